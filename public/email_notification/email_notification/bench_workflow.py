@@ -0,0 +1,524 @@
+"""
+Benchmarks for the approval email workflow.
+
+    python bench_workflow.py render [--iterations 5000] [--line-changes 10]
+    python bench_workflow.py coldstart [--runs 7] [--budget-ms 100]
+    python bench_workflow.py e2e [--sizes 1000,10000,100000] [--line-changes 0,10,100]
+                                 [--workers 1] [--dsn DSN] [--output FILE] [--baseline FILE]
+"""
+import argparse
+import concurrent.futures
+import itertools
+import json
+import logging
+import os
+import platform
+import resource
+import socketserver
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import types
+from datetime import datetime, timezone
+from decimal import Decimal
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import workflow
+
+
+def sample_changes(line_changes):
+    return {
+        "header_changes": {
+            "total_amount": "10,000.00 → 12,500.00",
+            "supplier_name": "Acme Freight → Acme Freight Pvt Ltd",
+        },
+        "line_changes": {
+            line: {"quantity": f"{line} → {line + 1}", "unit_price": "100.00 → 110.00"}
+            for line in range(1, line_changes + 1)
+        },
+    }
+
+
+def bench_render(iterations, line_changes):
+    """
+    Render cost per approval email (HTML + plain text) with precompiled templates
+    """
+    changes = sample_changes(line_changes)
+    workflow.precompile_email_templates()
+
+    start = time.perf_counter()
+    for i in range(iterations):
+        approve_url = f"http://127.0.0.1:8000/api/workflow/action?audit_id={i}&action=approve"
+        reject_url = f"http://127.0.0.1:8000/api/workflow/action?audit_id={i}&action=reject"
+        edit_url = f"http://127.0.0.1:8000/api/workflow/action?audit_id={i}&action=request_edit"
+        workflow.generate_approval_email_html(
+            invoice_number=f"INV-{i}",
+            formatted_amount="12,500.00",
+            audit_id=i,
+            approver_name="Approver L1",
+            approver_email="approver@example.com",
+            approver_level="L1",
+            changes=changes,
+            approve_url=approve_url,
+            reject_url=reject_url,
+            request_edit_url=edit_url,
+        )
+        workflow.generate_approval_email_plain_text(
+            invoice_number=f"INV-{i}",
+            formatted_amount="12,500.00",
+            audit_id=i,
+            approver_name="Approver L1",
+            changes=changes,
+            approve_url=approve_url,
+            reject_url=reject_url,
+            request_edit_url=edit_url,
+        )
+    elapsed = time.perf_counter() - start
+
+    print(f"render: {iterations} emails, {line_changes} line changes each")
+    print(f"  {elapsed / iterations * 1e6:.1f} µs/email, {iterations / elapsed:,.0f} emails/s")
+    return elapsed / iterations
+
+
+# Modules that must not be loaded just by importing workflow
+COLD_START_DEFERRED = ("psycopg2", "smtplib", "ssl", "email.mime.text", "email.mime.multipart")
+
+COLD_START_PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import workflow
+elapsed = time.perf_counter() - started
+print(json.dumps({"ms": elapsed * 1000, "loaded": [m for m in %r if m in sys.modules]}))
+"""
+
+
+def bench_coldstart(runs, budget_ms):
+    """
+    Time `import workflow` in fresh interpreters; returns False if the median exceeds
+    the budget or a deferred dependency was imported eagerly
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [here, os.environ.get("PYTHONPATH")])))
+    env.pop("WORKFLOW_PREWARM", None)
+
+    timings = []
+    eager = set()
+    for _ in range(runs):
+        out = subprocess.run(
+            [sys.executable, "-c", COLD_START_PROBE % (COLD_START_DEFERRED,)],
+            cwd=here, env=env, capture_output=True, text=True, check=True,
+        )
+        result = json.loads(out.stdout.strip().splitlines()[-1])
+        timings.append(result["ms"])
+        eager.update(result["loaded"])
+
+    median = statistics.median(timings)
+    print(f"coldstart: import workflow over {runs} runs")
+    print(f"  median {median:.1f} ms, min {min(timings):.1f} ms, max {max(timings):.1f} ms (budget {budget_ms:.0f} ms)")
+    ok = True
+    if eager:
+        print(f"  FAIL: imported eagerly: {', '.join(sorted(eager))}")
+        ok = False
+    if median > budget_ms:
+        print("  FAIL: median import time over budget")
+        ok = False
+    return ok
+
+
+# ---------------------------------------------------------------------------
+# End-to-end: routing -> audit -> pending changes -> render -> send, against a
+# local SMTP capture server and an in-memory DB stand-in (or a real Postgres)
+# ---------------------------------------------------------------------------
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    """
+    Just enough ESMTP for smtplib: EHLO, AUTH (any credentials), MAIL/RCPT/DATA, NOOP, RSET, QUIT
+    """
+
+    def reply(self, line):
+        self.wfile.write(line.encode("ascii") + b"\r\n")
+
+    def handle(self):
+        server = self.server
+        self.reply("220 bench-sink ESMTP")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            verb = line[:4].upper()
+            if verb == b"EHLO":
+                self.wfile.write(b"250-bench-sink\r\n250-AUTH PLAIN LOGIN\r\n250-8BITMIME\r\n250 SIZE 104857600\r\n")
+            elif verb == b"HELO":
+                self.reply("250 bench-sink")
+            elif verb == b"AUTH":
+                self.reply("235 2.7.0 Authentication successful")
+            elif verb in (b"MAIL", b"RCPT", b"RSET", b"NOOP"):
+                self.reply("250 OK")
+            elif verb == b"DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                size = 0
+                for data in self.rfile:
+                    if data == b".\r\n":
+                        break
+                    size += len(data)
+                with server.lock:
+                    server.messages += 1
+                    server.bytes += size
+                self.reply("250 OK queued")
+            elif verb == b"QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Command not implemented")
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host="127.0.0.1", port=0):
+        super().__init__((host, port), SMTPSinkHandler)
+        self.lock = threading.Lock()
+        self.messages = 0
+        self.bytes = 0
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="smtp-sink", daemon=True).start()
+        return self.server_address
+
+
+BENCH_HIERARCHY = [
+    {"min_amount": Decimal("0"), "max_amount": Decimal("100000"), "level_name": "L1",
+     "approver_name": "Approver L1", "approver_email": "l1@bench.local"},
+    {"min_amount": Decimal("100000.01"), "max_amount": Decimal("1000000"), "level_name": "L2",
+     "approver_name": "Approver L2", "approver_email": "l2@bench.local"},
+    {"min_amount": Decimal("1000000.01"), "max_amount": Decimal("999999999"), "level_name": "L3",
+     "approver_name": "Approver L3", "approver_email": "l3@bench.local"},
+]
+
+class FakeCursor:
+    """
+    Answers the statements workflow issues by keyword. Implements mogrify and
+    connection.encoding so psycopg2.extras.execute_values works against it.
+    """
+
+    def __init__(self, conn, dict_rows):
+        self.connection = conn
+        self.dict_rows = dict_rows
+        self._rows = []
+        self._pending_values = 0
+        self.rowcount = -1
+
+    def mogrify(self, template, args):
+        self._pending_values += 1
+        return b"(...)"
+
+    def execute(self, sql, params=None):
+        if self.connection.latency:
+            time.sleep(self.connection.latency)
+        if isinstance(sql, bytes):
+            sql = sql.decode("utf-8", "replace")
+        values, self._pending_values = self._pending_values, 0
+        if "SELECT 1" in sql:
+            rows = [(1,)]
+        elif "approval_hierarchy" in sql and "SELECT" in sql:
+            rows = [dict(tier) if self.dict_rows else tuple(tier.values()) for tier in BENCH_HIERARCHY]
+        elif "INSERT INTO \"DocAI\".workflow_audit_log" in sql:
+            rows = [(audit_id,) for audit_id in self.connection.db.next_ids(max(values, 1))]
+        elif "INSERT INTO \"DocAI\".email_send_log" in sql:
+            rows = [(params[0],)]
+        else:
+            rows = []
+        self._rows = rows
+        self.rowcount = len(rows)
+
+    def fetchone(self):
+        return self._rows.pop(0) if self._rows else None
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def close(self):
+        pass
+
+class FakeConnection:
+    closed = 0
+    autocommit = False
+    encoding = "UTF8"
+
+    def __init__(self, db, latency):
+        self.db = db
+        self.latency = latency
+
+    def cursor(self, cursor_factory=None, **kwargs):
+        return FakeCursor(self, cursor_factory is not None)
+
+    def commit(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+class FakeDatabase:
+    def __init__(self, latency_ms=0.0):
+        self.latency = latency_ms / 1000.0
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def next_ids(self, n):
+        with self._lock:
+            return [next(self._ids) for _ in range(n)]
+
+    def connect(self):
+        return FakeConnection(self, self.latency)
+
+def _install_psycopg2_stand_in():
+    """
+    The in-memory database does not need libpq, but workflow still looks up a few
+    psycopg2 names (execute_values, RealDictCursor, the error classes). When the driver
+    is not installed, register a module with just those so the stand-in runs anyway.
+    """
+    try:
+        import psycopg2.extras  # noqa: F401
+        return
+    except ImportError:
+        pass
+
+    psycopg2 = types.ModuleType("psycopg2")
+    psycopg2.Error = type("Error", (Exception,), {})
+    psycopg2.DatabaseError = type("DatabaseError", (psycopg2.Error,), {})
+    psycopg2.OperationalError = type("OperationalError", (psycopg2.DatabaseError,), {})
+    psycopg2.InterfaceError = type("InterfaceError", (psycopg2.Error,), {})
+
+    def execute_values(cur, sql, argslist, template=None, page_size=100, fetch=False):
+        # Same paging as psycopg2: one statement per page, the %s replaced by the rows
+        pre, post = sql.split("%s", 1)
+        argslist = list(argslist)
+        rows = []
+        for start in range(0, len(argslist), page_size):
+            values = b",".join(cur.mogrify(template, args) for args in argslist[start:start + page_size])
+            cur.execute(pre + values.decode() + post)
+            if fetch:
+                rows.extend(cur.fetchall())
+        return rows if fetch else None
+
+    extras = types.ModuleType("psycopg2.extras")
+    extras.RealDictCursor = type("RealDictCursor", (), {})
+    extras.execute_values = execute_values
+    psycopg2.extras = extras
+    sys.modules["psycopg2"] = psycopg2
+    sys.modules["psycopg2.extras"] = extras
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+# 1 µs .. ~60 s in 10% steps so p50/p99 are within a bucket width of the truth
+E2E_BUCKETS = tuple(1e-6 * 1.1 ** i for i in range(190))
+
+def run_e2e(invoices, line_changes, workers=1, dsn=None, db_latency_ms=0.0):
+    """
+    Push `invoices` approvals through start_approval_workflow and return a result dict
+    """
+    sink = SMTPSink()
+    host, port = sink.start()
+    os.environ.update({
+        "SMTP_SERVER": host,
+        "SMTP_PORT": str(port),
+        "SMTP_USER": "bench@bench.local",
+        "SMTP_PASSWORD": "bench",
+        "SMTP_STARTTLS": "0",
+        "WORKFLOW_APPROVAL_DIGEST": "0",
+        "WORKFLOW_EMAIL_MODE": "direct",
+    })
+
+    if dsn:
+        import psycopg2
+        workflow.configure_db_pool(factory=lambda: psycopg2.connect(dsn), maxconn=max(workers, 1) + 2)
+    else:
+        _install_psycopg2_stand_in()
+        workflow.configure_db_pool(factory=FakeDatabase(db_latency_ms).connect, maxconn=max(workers, 1) + 2)
+
+    # Pending changes come from the unifycode history tables in production; the
+    # stand-in returns a diff of the requested size for every invoice
+    changes = sample_changes(line_changes)
+    workflow._unifycode_attrs["get_pending_changes_from_history"] = lambda invoice_number: changes
+
+    workflow.invalidate_approval_hierarchy()
+    workflow.invalidate_pending_changes()
+    workflow.reset_workflow_metrics(E2E_BUCKETS)
+
+    def one(i):
+        invoice_number = f"BENCH-{i:07d}"
+        amount = 5000 + (i * 7919) % 2000000
+        with workflow._timed_stage("end_to_end"):
+            result = workflow.start_approval_workflow(invoice_number, amount * 0.9, amount, supplier_name="Bench Supplier")
+        return bool(result and result["email_ok"])
+
+    started = time.perf_counter()
+    if workers > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            sent = sum(pool.map(one, range(invoices), chunksize=64))
+    else:
+        sent = sum(one(i) for i in range(invoices))
+    elapsed = time.perf_counter() - started
+
+    workflow.close_smtp_pool()
+    workflow.close_db_pool()
+    sink.shutdown()
+    sink.server_close()
+
+    metrics = workflow.get_workflow_metrics()
+    stages = {
+        stage: {
+            "count": values["count"],
+            "mean_ms": values["sum"] / values["count"] * 1000 if values["count"] else None,
+            "p50_ms": values["p50"] * 1000 if values["p50"] is not None else None,
+            "p99_ms": values["p99"] * 1000 if values["p99"] is not None else None,
+        }
+        for stage, values in metrics["stages"].items()
+    }
+    return {
+        "invoices": invoices,
+        "line_changes": line_changes,
+        "workers": workers,
+        "db": "postgres" if dsn else f"fake(latency_ms={db_latency_ms:g})",
+        "elapsed_s": elapsed,
+        "emails_sent": sent,
+        "emails_per_sec": sent / elapsed if elapsed else None,
+        "sink_messages": sink.messages,
+        "sink_bytes": sink.bytes,
+        "bytes_per_email": sink.bytes / sink.messages if sink.messages else None,
+        "failures": metrics["failures"],
+        "stages": stages,
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def bench_e2e(sizes, line_changes, workers, dsn, db_latency_ms, output, baseline=None):
+    """
+    Run every (size, line_changes) scenario in its own interpreter so peak RSS is per run,
+    print a summary and save everything as JSON. `report["ok"]` is False when any
+    scenario crashed or did not send every email.
+    """
+    runs = []
+    ok = True
+    for size in sizes:
+        for lines in line_changes:
+            cmd = [sys.executable, os.path.abspath(__file__), "e2e-run",
+                   "--invoices", str(size), "--line-changes", str(lines),
+                   "--workers", str(workers), "--db-latency-ms", str(db_latency_ms)]
+            if dsn:
+                cmd += ["--dsn", dsn]
+            out = subprocess.run(cmd, capture_output=True, text=True)
+            lines_out = out.stdout.strip().splitlines()
+            if not lines_out:
+                print(f"e2e: {size:>7} invoices, {lines:>4} line changes: FAIL (exit {out.returncode})")
+                print(out.stderr.strip()[-2000:])
+                ok = False
+                continue
+            result = json.loads(lines_out[-1])
+            runs.append(result)
+            e2e = result["stages"].get("end_to_end", {})
+            print(f"e2e: {size:>7} invoices, {lines:>4} line changes: "
+                  f"{result['emails_per_sec']:,.0f} emails/s, "
+                  f"p50 {e2e.get('p50_ms') or 0:.2f} ms, p99 {e2e.get('p99_ms') or 0:.2f} ms, "
+                  f"{result['bytes_per_email'] or 0:,.0f} bytes/email, "
+                  f"peak RSS {result['peak_rss_mb']:.0f} MB")
+            if result["sink_messages"] != result["emails_sent"]:
+                print(f"  WARNING: sink captured {result['sink_messages']} of {result['emails_sent']} sent emails")
+            if result["emails_sent"] != result["invoices"]:
+                print(f"  FAIL: only {result['emails_sent']} of {result['invoices']} approval emails were sent")
+                ok = False
+
+    report = {
+        "started_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "git_commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "ok": ok,
+        "runs": runs,
+    }
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"results saved to {output}")
+
+    if baseline:
+        with open(baseline, encoding="utf-8") as f:
+            previous = {(r["invoices"], r["line_changes"], r["workers"]): r for r in json.load(f)["runs"]}
+        for run in runs:
+            before = previous.get((run["invoices"], run["line_changes"], run["workers"]))
+            if before and before.get("emails_per_sec"):
+                change = (run["emails_per_sec"] / before["emails_per_sec"] - 1) * 100
+                print(f"  vs baseline {run['invoices']}/{run['line_changes']}: {change:+.1f}% emails/s")
+            if before and before.get("bytes_per_email") and run.get("bytes_per_email"):
+                change = (run["bytes_per_email"] / before["bytes_per_email"] - 1) * 100
+                print(f"  vs baseline {run['invoices']}/{run['line_changes']}: {change:+.1f}% bytes/email")
+    return report
+
+def _int_list(value):
+    return [int(part) for part in value.split(",") if part.strip()]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    render = sub.add_parser("render", help="per-email template render cost")
+    render.add_argument("--iterations", type=int, default=5000)
+    render.add_argument("--line-changes", type=int, default=10)
+
+    coldstart = sub.add_parser("coldstart", help="import time in a fresh interpreter, checked against a budget")
+    coldstart.add_argument("--runs", type=int, default=7)
+    coldstart.add_argument("--budget-ms", type=float, default=float(os.getenv("WORKFLOW_COLDSTART_BUDGET_MS", 100)))
+
+    e2e = sub.add_parser("e2e", help="full pipeline against a local SMTP sink, one process per scenario")
+    e2e.add_argument("--sizes", type=_int_list, default=[1000, 10000, 100000])
+    e2e.add_argument("--line-changes", type=_int_list, default=[0, 10, 100])
+    e2e.add_argument("--workers", type=int, default=1)
+    e2e.add_argument("--dsn", help="use this Postgres instead of the in-memory stand-in")
+    e2e.add_argument("--db-latency-ms", type=float, default=0.0, help="simulated round trip for the stand-in")
+    e2e.add_argument("--output", default=f"bench-e2e-{datetime.now():%Y%m%d-%H%M%S}.json")
+    e2e.add_argument("--baseline", help="earlier results file to compare emails/s against")
+
+    e2e_run = sub.add_parser("e2e-run", help=argparse.SUPPRESS)
+    e2e_run.add_argument("--invoices", type=int, required=True)
+    e2e_run.add_argument("--line-changes", type=int, default=10)
+    e2e_run.add_argument("--workers", type=int, default=1)
+    e2e_run.add_argument("--dsn")
+    e2e_run.add_argument("--db-latency-ms", type=float, default=0.0)
+
+    args = parser.parse_args(argv)
+    if args.command == "render":
+        bench_render(args.iterations, args.line_changes)
+    elif args.command == "coldstart":
+        return 0 if bench_coldstart(args.runs, args.budget_ms) else 1
+    elif args.command == "e2e":
+        report = bench_e2e(args.sizes, args.line_changes, args.workers, args.dsn, args.db_latency_ms, args.output,
+                           args.baseline)
+        return 0 if report["ok"] else 1
+    elif args.command == "e2e-run":
+        workflow.logger.setLevel(logging.WARNING)
+        result = run_e2e(args.invoices, args.line_changes, args.workers, args.dsn, args.db_latency_ms)
+        print(json.dumps(result))
+        return 0 if result["emails_sent"] == result["invoices"] else 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
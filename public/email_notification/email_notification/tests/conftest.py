@@ -0,0 +1,223 @@
+"""
+Test doubles for the workflow modules: an in-memory psycopg2, a scripted DB connection
+and an SMTP server that records messages. Nothing here needs a live Postgres or SMTP.
+"""
+
+import os
+import sys
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import workflow
+import workflow_core
+import workflow_db
+import workflow_smtp
+
+
+class FakeCursor:
+    def __init__(self, conn, dict_rows=False):
+        self.conn = conn
+        self.dict_rows = dict_rows
+        self.rows = []
+
+    def execute(self, sql, params=None):
+        self.conn.db.log.append((sql, params))
+        self.rows = list(self.conn.db.handler(sql, params) or [])
+
+    def executemany(self, sql, params_seq):
+        for params in params_seq:
+            self.execute(sql, params)
+
+    def execute_values(self, sql, argslist, template=None, page_size=100, fetch=False):
+        argslist = list(argslist)
+        self.conn.db.log.append((sql, argslist))
+        rows = list(self.conn.db.handler(sql, argslist) or [])
+        self.rows = [] if fetch else rows
+        return rows
+
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    @property
+    def rowcount(self):
+        return len(self.rows)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class FakeConnection:
+    def __init__(self, db):
+        self.db = db
+        self.closed = 0
+        self.autocommit = False
+
+    def cursor(self, cursor_factory=None, **kwargs):
+        self.db.cursors += 1
+        return FakeCursor(self, cursor_factory is not None)
+
+    def commit(self):
+        self.db.log.append(("COMMIT", None))
+
+    def rollback(self):
+        self.db.rollbacks += 1
+
+    def close(self):
+        self.closed = 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class FakeDB:
+    """
+    Connection factory whose cursors answer every statement with handler(sql, params)
+    """
+
+    def __init__(self, handler=None):
+        self.handler = handler or (lambda sql, params: [])
+        self.log = []
+        self.connections = []
+        self.cursors = 0
+        self.rollbacks = 0
+
+    def connect(self):
+        conn = FakeConnection(self)
+        self.connections.append(conn)
+        return conn
+
+    def statements(self, fragment):
+        return [entry for entry in self.log if fragment in entry[0]]
+
+
+def _fake_psycopg2():
+    psycopg2 = types.ModuleType("psycopg2")
+
+    class Error(Exception):
+        pass
+
+    class OperationalError(Error):
+        pass
+
+    class InterfaceError(Error):
+        pass
+
+    class DatabaseError(Error):
+        pass
+
+    def connect(*args, **kwargs):
+        raise OperationalError("no database in tests")
+
+    psycopg2.Error = Error
+    psycopg2.OperationalError = OperationalError
+    psycopg2.InterfaceError = InterfaceError
+    psycopg2.DatabaseError = DatabaseError
+    psycopg2.connect = connect
+
+    extras = types.ModuleType("psycopg2.extras")
+
+    class RealDictCursor:
+        pass
+
+    def execute_values(cur, sql, argslist, template=None, page_size=100, fetch=False):
+        return cur.execute_values(sql, argslist, template, page_size, fetch)
+
+    extras.RealDictCursor = RealDictCursor
+    extras.execute_values = execute_values
+    psycopg2.extras = extras
+    return psycopg2, extras
+
+
+@pytest.fixture(autouse=True)
+def fake_psycopg2(monkeypatch):
+    psycopg2, extras = _fake_psycopg2()
+    monkeypatch.setitem(sys.modules, "psycopg2", psycopg2)
+    monkeypatch.setitem(sys.modules, "psycopg2.extras", extras)
+    monkeypatch.setitem(workflow_core.psycopg2.__dict__, "_module", psycopg2)
+    monkeypatch.setitem(workflow_core._psycopg2_extras.__dict__, "_module", extras)
+    return psycopg2
+
+
+@pytest.fixture(autouse=True)
+def isolated_workflow(monkeypatch):
+    """
+    No rate-limit sleeps, no shared pools or caches leaking between tests
+    """
+    monkeypatch.setenv("WORKFLOW_SMTP_RATE_LIMIT", "0")
+    monkeypatch.setattr(workflow_smtp, "_send_rate_limiter", None)
+    workflow._sent_keys.clear()
+    yield
+    workflow_db.close_db_pool()
+    workflow_smtp.close_smtp_pool()
+    workflow._sent_keys.clear()
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    """
+    FakeDB wired in as the process-wide pool's connection factory
+    """
+    db = FakeDB()
+    monkeypatch.setitem(workflow_core._unifycode_attrs, "get_db_connection", db.connect)
+    workflow_db.configure_db_pool(db.connect, minconn=0, maxconn=4, timeout=0.2)
+    return db
+
+
+class FakeSMTP:
+    def __init__(self, host, port, timeout=None):
+        self.host = host
+        self.port = port
+        self.sock = object()
+        self.sent = []
+        self.fail_with = []
+        FakeSMTP.instances.append(self)
+
+    def starttls(self):
+        pass
+
+    def login(self, user, password):
+        pass
+
+    def noop(self):
+        return (250, b"ok") if self.sock else (421, b"closed")
+
+    def send_message(self, msg):
+        if self.fail_with:
+            raise self.fail_with.pop(0)
+        self.sent.append(msg)
+        FakeSMTP.messages.append(msg)
+        return {}
+
+    def quit(self):
+        self.sock = None
+
+    def close(self):
+        self.sock = None
+
+
+@pytest.fixture
+def fake_smtp(monkeypatch):
+    import smtplib
+
+    FakeSMTP.instances = []
+    FakeSMTP.messages = []
+    monkeypatch.setattr(smtplib, "SMTP", FakeSMTP)
+    monkeypatch.setenv("SMTP_USER", "workflow@invoices.test")
+    monkeypatch.setenv("SMTP_PASSWORD", "secret")
+    return FakeSMTP
@@ -0,0 +1,36 @@
+import base64
+import io
+
+import workflow
+
+
+def test_chunked_encoding_matches_one_shot_base64():
+    raw = bytes(range(256)) * 1000
+    payload = workflow._encode_base64_stream(io.BytesIO(raw), limit=10**7)
+
+    assert payload == base64.encodebytes(raw).decode("ascii")
+    assert len(payload) <= workflow._encoded_size(len(raw))
+
+
+def test_encoding_stops_reading_once_over_the_cap():
+    stream = io.BytesIO(b"x" * (workflow._ATTACHMENT_CHUNK_BYTES * 10))
+
+    assert workflow._encode_base64_stream(stream, limit=workflow._encoded_size(workflow._ATTACHMENT_CHUNK_BYTES)) is None
+    assert stream.tell() == workflow._ATTACHMENT_CHUNK_BYTES * 2
+
+
+def test_seekable_stream_over_the_cap_is_never_read():
+    stream = io.BytesIO(b"x" * (workflow._ATTACHMENT_CHUNK_BYTES * 10))
+    document = workflow.InvoiceDocument(stream, filename="INV-1.pdf")
+
+    assert workflow._encode_invoice_document(document, limit=workflow._encoded_size(workflow._ATTACHMENT_CHUNK_BYTES)) is None
+    assert stream.tell() == 0
+
+
+def test_file_over_the_cap_is_never_opened(tmp_path, monkeypatch):
+    path = tmp_path / "INV-1.pdf"
+    path.write_bytes(b"x" * 1000)
+    document = workflow.InvoiceDocument(str(path))
+    monkeypatch.setattr("builtins.open", None)
+
+    assert workflow._encode_invoice_document(document, limit=workflow._encoded_size(1000) - 1) is None
@@ -0,0 +1,75 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import workflow
+import workflow_partitions
+
+T0 = datetime(2026, 3, 31, 23, 59, 59, 999999, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def audit_log(fake_db):
+    """
+    Fake DB answering the keyset query over 7 rows; ids 3-5 share one created_at
+    """
+    stamps = [T0, T0 + timedelta(seconds=1), T0 + timedelta(seconds=2), T0 + timedelta(seconds=2),
+              T0 + timedelta(seconds=2), T0 + timedelta(days=1), T0 + timedelta(days=40)]
+    rows = [{"id": audit_id, "created_at": created_at, "status": "pending"}
+            for audit_id, created_at in enumerate(stamps, start=1)]
+
+    def handler(sql, params):
+        newest_first = "DESC" in sql
+        *_, limit = params
+        page = sorted(rows, key=lambda row: (row["created_at"], row["id"]), reverse=newest_first)
+        if "(created_at, id)" in sql:
+            after = tuple(params[-3:-1])
+            page = [row for row in page
+                    if ((row["created_at"], row["id"]) < after if newest_first else (row["created_at"], row["id"]) > after)]
+        return page[:limit]
+
+    fake_db.handler = handler
+    return fake_db
+
+
+def pages(limit, newest_first=True):
+    cursor = None
+    while True:
+        page = workflow.list_workflow_audits(limit=limit, cursor=cursor, newest_first=newest_first)
+        yield [row["id"] for row in page["rows"]]
+        cursor = page["next_cursor"]
+        if cursor is None:
+            return
+
+
+def test_cursor_round_trips_timestamp_and_id():
+    cursor = workflow_partitions._encode_audit_cursor(T0, 42)
+    assert workflow_partitions._decode_audit_cursor(cursor) == (T0, 42)
+    assert cursor.isascii() and "|" not in cursor
+
+
+@pytest.mark.parametrize("limit", [1, 2, 3, 7])
+def test_pages_cover_every_row_once_across_ties(audit_log, limit):
+    assert sum(pages(limit), []) == [7, 6, 5, 4, 3, 2, 1]
+    assert sum(pages(limit, newest_first=False), []) == [1, 2, 3, 4, 5, 6, 7]
+
+
+def test_last_page_has_no_cursor(audit_log):
+    assert list(pages(7)) == [[7, 6, 5, 4, 3, 2, 1]]
+
+
+def test_cursor_becomes_a_row_value_bound(audit_log):
+    first = workflow.list_workflow_audits(limit=2, status="pending")
+    workflow.list_workflow_audits(limit=2, status="pending", cursor=first["next_cursor"])
+
+    sql, params = audit_log.log[-1]
+    assert "(created_at, id) < (%s, %s)" in sql
+    assert params == ["pending", T0 + timedelta(days=1), 6, 3]
+
+
+def test_query_failure_returns_none(audit_log):
+    def broken(sql, params):
+        raise RuntimeError("connection reset")
+
+    audit_log.handler = broken
+    assert workflow.list_workflow_audits() is None
@@ -0,0 +1,107 @@
+import itertools
+import threading
+
+import pytest
+
+import workflow
+
+
+@pytest.fixture
+def audit_log(fake_db):
+    """
+    Fake workflow_audit_log: `audit_log.rows` maps id -> invoice_number; a row for
+    invoice "BAD" fails the whole statement it is in
+    """
+    rows = {}
+    ids = itertools.count(1)
+
+    def handler(sql, params):
+        if 'INSERT INTO "DocAI".workflow_audit_log' not in sql:
+            return []
+        if any(row[0] == "BAD" for row in params):
+            raise ValueError("invalid input syntax for type numeric")
+        inserted = []
+        for row in params:
+            audit_id = next(ids)
+            rows[audit_id] = row[0]
+            inserted.append((audit_id,))
+        return inserted
+
+    fake_db.handler = handler
+    fake_db.rows = rows
+    fake_db.commits = lambda: len(fake_db.statements("COMMIT"))
+    yield fake_db
+    workflow.disable_audit_group_commit()
+
+
+def create(invoice_number):
+    return workflow.create_workflow_audit(invoice_number, 100, 120, "L1", "l1@corp.test", "Lee")
+
+
+def create_concurrently(invoice_numbers):
+    results = {}
+    start = threading.Barrier(len(invoice_numbers))
+
+    def worker(invoice_number):
+        start.wait()
+        results[invoice_number] = create(invoice_number)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in invoice_numbers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    return results
+
+
+def test_without_group_commit_each_audit_commits(audit_log):
+    assert [create("INV-1"), create("INV-2")] == [1, 2]
+    assert audit_log.commits() == 2
+
+
+def test_concurrent_audits_share_one_commit(audit_log, monkeypatch):
+    monkeypatch.setenv("WORKFLOW_AUDIT_GROUP_COMMIT", "1")
+    monkeypatch.setenv("WORKFLOW_AUDIT_BATCH_WINDOW_MS", "500")
+    invoice_numbers = [f"INV-{n}" for n in range(12)]
+
+    results = create_concurrently(invoice_numbers)
+    # Every caller gets the id of its own row
+    assert {audit_log.rows[audit_id]: audit_id for audit_id in results.values()} == results
+    assert audit_log.commits() < len(invoice_numbers)
+
+
+def test_batch_is_capped_at_max_batch(audit_log):
+    committer = workflow.enable_audit_group_commit(window_ms=500, max_batch=3)
+    futures = [committer.submit((f"INV-{n}", 100, 120, "L1", "l1@corp.test", "user_1")) for n in range(7)]
+    assert sorted(future.result(5) for future in futures) == list(range(1, 8))
+    assert all(len(params) <= 3 for _, params in audit_log.statements("workflow_audit_log"))
+
+
+def test_one_bad_row_does_not_fail_the_others(audit_log, monkeypatch):
+    monkeypatch.setenv("WORKFLOW_AUDIT_GROUP_COMMIT", "1")
+    monkeypatch.setenv("WORKFLOW_AUDIT_BATCH_WINDOW_MS", "500")
+
+    results = create_concurrently(["INV-1", "BAD", "INV-2"])
+    assert results["BAD"] is None
+    assert sorted(audit_log.rows[results[n]] for n in ("INV-1", "INV-2")) == ["INV-1", "INV-2"]
+
+
+def test_disable_flushes_pending_inserts(audit_log):
+    committer = workflow.enable_audit_group_commit(window_ms=60000)
+    future = committer.submit(("INV-1", 100, 120, "L1", "l1@corp.test", "user_1"))
+    workflow.disable_audit_group_commit()
+    assert future.result(0) == 1
+    assert audit_log.commits() == 1
+
+
+def test_bulk_insert_is_one_statement_and_one_commit(audit_log):
+    entries = [
+        {"invoice_number": "INV-1", "changed_amount": 120, "approver_level": "L1", "user_id": 7},
+        ("INV-2", 100, 120, "L1", "l1@corp.test"),
+    ]
+    assert workflow.create_workflow_audits_bulk(entries) == [1, 2]
+    (_, params), = audit_log.statements("workflow_audit_log")
+    assert [row[0] for row in params] == ["INV-1", "INV-2"]
+    assert params[0][-1] == "user_7"
+    assert audit_log.commits() == 1
+    assert workflow.create_workflow_audits_bulk([]) == []
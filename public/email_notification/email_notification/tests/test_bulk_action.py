@@ -0,0 +1,119 @@
+import pytest
+
+import workflow
+
+
+@pytest.fixture
+def audit_rows(fake_db, monkeypatch):
+    """
+    Fake DB holding workflow_audit_log rows {id: [status, invoice_number, change_requested_by]}
+    and applying the bulk statement to them
+    """
+    monkeypatch.setenv("WORKFLOW_DEFAULT_REQUESTER_EMAIL", "requester@invoices.test")
+    rows = {
+        1: ["pending", "INV-1", "user_1"],
+        2: ["approved", "INV-2", "user_2"],
+        3: ["pending", "INV-3", "user_1"],
+    }
+
+    def handler(sql, params):
+        if "locked AS" not in sql:
+            return []
+        ids, new_status = params
+        result = []
+        for audit_id in dict.fromkeys(ids):
+            row = rows.get(audit_id)
+            if row is None:
+                result.append((audit_id, False, None, None, None))
+                continue
+            current_status, invoice_number, requested_by = row
+            applied = current_status == "pending"
+            if applied:
+                row[0] = new_status
+            result.append((audit_id, applied, invoice_number, current_status, requested_by))
+        return result
+
+    fake_db.handler = handler
+    fake_db.rows = rows
+    return fake_db
+
+
+@pytest.mark.parametrize("action, status", [("approve", "approved"), ("reject", "rejected"),
+                                            ("request_edit", "request_edit")])
+def test_writes_the_existing_status_values(audit_rows, fake_smtp, action, status):
+    results = workflow.process_bulk_workflow_action([1, 3], action)
+
+    assert [r["status"] for r in results.values()] == [status, status]
+    assert audit_rows.rows[1][0] == audit_rows.rows[3][0] == status
+    (_, params), = audit_rows.statements("locked AS")
+    assert params == ([1, 3], status)
+
+
+def test_results_keep_caller_order_and_report_every_id(audit_rows, fake_smtp):
+    results = workflow.process_bulk_workflow_action(["3", "x", 2, 9, None, 1, 3], "approve")
+
+    assert list(results) == [3, "x", 2, 9, None, 1]
+    assert results[3] == {"ok": True, "status": "approved", "invoice_number": "INV-3", "error": None, "notified": True}
+    assert results["x"] == results[None] == {"ok": False, "status": None, "invoice_number": None, "error": "invalid_id",
+                                             "notified": False}
+    assert results[2]["error"] == "invalid_state: already approved"
+    assert results[9]["error"] == "not_found"
+    (_, params), = audit_rows.statements("locked AS")
+    assert params[0] == [3, 2, 9, 1]
+
+
+def test_only_invalid_ids_skip_the_database(audit_rows, fake_smtp):
+    results = workflow.process_bulk_workflow_action(["x", [1]], "reject")
+
+    assert [r["error"] for r in results.values()] == ["invalid_id", "invalid_id"]
+    assert audit_rows.log == []
+
+
+def test_unknown_action_changes_nothing(audit_rows, fake_smtp):
+    assert workflow.process_bulk_workflow_action([1], "approved") is None
+    assert audit_rows.log == []
+
+
+def test_state_comes_from_locked_rows():
+    # A row another approver changed while we waited for the lock must be reported
+    # with that status, so nothing may read the audit table outside the locked CTE
+    sql = " ".join(workflow.BULK_WORKFLOW_ACTION_SQL.split())
+    assert "FOR UPDATE OF w" in sql
+    assert "l.status AS current_status" in sql
+    assert sql.count('"DocAI".workflow_audit_log') == 2
+
+
+def test_one_notification_per_requester(audit_rows, fake_smtp):
+    workflow.process_bulk_workflow_action([1, 2, 3], "approve", notes="Looks good")
+
+    assert len(fake_smtp.messages) == 1
+    msg = fake_smtp.messages[0]
+    assert msg["To"] == "requester@invoices.test"
+    assert msg["Subject"].startswith("Update: 2 invoices")
+
+
+def test_requester_email_in_the_audit_row_is_used(audit_rows, fake_smtp, monkeypatch):
+    monkeypatch.delenv("WORKFLOW_DEFAULT_REQUESTER_EMAIL")
+    audit_rows.rows[1][2] = "asha@invoices.test"
+    results = workflow.process_bulk_workflow_action([1], "reject")
+
+    assert results[1]["notified"] is True
+    assert [msg["To"] for msg in fake_smtp.messages] == ["asha@invoices.test"]
+
+
+def test_unreachable_requester_is_reported(audit_rows, fake_smtp, monkeypatch, caplog):
+    # No unifycode module and no default address: the update stands, the miss is reported
+    monkeypatch.delenv("WORKFLOW_DEFAULT_REQUESTER_EMAIL")
+    results = workflow.process_bulk_workflow_action([1, 3], "approve")
+
+    assert [r["ok"] for r in results.values()] == [True, True]
+    assert [r["notified"] for r in results.values()] == [False, False]
+    assert fake_smtp.messages == []
+    assert "not notified: INV-1, INV-3" in caplog.text
+
+
+def test_failed_send_is_reported(audit_rows, fake_smtp, monkeypatch):
+    monkeypatch.setattr(workflow, "send_email_messages_batch", lambda messages, smtp_config=None: [False] * len(messages))
+    results = workflow.process_bulk_workflow_action([1], "approve")
+    assert results[1]["ok"] is True
+    assert results[1]["notified"] is False
@@ -0,0 +1,97 @@
+import csv
+import io
+import time
+
+import pytest
+
+import workflow
+
+
+def line_changes(count):
+    return {n: {"quantity": f"{n} → {n + 1}", "unit_price": "10 → 11"} for n in range(1, count + 1)}
+
+
+def baseline_changes_summary_plain_text(changes):
+    """
+    The plain-text summary as the pre-optimization implementation built it
+    """
+    changes_text = "CHANGES SUMMARY:\n\n"
+    if changes.get("header_changes"):
+        changes_text += "Header Changes:\n"
+        changes_text += "-" * 40 + "\n"
+        for field, change_desc in changes["header_changes"].items():
+            changes_text += f"  {field.replace('_', ' ').title()}: {change_desc}\n"
+        changes_text += "\n"
+    if changes.get("line_changes"):
+        changes_text += "Line Item Changes:\n"
+        changes_text += "-" * 40 + "\n"
+        for line_num, line_changes in changes["line_changes"].items():
+            changes_text += f"Line {line_num}:\n"
+            for field, change_desc in line_changes.items():
+                changes_text += f"  {field.replace('_', ' ').title()}: {change_desc}\n"
+            changes_text += "\n"
+    return changes_text
+
+
+@pytest.fixture
+def plain_html(monkeypatch):
+    monkeypatch.setenv("WORKFLOW_EMAIL_MINIFY", "0")
+
+
+def test_plain_text_matches_baseline():
+    changes = {"header_changes": {"supplier_name": "Acme → Acme Ltd"}, "line_changes": line_changes(3)}
+    assert workflow.generate_changes_summary_plain_text(changes) == baseline_changes_summary_plain_text(changes)
+
+
+def test_only_the_first_lines_are_rendered(plain_html):
+    changes = {"line_changes": line_changes(10)}
+
+    text = workflow.generate_changes_summary_plain_text(changes, max_line_changes=3, full_diff_attached=True)
+    assert [line for line in text.splitlines() if line.startswith("Line ") and line[5].isdigit()] == ["Line 1:", "Line 2:", "Line 3:"]
+    assert text.endswith("... and 7 more line item changes (full diff attached as CSV)\n\n")
+
+    markup = workflow.generate_changes_summary_html(changes, max_line_changes=3)
+    assert markup.count('<div class="line-change">') == 3
+    assert "… and 7 more line item changes</em>" in markup
+
+
+def test_summary_values_are_escaped(plain_html):
+    markup = workflow.generate_changes_summary_html({"header_changes": {"description": "<b>bolt</b> → nut"}})
+    assert "&lt;b&gt;bolt&lt;/b&gt; → nut" in markup
+    assert "<b>" not in markup
+
+
+def test_csv_holds_every_change():
+    changes = {"header_changes": {"currency": "INR → USD"}, "line_changes": line_changes(250)}
+    rows = list(csv.reader(io.StringIO(workflow.build_changes_csv(changes))))
+    assert rows[:2] == [["scope", "line", "field", "change"], ["header", "", "Currency", "INR → USD"]]
+    assert len(rows) == 2 + 250 * 2
+    assert rows[-1] == ["line", "250", "Unit Price", "10 → 11"]
+
+
+@pytest.mark.parametrize("line_count, attach_setting, attached", [(5, "1", False), (6, "1", True), (6, "0", False)])
+def test_full_diff_attachment_over_the_line_cap(monkeypatch, line_count, attach_setting, attached):
+    monkeypatch.setenv("WORKFLOW_EMAIL_MAX_LINE_CHANGES", "5")
+    monkeypatch.setenv("WORKFLOW_EMAIL_ATTACH_FULL_DIFF", attach_setting)
+    msg = workflow.build_approval_email_message("INV-1", 100, "l1@corp.test", "Lee", 7,
+                                                {"line_changes": line_changes(line_count)}, sender_email="ap@corp.test")
+
+    filenames = [part.get_filename() for part in msg.walk() if part.get_filename()]
+    assert filenames == (["invoice_INV-1_changes.csv"] if attached else [])
+
+
+def best_time(render, repeat=3):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        render()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def test_rendering_time_grows_linearly(plain_html):
+    small, large = {"line_changes": line_changes(2000)}, {"line_changes": line_changes(20000)}
+    for render in (workflow.generate_changes_summary_html, workflow.generate_changes_summary_plain_text):
+        ratio = best_time(lambda: render(large)) / best_time(lambda: render(small))
+        # 10x the lines: about 10x the time; repeated string concatenation would be far worse
+        assert ratio < 30, (render.__name__, ratio)
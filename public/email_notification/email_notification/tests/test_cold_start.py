@@ -0,0 +1,65 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+import bench_workflow
+import workflow
+
+MODULE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_fresh(code):
+    env = dict(os.environ)
+    env.pop("WORKFLOW_PREWARM", None)
+    return subprocess.run([sys.executable, "-c", code], cwd=MODULE_DIR, env=env,
+                          capture_output=True, text=True, timeout=60)
+
+
+def test_import_stays_within_the_cold_start_budget(capsys):
+    budget_ms = float(os.getenv("WORKFLOW_COLDSTART_BUDGET_MS", 100))
+    assert bench_workflow.bench_coldstart(runs=3, budget_ms=budget_ms), capsys.readouterr().out
+
+
+def test_heavy_modules_load_on_first_use():
+    code = (
+        "import sys, workflow\n"
+        "deferred = ('psycopg2', 'smtplib', 'ssl', 'email.mime.text', 'email.mime.multipart', 'numpy')\n"
+        "assert not [m for m in deferred if m in sys.modules], [m for m in deferred if m in sys.modules]\n"
+        "workflow.build_action_notification_message('INV-1', 'approve', None, 'a@corp.test', sender_email='ap@corp.test')\n"
+        "assert 'email.mime.multipart' in sys.modules\n"
+        "assert 'psycopg2' not in sys.modules and 'smtplib' not in sys.modules\n"
+    )
+    result = run_fresh(code)
+    assert result.returncode == 0, result.stderr
+
+
+def test_prewarm_compiles_templates_and_opens_connections(fake_db, fake_smtp, monkeypatch):
+    monkeypatch.setattr(workflow, "_compiled_templates", {})
+    workflow.invalidate_approval_hierarchy()
+
+    assert workflow.prewarm(background=False) is None
+    minify = workflow._email_minify_enabled()
+    assert set(workflow._compiled_templates) == {(name, minify) for name in workflow._EMAIL_TEMPLATE_SOURCES}
+    assert fake_db.statements('FROM "DocAI".approval_hierarchy')
+    assert workflow.get_smtp_pool().stats()["idle"] == 1
+    workflow.invalidate_approval_hierarchy()
+
+
+def test_prewarm_without_smtp_credentials_skips_the_session(fake_db, fake_smtp, monkeypatch):
+    monkeypatch.setenv("SMTP_PASSWORD", "")
+    workflow.prewarm(db=False, background=False)
+    assert fake_smtp.instances == []
+
+
+@pytest.mark.parametrize("setting, parts", [
+    ("", None), ("0", None), ("1", (True, True)), ("all", (True, True)),
+    ("db", (True, False)), ("smtp", (False, True)), ("db, smtp", (True, True)),
+])
+def test_prewarm_setting_picks_the_parts(monkeypatch, setting, parts):
+    calls = []
+    monkeypatch.setattr(workflow, "prewarm", lambda db=True, smtp=True: calls.append((db, smtp)))
+    monkeypatch.setenv("WORKFLOW_PREWARM", setting)
+    workflow.prewarm_from_env()
+    assert calls == ([parts] if parts else [])
@@ -0,0 +1,126 @@
+import threading
+
+import pytest
+
+import workflow_db
+from conftest import FakeDB
+
+
+def make_pool(db, **settings):
+    settings.setdefault("minconn", 0)
+    settings.setdefault("maxconn", 2)
+    settings.setdefault("timeout", 0.1)
+    return workflow_db.DBConnectionPool(db.connect, **settings)
+
+
+def test_close_returns_connection_for_reuse():
+    db = FakeDB()
+    pool = make_pool(db)
+
+    conn = pool.acquire()
+    raw = conn._conn
+    conn.close()
+    again = pool.acquire()
+
+    assert again._conn is raw
+    assert len(db.connections) == 1
+    # returned connections never carry an open transaction, nor does the checkout ping
+    assert db.rollbacks == 2
+    stats = pool.stats()
+    assert stats["checkouts"] == 2
+    assert stats["created"] == 1
+    assert stats["in_use"] == 1
+
+
+def test_double_close_is_harmless():
+    pool = make_pool(FakeDB())
+    conn = pool.acquire()
+    conn.close()
+    conn.close()
+    assert pool.stats()["in_use"] == 0
+    assert pool.stats()["idle"] == 1
+
+
+def test_minconn_is_opened_up_front():
+    db = FakeDB()
+    pool = make_pool(db, minconn=2, maxconn=3)
+    assert len(db.connections) == 2
+    assert pool.stats()["idle"] == 2
+
+
+def test_checkout_times_out_when_exhausted():
+    pool = make_pool(FakeDB(), maxconn=1, timeout=0.05)
+    held = pool.acquire()
+    with pytest.raises(workflow_db.DBPoolTimeout):
+        pool.acquire()
+    held.close()
+    assert pool.stats()["timeouts"] == 1
+
+
+def test_waiter_gets_connection_released_by_another_thread():
+    pool = make_pool(FakeDB(), maxconn=1, timeout=2)
+    held = pool.acquire()
+    threading.Timer(0.05, held.close).start()
+    conn = pool.acquire()
+    conn.close()
+    stats = pool.stats()
+    assert stats["waits"] == 1
+    assert stats["size"] == 1
+
+
+def test_broken_connection_is_discarded(fake_psycopg2):
+    db = FakeDB()
+    pool = make_pool(db)
+    with pytest.raises(fake_psycopg2.OperationalError):
+        with pool.connection():
+            raise fake_psycopg2.OperationalError("server closed the connection")
+    assert pool.stats()["discarded"] == 1
+    assert pool.stats()["size"] == 0
+
+    with pool.connection():
+        pass
+    assert len(db.connections) == 2
+
+
+def test_idle_connection_is_health_checked_on_every_checkout(fake_psycopg2):
+    db = FakeDB()
+    pool = make_pool(db)
+    pool.acquire().close()
+    assert db.statements("SELECT 1") == []  # a new connection is not pinged
+
+    pool.acquire().close()
+    assert len(db.statements("SELECT 1")) == 1
+
+    def server_gone(sql, params):
+        raise fake_psycopg2.OperationalError("server closed the connection unexpectedly")
+
+    # Returned a moment ago, dropped by the server since: conn.closed does not show it yet
+    db.handler = server_gone
+    conn = pool.acquire()
+    assert conn._conn is db.connections[1]
+    assert pool.stats()["health_check_failures"] == 1
+
+
+def test_with_block_yields_the_pooled_wrapper():
+    db = FakeDB()
+    pool = make_pool(db)
+    conn = pool.acquire()
+    with conn as entered:
+        assert entered is conn
+    conn.close()
+    assert pool.stats()["idle"] == 1
+
+
+def test_closed_pool_refuses_checkout(fake_psycopg2):
+    pool = make_pool(FakeDB())
+    pool.close()
+    with pytest.raises(fake_psycopg2.InterfaceError):
+        pool.acquire()
+
+
+def test_get_db_connection_uses_configured_pool(fake_db):
+    conn = workflow_db.get_db_connection()
+    conn.cursor().execute("SELECT 1")
+    conn.close()
+    assert fake_db.statements("SELECT 1")
+    assert workflow_db.get_db_pool_stats()["idle"] == 1
@@ -0,0 +1,147 @@
+import socket
+import time
+
+import pytest
+
+import workflow
+
+TIERS = [
+    {"min_amount": 0, "max_amount": 5000, "level_name": "L1", "approver_name": "Lee", "approver_email": "l1@corp.test"},
+    {"min_amount": 4000, "max_amount": 20000, "level_name": "L2", "approver_name": "Sam", "approver_email": "l2@corp.test"},
+    {"min_amount": 50000, "max_amount": 90000, "level_name": "L3", "approver_name": "Kim", "approver_email": "l3@corp.test"},
+]
+
+
+def between_query(amount):
+    """
+    What `amount BETWEEN min_amount AND max_amount ORDER BY min_amount LIMIT 1` returns
+    """
+    for tier in sorted(TIERS, key=lambda tier: tier["min_amount"]):
+        if tier["min_amount"] <= amount <= tier["max_amount"]:
+            return {key: tier[key] for key in ("level_name", "approver_name", "approver_email")}
+    return None
+
+
+@pytest.fixture
+def hierarchy(fake_db):
+    fake_db.rows = [dict(tier) for tier in TIERS]
+
+    def handler(sql, params):
+        if 'FROM "DocAI".approval_hierarchy' in sql:
+            return [dict(row) for row in fake_db.rows]
+        return []
+
+    fake_db.handler = handler
+    fake_db.loads = lambda: len(fake_db.statements('FROM "DocAI".approval_hierarchy'))
+    return fake_db
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+@pytest.mark.parametrize("amount", [-1, 0, 3999.99, 4000, 5000, 5000.01, 20000, 20000.01, 49999, 50000, 90000, 90001])
+def test_lookup_matches_the_between_query(hierarchy, amount):
+    snapshot = workflow.ApprovalHierarchySnapshot()
+    assert snapshot.lookup(amount) == between_query(amount)
+
+
+def test_lookups_are_served_from_the_snapshot(hierarchy):
+    snapshot = workflow.ApprovalHierarchySnapshot()
+    for amount in range(0, 100000, 250):
+        snapshot.lookup(amount)
+    assert hierarchy.loads() == 1
+    assert snapshot.next_tier("L1")["level_name"] == "L2"
+    assert snapshot.next_tier("L3") is None
+    assert hierarchy.loads() == 1
+
+
+def test_invalidate_and_ttl_reload(hierarchy, monkeypatch):
+    snapshot = workflow.ApprovalHierarchySnapshot(ttl=60)
+    assert snapshot.lookup(100)["level_name"] == "L1"
+
+    hierarchy.rows[0]["approver_email"] = "new-l1@corp.test"
+    assert snapshot.lookup(100)["approver_email"] == "l1@corp.test"
+    snapshot.invalidate()
+    assert snapshot.lookup(100)["approver_email"] == "new-l1@corp.test"
+    assert hierarchy.loads() == 2
+
+    now = time.monotonic()
+    monkeypatch.setattr(workflow.time, "monotonic", lambda: now + 61)
+    snapshot.lookup(100)
+    assert hierarchy.loads() == 3
+
+
+def test_failed_refresh_keeps_the_previous_snapshot(hierarchy):
+    snapshot = workflow.ApprovalHierarchySnapshot()
+    snapshot.lookup(100)
+
+    def down(sql, params):
+        raise RuntimeError("database unavailable")
+
+    hierarchy.handler = down
+    snapshot.invalidate()
+    assert snapshot.lookup(100)["level_name"] == "L1"
+    with pytest.raises(RuntimeError):
+        workflow.ApprovalHierarchySnapshot().lookup(100)
+
+
+class ListeningConnection:
+    """
+    Raw connection for the listener: select() waits on a socket, notify() plays a NOTIFY
+    """
+
+    def __init__(self):
+        self._reader, self._writer = socket.socketpair()
+        self.autocommit = False
+        self.notifies = []
+        self.executed = []
+
+    def fileno(self):
+        return self._reader.fileno()
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql):
+        self.executed.append(sql)
+
+    def poll(self):
+        self.notifies.extend(self._reader.recv(64))
+
+    def notify(self):
+        self._writer.send(b"!")
+
+    def close(self):
+        self._reader.close()
+        self._writer.close()
+
+
+def test_notify_invalidates_the_snapshot(hierarchy, monkeypatch):
+    conn = ListeningConnection()
+    monkeypatch.setattr(workflow, "_create_raw_db_connection", lambda: conn)
+    snapshot = workflow.ApprovalHierarchySnapshot()
+    invalidations = []
+    invalidate = snapshot.invalidate
+    monkeypatch.setattr(snapshot, "invalidate", lambda: invalidations.append(1) or invalidate())
+    listener = workflow._ApprovalHierarchyListener(snapshot, poll_interval=0.05)
+    listener.start()
+    try:
+        # Subscribing invalidates once: changes may have happened while nobody listened
+        assert wait_for(lambda: invalidations == [1])
+        assert conn.executed == [f"LISTEN {workflow.APPROVAL_HIERARCHY_CHANNEL}"]
+        assert conn.autocommit is True
+        snapshot.lookup(100)
+        assert not snapshot._needs_refresh()
+
+        conn.notify()
+        assert wait_for(lambda: invalidations == [1, 1])
+        snapshot.lookup(100)
+        assert hierarchy.loads() == 2
+    finally:
+        listener.stop()
+        listener.join(5)
+    assert not listener.is_alive()
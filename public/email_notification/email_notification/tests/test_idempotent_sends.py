@@ -0,0 +1,219 @@
+import itertools
+import smtplib
+
+import pytest
+
+import workflow
+import workflow_outbox
+
+CHANGES = {"notes": "Amount corrected"}
+
+
+def send(audit_id, email="approver@example.com"):
+    return workflow.send_approval_email("INV-1", 1250.0, email, "Asha", audit_id, changes=CHANGES)
+
+
+@pytest.fixture
+def send_log(fake_db):
+    """
+    Fake DB that keeps email_send_log rows and hands out audit/outbox ids
+    """
+    rows = {}
+    ids = itertools.count(100)
+
+    def handler(sql, params):
+        if 'INSERT INTO "DocAI".email_send_log' in sql and "VALUES %s" in sql:
+            for send_key, *_ in params:
+                rows[send_key] = "sent"
+            return []
+        if 'INSERT INTO "DocAI".email_send_log' in sql:
+            if params[0] in rows:
+                return []
+            rows[params[0]] = "sending"
+            return [(params[0],)]
+        if 'UPDATE "DocAI".email_send_log' in sql:
+            rows[params[0]] = "sent"
+        if 'DELETE FROM "DocAI".email_send_log' in sql:
+            rows.pop(params[0], None)
+        if "INSERT INTO \"DocAI\".workflow_audit_log" in sql:
+            return [(next(ids),) for _ in params]
+        if "INSERT INTO \"DocAI\".email_outbox" in sql:
+            return [(next(ids),)]
+        return []
+
+    fake_db.handler = handler
+    fake_db.rows = rows
+    yield fake_db
+    workflow.flush_send_log()
+
+
+def send_log_statements(db):
+    return db.statements("email_send_log")
+
+
+def test_first_send_costs_no_query(send_log, fake_smtp):
+    assert send(5) is True
+    assert send_log_statements(send_log) == []
+    assert len(fake_smtp.messages) == 1
+
+    workflow.flush_send_log()
+    assert send_log.rows == {"5:approval_request:approver@example.com": "sent"}
+
+
+def test_duplicate_is_answered_from_memory(send_log, fake_smtp):
+    send(5)
+    assert send(5, "Approver@Example.com ") is True
+    assert len(fake_smtp.messages) == 1
+    assert send_log_statements(send_log) == []
+
+
+def test_failed_send_releases_key(send_log, fake_smtp, monkeypatch):
+    monkeypatch.setenv("SMTP_PASSWORD", "")
+    assert send(6) is False
+    monkeypatch.setenv("SMTP_PASSWORD", "secret")
+    assert send(6) is True
+    assert len(fake_smtp.messages) == 1
+
+
+def test_send_log_writes_are_batched(send_log, fake_smtp):
+    for audit_id in range(1, 6):
+        send(audit_id)
+    workflow.flush_send_log()
+    assert len(send_log_statements(send_log)) == 1
+    assert len(send_log.rows) == 5
+
+
+def test_strict_mode_claims_in_the_log(send_log, fake_smtp, monkeypatch):
+    monkeypatch.setenv("WORKFLOW_EMAIL_IDEMPOTENCY", "strict")
+    send_log.rows["7:approval_request:approver@example.com"] = "sent"  # sent by another process
+    assert send(7) is True
+    assert fake_smtp.messages == []
+
+    assert send(8) is True
+    assert send_log.rows["8:approval_request:approver@example.com"] == "sent"
+    assert len(fake_smtp.messages) == 1
+
+
+def test_outbox_fanout_uses_send_keys(send_log, fake_smtp, monkeypatch):
+    monkeypatch.setenv("WORKFLOW_EMAIL_MODE", "outbox")
+    result = workflow.send_approval_fanout("INV-2", 100, 200, [("A", "a@example.com"), ("B", "b@example.com")],
+                                           changes=CHANGES)
+    assert [entry["email_ok"] for entry in result] == [True, True]
+    audit_id = result[0]["audit_id"]
+
+    monkeypatch.setenv("WORKFLOW_EMAIL_MODE", "direct")
+    assert workflow.send_approval_email("INV-2", 200, "a@example.com", "A", audit_id, changes=CHANGES) is True
+    assert fake_smtp.messages == []
+
+    workflow.flush_send_log()
+    assert sorted(send_log.rows) == [f"{entry['audit_id']}:approval_request:{entry['approver_email']}"
+                                     for entry in result]
+
+
+def test_direct_fanout_releases_failed_keys(send_log, fake_smtp, monkeypatch):
+    monkeypatch.setattr(workflow, "send_email_messages_batch", lambda messages, **kwargs: [True, False])
+    result = workflow.send_approval_fanout("INV-3", 100, 200, [("A", "a@example.com"), ("B", "b@example.com")],
+                                           changes=CHANGES)
+    first, second = result
+    assert workflow._sent_keys.get(f"{first['audit_id']}:approval_request:a@example.com") is True
+    assert workflow._sent_keys.get(f"{second['audit_id']}:approval_request:b@example.com") is None
+
+
+def test_disabled_idempotency_always_sends(send_log, fake_smtp, monkeypatch):
+    monkeypatch.setenv("WORKFLOW_EMAIL_IDEMPOTENCY", "0")
+    send(9)
+    send(9)
+    assert len(fake_smtp.messages) == 2
+
+
+@pytest.fixture
+def digest_mode(monkeypatch):
+    monkeypatch.setenv("WORKFLOW_APPROVAL_DIGEST", "1")
+    monkeypatch.setenv("WORKFLOW_DIGEST_WINDOW_SECONDS", "3600")
+    yield
+    workflow.flush_approval_digests()
+
+
+def test_digest_entry_is_marked_sent_after_delivery(send_log, fake_smtp, digest_mode):
+    send_key = "10:approval_request:approver@example.com"
+    assert send(10) is True
+    assert fake_smtp.messages == []
+    assert workflow._sent_keys.get(send_key) is not True  # claimed, not sent
+    assert send(10) is True  # an in-flight duplicate is not queued twice
+
+    workflow.flush_approval_digests()
+    assert len(fake_smtp.messages) == 1
+    assert workflow._sent_keys.get(send_key) is True
+    workflow.flush_send_log()
+    assert send_log.rows == {send_key: "sent"}
+
+
+def test_undelivered_digest_releases_keys(send_log, fake_smtp, digest_mode, monkeypatch):
+    monkeypatch.setattr(workflow, "send_email_messages_batch", lambda messages, **kwargs: [False] * len(messages))
+    assert send(11) is True
+
+    workflow.flush_approval_digests()
+    assert workflow._sent_keys.get("11:approval_request:approver@example.com") is None
+    workflow.flush_send_log()
+    assert send_log.rows == {}
+
+
+@pytest.fixture
+def deferred_queue(monkeypatch):
+    queue = workflow_outbox.DeferredSendQueue()
+    monkeypatch.setattr(workflow_outbox, "_deferred_sends", queue)
+    yield queue
+    queue.stop(spill=False)
+
+
+def throttle_next_send(fake_smtp, monkeypatch):
+    monkeypatch.setattr(fake_smtp, "fail_with", [smtplib.SMTPDataError(421, b"try again later")], raising=False)
+    original = fake_smtp.__init__
+
+    def init(self, *args, **kwargs):
+        original(self, *args, **kwargs)
+        self.fail_with = list(fake_smtp.fail_with)
+        fake_smtp.fail_with = []
+
+    monkeypatch.setattr(fake_smtp, "__init__", init)
+
+
+def retry_deferred(queue):
+    with queue._cond:
+        due, queue._heap = queue._heap, []
+    queue._send(workflow._get_smtp_config(), due)
+
+
+def test_deferred_send_is_marked_sent_only_after_delivery(send_log, fake_smtp, deferred_queue, monkeypatch):
+    send_key = "12:approval_request:approver@example.com"
+    throttle_next_send(fake_smtp, monkeypatch)
+    assert send(12) == workflow.EMAIL_QUEUED
+    assert fake_smtp.messages == []
+    assert workflow._sent_keys.get(send_key) is not True  # claimed, not sent
+    assert send(12) is True  # the deferred message is not queued twice
+
+    retry_deferred(deferred_queue)
+    assert len(fake_smtp.messages) == 1
+    assert workflow._sent_keys.get(send_key) is True
+
+
+def test_failed_deferred_send_releases_key(send_log, fake_smtp, deferred_queue, monkeypatch):
+    throttle_next_send(fake_smtp, monkeypatch)
+    assert send(13) == workflow.EMAIL_QUEUED
+    recipient_refused = smtplib.SMTPRecipientsRefused({"approver@example.com": (550, b"no such user")})
+    monkeypatch.setattr(workflow_outbox.get_smtp_pool(), "send_batch",
+                        lambda config, messages, background=False: [(False, recipient_refused)] * len(messages))
+    monkeypatch.setattr(workflow_outbox, "enqueue_email", lambda *args, **kwargs: None)
+
+    retry_deferred(deferred_queue)
+    assert workflow._sent_keys.get("13:approval_request:approver@example.com") is None
+
+
+def test_fanout_skips_recipients_already_sent(send_log, fake_smtp, monkeypatch):
+    monkeypatch.setenv("WORKFLOW_EMAIL_IDEMPOTENCY", "strict")
+    send_log.rows["100:approval_request:a@example.com"] = "sent"  # sent by another process
+    result = workflow.send_approval_fanout("INV-4", 100, 200, [("A", "a@example.com"), ("B", "b@example.com")],
+                                           changes=CHANGES)
+
+    assert [entry["email_ok"] for entry in result] == [True, True]
+    assert [msg["To"] for msg in fake_smtp.messages] == ["b@example.com"]
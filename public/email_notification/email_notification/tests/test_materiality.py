@@ -0,0 +1,79 @@
+import pytest
+
+import workflow
+
+
+@pytest.fixture
+def policy():
+    yield workflow.configure_materiality({"abs": 100, "pct": 1.0, "fields": {"unit_price": {"pct": 0.5}}})
+    workflow.configure_materiality({})
+
+
+@pytest.fixture
+def no_lookups(monkeypatch):
+    """
+    Materiality is decided in-process: any pending-changes lookup fails the test
+    """
+    def lookup(*args, **kwargs):
+        pytest.fail("materiality must not read pending changes")
+
+    monkeypatch.setattr(workflow, "get_pending_changes_for_email", lookup)
+    monkeypatch.setattr(workflow, "get_pending_changes_for_emails", lookup)
+
+
+def test_unconfigured_policy_triggers_without_lookups(no_lookups):
+    assert workflow.should_trigger_workflow(10, "INV-1") is True
+    assert workflow.should_trigger_workflow(None, "INV-1") is False
+
+
+def test_prior_amount_comes_from_the_amount_diff(policy, no_lookups):
+    assert workflow.should_trigger_workflow(
+        10020, "INV-1", changes={"header_changes": {"invoice_amount": "10,000.00 → 10,020.00"}}) is False
+    assert workflow.should_trigger_workflow(
+        12000, "INV-2", changes={"header_changes": {"invoice_amount": "10,000.00 → 12,000.00"}}) is True
+
+
+def test_field_rules_apply(policy, no_lookups):
+    changes = {"header_changes": {"invoice_amount": "1000 → 1000"}, "line_changes": {1: {"unit_price": "100 → 101"}}}
+    assert workflow.should_trigger_workflow(1000, "INV-3", changes=changes) is True
+
+
+def test_without_any_prior_amount_the_workflow_still_triggers(policy, no_lookups):
+    assert workflow.should_trigger_workflow(1000, "INV-4") is True
+
+
+def test_immaterial_change_is_skipped(policy, no_lookups):
+    assert workflow.should_trigger_workflow(1000, "INV-5", original_amount=1000, changes={}) is False
+    assert workflow.should_trigger_workflow(1000.01, "INV-5", original_amount=1000) is False
+
+
+def test_unevaluable_change_fails_open(policy, no_lookups):
+    assert workflow.should_trigger_workflow("n/a", "INV-6", original_amount=1000) is True
+    assert workflow.should_trigger_workflow_batch([{"invoice_number": "INV-6", "changed_amount": "n/a",
+                                                    "original_amount": 1000}]) == [True]
+
+
+def test_amount_rule_applies_with_only_field_rules(no_lookups):
+    workflow.configure_materiality({"fields": {"unit_price": "ignore"}})
+    try:
+        assert workflow.should_trigger_workflow(1200, "INV-7", original_amount=1000, changes={}) is True
+        assert workflow.should_trigger_workflow(1000, "INV-7", original_amount=1000,
+                                                changes={"line_changes": {1: {"unit_price": "1 → 2"}}}) is False
+    finally:
+        workflow.configure_materiality({})
+
+
+def test_batch_matches_single_calls(policy, no_lookups):
+    items = [
+        {"invoice_number": "A", "changed_amount": 501, "changes": {"header_changes": {"invoice_amount": "500 → 501"}}},
+        {"invoice_number": "B", "changed_amount": 900, "original_amount": 500},
+        {"invoice_number": "C", "changed_amount": 5, "original_amount": 5, "changes": {}},
+        {"invoice_number": "D"},
+    ]
+    decisions = workflow.should_trigger_workflow_batch(items)
+    assert decisions == [False, True, False, False]
+    assert decisions == [
+        workflow.should_trigger_workflow(item.get("changed_amount"), item["invoice_number"], item.get("original_amount"),
+                                         changes=item.get("changes"))
+        for item in items
+    ]
@@ -0,0 +1,57 @@
+import os
+import subprocess
+import sys
+
+import workflow
+import workflow_db
+import workflow_outbox
+import workflow_smtp
+
+
+MODULE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_subsystems_are_reexported():
+    assert workflow.get_db_pool is workflow_db.get_db_pool
+    assert workflow.SMTPSessionPool is workflow_smtp.SMTPSessionPool
+    assert workflow.enqueue_email is workflow_outbox.enqueue_email
+    for module in (workflow_db, workflow_smtp, workflow_outbox):
+        assert set(module.__all__) <= set(dir(workflow))
+    # Parts are built through private factories; the stdlib class names are not shadowed
+    assert not {"MIMEText", "MIMEMultipart", "MIMEBase"} & set(dir(workflow))
+
+
+def test_import_has_no_side_effects():
+    code = (
+        "import sys, threading, workflow\n"
+        "assert threading.active_count() == 1, threading.enumerate()\n"
+        "assert workflow.get_tracer() is None\n"
+        "assert 'psycopg2' not in sys.modules and 'smtplib' not in sys.modules\n"
+    )
+    env = dict(os.environ, WORKFLOW_TRACE="1", WORKFLOW_PREWARM="1")
+    result = subprocess.run([sys.executable, "-c", code], cwd=MODULE_DIR, env=env,
+                            capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+
+
+def test_configure_from_env_turns_tracing_on(monkeypatch):
+    monkeypatch.setenv("WORKFLOW_TRACE", "1")
+    monkeypatch.delenv("WORKFLOW_PREWARM", raising=False)
+    try:
+        workflow.configure_from_env()
+        assert workflow.get_tracer() is not None
+    finally:
+        workflow.configure_tracing(False)
+
+
+def test_ensure_workflow_schema_runs_every_step(fake_db):
+    assert workflow.ensure_workflow_schema() == []
+    ddl = [sql for sql, _ in fake_db.log if "CREATE" in sql or "ALTER" in sql]
+    assert any("approval_rules" in sql for sql in ddl)
+    assert any("email_send_log" in sql for sql in ddl)
+    assert any("email_outbox" in sql for sql in ddl)
+
+
+def test_shutdown_is_repeatable():
+    workflow.shutdown_workflow()
+    workflow.shutdown_workflow()
@@ -0,0 +1,90 @@
+import time
+
+import pytest
+
+import workflow
+
+
+def plain_text(msg):
+    return "".join(part.get_payload(decode=True).decode() for part in msg.walk() if part.get_content_type() == "text/plain")
+
+
+@pytest.fixture
+def coalescer(fake_smtp):
+    coalescer = workflow.NotificationCoalescer(window_seconds=3600, max_pending=3, max_retries=1)
+    yield coalescer
+    coalescer.close()
+
+
+def test_updates_in_the_window_collapse_into_one_email(coalescer, fake_smtp):
+    assert coalescer.add("INV-1", "request_edit", "Fix the PO", "req@corp.test") == workflow.EMAIL_QUEUED
+    assert coalescer.add("INV-2", "approve", None, "req@corp.test") == workflow.EMAIL_QUEUED
+    assert coalescer.add("INV-1", "approve", "Thanks", "req@corp.test") == workflow.NOTIFICATION_MERGED
+    assert fake_smtp.messages == []
+    assert coalescer.pending() == {"req@corp.test": 2}
+
+    coalescer.flush()
+    msg, = fake_smtp.messages
+    text = plain_text(msg)
+    assert "INV-1" in text and "INV-2" in text
+    assert "Earlier: ✏️ EDIT REQUESTED" in text
+    assert coalescer.stats()["superseded"] == 1
+    assert coalescer.stats()["emails"] == 1
+
+
+def test_window_end_sends_without_a_flush(fake_smtp):
+    coalescer = workflow.NotificationCoalescer(window_seconds=0.05)
+    try:
+        coalescer.add("INV-1", "approve", None, "a@corp.test")
+        coalescer.add("INV-2", "reject", None, "b@corp.test")
+        deadline = time.monotonic() + 5
+        while len(fake_smtp.messages) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert sorted(msg["To"] for msg in fake_smtp.messages) == ["a@corp.test", "b@corp.test"]
+        assert coalescer.pending() == {}
+    finally:
+        coalescer.close()
+
+
+def test_full_buffer_sends_the_oldest_recipient_early(coalescer, fake_smtp):
+    coalescer.add("INV-1", "approve", None, "first@corp.test")
+    coalescer.add("INV-2", "approve", None, "second@corp.test")
+    coalescer.add("INV-3", "approve", None, "second@corp.test")
+    coalescer.add("INV-4", "approve", None, "third@corp.test")
+
+    assert [msg["To"] for msg in fake_smtp.messages] == ["first@corp.test"]
+    assert coalescer.stats()["forced"] == 1
+
+
+def test_closed_coalescer_rejects_and_the_update_is_sent_directly(fake_smtp, monkeypatch):
+    monkeypatch.setenv("WORKFLOW_NOTIFICATION_COALESCE", "1")
+    coalescer = workflow.NotificationCoalescer()
+    coalescer.close()
+    monkeypatch.setattr(workflow, "get_notification_coalescer", lambda: coalescer)
+
+    assert coalescer.add("INV-1", "approve", None, "req@corp.test") is False
+    assert workflow.send_action_notification_email("INV-1", "approve", None, "req@corp.test") is True
+    assert [msg["To"] for msg in fake_smtp.messages] == ["req@corp.test"]
+
+
+def test_failed_send_at_shutdown_moves_updates_to_the_outbox(coalescer, fake_smtp, monkeypatch):
+    spilled = []
+    monkeypatch.setattr(workflow, "send_email_messages_batch", lambda messages, *args: [False] * len(messages))
+    monkeypatch.setattr(workflow, "email_outbox_available", lambda: True)
+    monkeypatch.setattr(workflow, "enqueue_email", lambda msg, kind: spilled.append((msg["To"], kind)) or 1)
+    coalescer.add("INV-1", "approve", None, "req@corp.test")
+    coalescer.add("INV-2", "reject", None, "req@corp.test")
+
+    coalescer.close()
+    assert spilled == [("req@corp.test", "action_notification")]
+    assert coalescer.stats()["spilled"] == 2
+    assert coalescer.stats()["dropped"] == 0
+
+
+def test_without_an_outbox_dropped_updates_are_counted(coalescer, fake_smtp, monkeypatch):
+    monkeypatch.setattr(workflow, "send_email_messages_batch", lambda messages, *args: [False] * len(messages))
+    monkeypatch.setattr(workflow, "email_outbox_available", lambda: False)
+    coalescer.add("INV-1", "approve", None, "req@corp.test")
+
+    coalescer.close()
+    assert coalescer.stats()["dropped"] == 1
@@ -0,0 +1,148 @@
+import itertools
+import smtplib
+import time
+from email.message import EmailMessage
+
+import pytest
+
+import workflow
+import workflow_outbox
+
+HIERARCHY = [
+    {"min_amount": 0, "max_amount": 5000, "level_name": "L1", "approver_name": "Lee", "approver_email": "l1@corp.test"},
+    {"min_amount": 5000.01, "max_amount": 10 ** 9, "level_name": "L3", "approver_name": "Kim", "approver_email": "l3@corp.test"},
+]
+
+
+def make_message(to):
+    msg = EmailMessage()
+    msg["To"] = to
+    msg["Subject"] = "Invoice"
+    msg.set_content("body")
+    return msg
+
+
+@pytest.fixture
+def outbox(fake_db, fake_smtp):
+    """
+    Fake DB holding email_outbox rows {id: {"payload", "status", "attempts", "last_error"}}
+    plus the audit and routing tables start_approval_workflow needs
+    """
+    rows = {}
+    ids = itertools.count(1)
+    audit_ids = itertools.count(100)
+
+    def handler(sql, params):
+        if 'INSERT INTO "DocAI".email_outbox' in sql:
+            outbox_id = next(ids)
+            rows[outbox_id] = {"recipient": params[2], "payload": params[3], "status": params[4],
+                               "attempts": 0, "last_error": params[5]}
+            return [(outbox_id,)]
+        if "RETURNING id, payload" in sql:
+            lease, batch_size = params
+            claimed = [outbox_id for outbox_id, row in rows.items() if row["status"] == "pending"][:batch_size]
+            for outbox_id in claimed:
+                rows[outbox_id]["status"] = "sending"
+            return [(outbox_id, rows[outbox_id]["payload"]) for outbox_id in claimed]
+        if "SET status = 'sent'" in sql:
+            for outbox_id in params[0]:
+                rows[outbox_id]["status"] = "sent"
+        if "SET attempts = attempts + 1" in sql:
+            max_attempts, _, _, error, outbox_id = params
+            row = rows[outbox_id]
+            row["attempts"] += 1
+            row["status"] = "dead" if row["attempts"] >= max_attempts else "pending"
+            row["last_error"] = error
+            return [(row["status"],)]
+        if "SET status = 'pending'" in sql:
+            rows[params[2]].update(status="pending", last_error=params[1])
+        if 'INSERT INTO "DocAI".workflow_audit_log' in sql:
+            return [(next(audit_ids),) for _ in params]
+        if 'FROM "DocAI".approval_hierarchy' in sql:
+            return [dict(row) for row in HIERARCHY]
+        return []
+
+    fake_db.handler = handler
+    fake_db.rows = rows
+    workflow.invalidate_approval_hierarchy()
+    yield fake_db
+    workflow.stop_email_outbox_worker()
+    workflow.flush_approval_digests()
+    workflow.flush_send_log()
+    workflow.invalidate_approval_hierarchy()
+
+
+def test_claim_delivers_and_marks_sent(outbox, fake_smtp):
+    for to in ("a@corp.test", "b@corp.test", "c@corp.test"):
+        workflow.enqueue_email(make_message(to), "approval_request")
+    worker = workflow.EmailOutboxWorker(num_workers=0, batch_size=2)
+
+    assert worker.run_once() == 2
+    assert [row["status"] for row in outbox.rows.values()] == ["sent", "sent", "pending"]
+    assert worker.run_once() == 1
+    assert worker.run_once() == 0
+    assert [msg["To"] for msg in fake_smtp.messages] == ["a@corp.test", "b@corp.test", "c@corp.test"]
+    assert worker.counters()["sent"] == 3
+
+
+def test_failed_delivery_is_retried_then_dead_lettered(outbox, fake_smtp, monkeypatch):
+    workflow.enqueue_email(make_message("gone@corp.test"), "approval_request")
+    refused = smtplib.SMTPRecipientsRefused({"gone@corp.test": (550, b"no such user")})
+    monkeypatch.setattr(workflow_outbox.get_smtp_pool(), "send_batch",
+                        lambda config, messages, background=False: [(False, refused)] * len(messages))
+    worker = workflow.EmailOutboxWorker(num_workers=0, max_attempts=2)
+
+    worker.run_once()
+    assert outbox.rows[1]["status"] == "pending"
+    assert outbox.rows[1]["attempts"] == 1
+    worker.run_once()
+    assert outbox.rows[1]["status"] == "dead"
+    assert "no such user" in outbox.rows[1]["last_error"]
+    assert worker.counters() == {"sent": 0, "retried": 1, "dead": 1, "deferred": 0}
+
+
+def test_throttled_delivery_does_not_use_an_attempt(outbox, fake_smtp, monkeypatch):
+    workflow.enqueue_email(make_message("a@corp.test"), "approval_request")
+    throttled = workflow.SMTPThrottled("SMTP 421", 60, 421)
+    monkeypatch.setattr(workflow_outbox.get_smtp_pool(), "send_batch",
+                        lambda config, messages, background=False: [(False, throttled)] * len(messages))
+    worker = workflow.EmailOutboxWorker(num_workers=0)
+
+    worker.run_once()
+    assert outbox.rows[1]["status"] == "pending"
+    assert outbox.rows[1]["attempts"] == 0
+    assert worker.counters()["deferred"] == 1
+
+
+def test_configure_from_env_starts_the_worker_pool(outbox, fake_smtp, monkeypatch):
+    monkeypatch.setenv("WORKFLOW_EMAIL_MODE", "outbox")
+    monkeypatch.setenv("WORKFLOW_OUTBOX_WORKERS", "1")
+    monkeypatch.setenv("WORKFLOW_OUTBOX_POLL_INTERVAL", "0.01")
+    monkeypatch.delenv("WORKFLOW_TRACE", raising=False)
+    monkeypatch.delenv("WORKFLOW_PREWARM", raising=False)
+    workflow.enqueue_email(make_message("a@corp.test"), "approval_request")
+
+    workflow.configure_from_env()
+    deadline = time.monotonic() + 5
+    while outbox.rows[1]["status"] != "sent" and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert outbox.rows[1]["status"] == "sent"
+    assert [msg["To"] for msg in fake_smtp.messages] == ["a@corp.test"]
+
+
+def test_outbox_mode_still_routes_through_the_digest(outbox, fake_smtp, monkeypatch):
+    monkeypatch.setenv("WORKFLOW_EMAIL_MODE", "outbox")
+    monkeypatch.setenv("WORKFLOW_APPROVAL_DIGEST", "1")
+    monkeypatch.setenv("WORKFLOW_DIGEST_WINDOW_SECONDS", "3600")
+    changes = {"notes": "Amount corrected"}
+
+    routine = workflow.start_approval_workflow("INV-1", 100, 120, changes=changes)
+    urgent = workflow.start_approval_workflow("INV-2", 9000, 9500, changes=changes)
+    assert routine["email_ok"] and urgent["email_ok"]
+    # The urgent tier is queued at once, with its audit row; the routine request waits in the digest
+    assert [row["recipient"] for row in outbox.rows.values()] == ["l3@corp.test"]
+    assert workflow.get_approval_digest().pending() == {"l1@corp.test": 1}
+
+    workflow.flush_approval_digests()
+    assert [row["recipient"] for row in outbox.rows.values()] == ["l3@corp.test", "l1@corp.test"]
+    assert fake_smtp.messages == []
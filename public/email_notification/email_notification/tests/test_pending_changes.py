@@ -0,0 +1,139 @@
+import json
+
+import pytest
+
+import workflow
+import workflow_core
+
+HEADER_ROWS = [
+    ("INV-1", "supplier_name", "Acme", "Acme Ltd"),
+    ("INV-1", "currency", "INR", "INR"),  # edited back to the original value
+    ("INV-2", "invoice_amount", 100, 120),
+]
+LINE_ROWS = [
+    ("INV-1", 1, "quantity", 2, 3),
+    ("INV-1", 1, "unit_price", None, 10),
+    ("INV-2", 4, "description", "Bolt", "Bolts"),
+]
+SCHEMA = {
+    "header_table": "DocAI.invoice_header_history", "line_table": "DocAI.invoice_line_history",
+    "invoice_column": "invoice_number", "line_column": "line_number", "field_column": "field_name",
+    "old_column": "old_value", "new_column": "new_value", "order_column": "changed_at",
+    "status_column": "status", "pending_statuses": ["draft", "pending"], "id_column": "id",
+}
+
+
+@pytest.fixture(autouse=True)
+def fresh_cache(monkeypatch):
+    workflow.invalidate_pending_changes()
+    monkeypatch.setattr(workflow, "_history_batch_available", True)
+    monkeypatch.setattr(workflow, "_history_schema", {"schema": None, "loaded": False})
+    monkeypatch.setenv("WORKFLOW_HISTORY_SCHEMA", json.dumps(SCHEMA))
+    yield
+    workflow.invalidate_pending_changes()
+
+
+@pytest.fixture
+def history(fake_db, monkeypatch):
+    def handler(sql, params):
+        if "invoice_header_history" in sql:
+            return [row for row in HEADER_ROWS if row[0] in params[0]]
+        if "invoice_line_history" in sql:
+            return [row for row in LINE_ROWS if row[0] in params[0]]
+        return []
+
+    fake_db.handler = handler
+    single_calls = []
+    monkeypatch.setitem(workflow_core._unifycode_attrs, "get_pending_changes_from_history",
+                        lambda invoice_number: single_calls.append(invoice_number) or {})
+    fake_db.single_calls = single_calls
+    return fake_db
+
+
+def history_queries(db):
+    return [params for sql, params in db.log if "_history" in sql]
+
+
+def test_batch_uses_two_queries_for_any_number_of_invoices(history):
+    result = workflow.get_pending_changes_for_emails(["INV-1", "INV-2", "INV-3", "INV-1"])
+
+    assert result == {
+        "INV-1": {"header_changes": {"supplier_name": "Acme → Acme Ltd"},
+                  "line_changes": {1: {"quantity": "2 → 3", "unit_price": " → 10"}}},
+        "INV-2": {"header_changes": {"invoice_amount": "100 → 120"},
+                  "line_changes": {4: {"description": "Bolt → Bolts"}}},
+        "INV-3": None,
+    }
+    queries = history_queries(history)
+    assert len(queries) == 2
+    assert all(params == (["INV-1", "INV-2", "INV-3"], ["draft", "pending"]) for params in queries)
+    assert history.single_calls == []
+
+
+def test_without_versions_nothing_is_cached(history):
+    workflow.get_pending_changes_for_emails(["INV-1", "INV-2"])
+    workflow.get_pending_changes_for_emails(["INV-1", "INV-2"])
+    assert len(history_queries(history)) == 4
+
+
+def test_versioned_entries_are_reused_until_the_version_changes(history):
+    versions = {"INV-1": "v1", "INV-2": "v1"}
+    workflow.get_pending_changes_for_emails(["INV-1", "INV-2"], versions)
+    workflow.get_pending_changes_for_emails(["INV-1", "INV-2"], versions)
+    assert len(history_queries(history)) == 2
+
+    # Only INV-1 is refetched; a single invoice goes through the per-invoice loader
+    workflow.get_pending_changes_for_emails(["INV-1", "INV-2"], {"INV-1": "v2", "INV-2": "v1"})
+    assert len(history_queries(history)) == 2
+    assert history.single_calls == ["INV-1"]
+
+
+def test_single_lookup_caches_only_with_a_version(history):
+    workflow.get_pending_changes_for_email("INV-9")
+    workflow.get_pending_changes_for_email("INV-9")
+    assert history.single_calls == ["INV-9", "INV-9"]
+
+    workflow.get_pending_changes_for_email("INV-9", version=3)
+    workflow.get_pending_changes_for_email("INV-9", version=3)
+    assert history.single_calls == ["INV-9", "INV-9", "INV-9"]
+
+
+def test_missing_history_tables_fall_back_to_per_invoice_loader(history):
+    class UndefinedTable(Exception):
+        pgcode = "42P01"
+
+    def handler(sql, params):
+        raise UndefinedTable("relation does not exist")
+
+    history.handler = handler
+    result = workflow.get_pending_changes_for_emails(["INV-1", "INV-2"])
+    assert result == {"INV-1": None, "INV-2": None}
+    assert history.single_calls == ["INV-1", "INV-2"]
+    assert workflow._history_batch_available is False
+
+
+def test_batched_reads_are_off_without_a_schema(history, monkeypatch):
+    monkeypatch.delenv("WORKFLOW_HISTORY_SCHEMA")
+    workflow.get_pending_changes_for_emails(["INV-1", "INV-2"])
+    assert history_queries(history) == []
+    assert history.single_calls == ["INV-1", "INV-2"]
+
+
+def test_invalid_schema_falls_back_to_per_invoice_loader(history, monkeypatch):
+    monkeypatch.setenv("WORKFLOW_HISTORY_SCHEMA", json.dumps({"header_table": "h"}))
+    workflow.get_pending_changes_for_emails(["INV-1", "INV-2"])
+    assert history_queries(history) == []
+    assert history.single_calls == ["INV-1", "INV-2"]
+
+
+def test_queries_use_the_configured_names():
+    schema = workflow.configure_history_schema({
+        "header_table": "audit.hdr_changes", "line_table": "audit.line_changes", "invoice_column": "doc_no",
+        "line_column": "line_no", "field_column": "attr", "old_column": "before", "new_column": "after",
+        "order_column": "ts",
+    })
+    sql = " ".join(schema.line_sql.split())
+    assert 'FROM "audit"."line_changes"' in sql
+    assert '(array_agg("before" ORDER BY "ts"))[1] AS old_value' in sql
+    assert 'WHERE "doc_no" = ANY(%s) GROUP BY "doc_no", "line_no", "attr"' in sql
+    assert schema.params == ()
@@ -0,0 +1,171 @@
+import time
+from email.message import EmailMessage
+
+import pytest
+
+import workflow
+import workflow_outbox
+import workflow_smtp
+
+CONFIG = {"server": "smtp.example.com", "port": 587, "user": "ap@example.com", "password": "x",
+          "timeout": 5, "starttls": False}
+
+
+def make_message(to="approver@example.com"):
+    msg = EmailMessage()
+    msg["To"] = to
+    msg["Subject"] = "Invoice"
+    msg.set_content("body")
+    return msg
+
+
+def test_bucket_allows_burst_then_reports_wait():
+    limiter = workflow_smtp.SendRateLimiter(per_minute=60)
+    now = time.monotonic()
+    for _ in range(60):
+        assert limiter.reserve(CONFIG, now) == 0.0
+    assert limiter.reserve(CONFIG, now) == pytest.approx(1.0)
+    # One second at 60/minute refills exactly one token
+    assert limiter.reserve(CONFIG, now + 1.01) == 0.0
+
+
+def test_provider_defaults_apply_per_host():
+    limiter = workflow_smtp.SendRateLimiter()
+    gmail = dict(CONFIG, server="smtp.gmail.com")
+    now = time.monotonic()
+    for _ in range(60):
+        assert limiter.reserve(gmail, now) == 0.0
+    assert limiter.reserve(gmail, now) > 0
+    # Unknown hosts have no limit unless one is configured
+    assert all(limiter.reserve(CONFIG, now) == 0.0 for _ in range(500))
+
+
+def test_provider_bucket_is_shared_between_accounts():
+    limiter = workflow_smtp.SendRateLimiter(per_minute=100, provider_per_minute=3)
+    now = time.monotonic()
+    for user in ("a", "b", "c"):
+        assert limiter.reserve(dict(CONFIG, user=user), now) == 0.0
+    assert limiter.reserve(dict(CONFIG, user="d"), now) > 0
+
+
+def test_throttle_halves_rate_and_doubles_backoff():
+    limiter = workflow_smtp.SendRateLimiter(per_minute=60, base_backoff=10, max_backoff=25)
+    assert limiter.throttled(CONFIG, 452) == 10
+    assert limiter.throttled(CONFIG, 452) == 20
+    assert limiter.throttled(CONFIG, 452) == 25
+    account, _ = limiter._state(CONFIG)
+    assert account.scale == pytest.approx(0.125)
+    assert limiter.delay(CONFIG) > 20
+
+    limiter.success(CONFIG)
+    assert account.strikes == 0
+    assert account.scale == pytest.approx(0.145)
+
+
+def test_acquire_without_wait_budget_never_sleeps(monkeypatch):
+    limiter = workflow_smtp.SendRateLimiter(per_minute=1, max_wait=30)
+    limiter.acquire(CONFIG, max_wait=0)
+    monkeypatch.setattr(workflow_smtp.time, "sleep", lambda seconds: pytest.fail("slept"))
+    with pytest.raises(workflow_smtp.SMTPThrottled) as exc:
+        limiter.acquire(CONFIG, max_wait=0)
+    assert exc.value.code is None
+    assert exc.value.retry_after == pytest.approx(60, abs=1)
+    assert limiter.stats()["refused"] == 1
+
+
+def test_inline_send_is_deferred_instead_of_blocking(monkeypatch, fake_smtp):
+    workflow_smtp.configure_send_rate_limiter(per_minute=1, max_wait=30)
+    monkeypatch.setattr(workflow_smtp.time, "sleep", lambda seconds: pytest.fail("slept"))
+    queued = []
+    monkeypatch.setattr(workflow_outbox._deferred_sends, "add",
+                        lambda msg, retry_after, *args, **kwargs: queued.append(msg["To"]) or True)
+
+    assert workflow.send_email_messages_batch([make_message("a@x"), make_message("b@x")], CONFIG) == [True, True]
+    assert len(fake_smtp.messages) == 1
+    assert queued == ["b@x"]
+
+
+def test_background_send_waits_for_token(monkeypatch, fake_smtp):
+    limiter = workflow_smtp.configure_send_rate_limiter(per_minute=60, max_wait=5)
+    for _ in range(60):
+        limiter.reserve(CONFIG)
+    slept = []
+    monkeypatch.setattr(workflow_smtp.time, "sleep", slept.append)
+    monkeypatch.setattr(limiter, "reserve", lambda config, now=None: 0.0 if slept else 0.5)
+
+    results = workflow_smtp.get_smtp_pool().send_batch(CONFIG, [make_message()], background=True)
+    assert results == [(True, None)]
+    assert slept == [0.5]
+
+
+@pytest.fixture
+def outbox(monkeypatch):
+    """
+    Rows written to a stand-in email_outbox as (recipient, kind, audit_id, status, last_error)
+    """
+    rows = []
+
+    def enqueue(msg, kind, audit_id=None, status="pending", last_error=None):
+        rows.append((msg["To"], kind, audit_id, status, last_error and str(last_error)))
+        return len(rows)
+
+    monkeypatch.setattr(workflow_outbox, "email_outbox_available", lambda: True)
+    monkeypatch.setattr(workflow_outbox, "enqueue_email", enqueue)
+    return rows
+
+
+def test_full_deferred_queue_spills_to_outbox(outbox):
+    queue = workflow_outbox.DeferredSendQueue(max_size=0)
+    assert queue.add(make_message(), 30, message_kind="approval_request", audit_id=5) is True
+    assert outbox == [("approver@example.com", "approval_request", 5, "pending", None)]
+    assert queue.stats()["spilled"] == 1
+    assert len(queue) == 0
+
+
+def test_full_deferred_queue_hands_message_back_when_outbox_fails(monkeypatch):
+    queue = workflow_outbox.DeferredSendQueue(max_size=0)
+    monkeypatch.setattr(workflow_outbox, "enqueue_email", lambda *args, **kwargs: None)
+    assert queue.add(make_message(), 30) is False
+    assert queue.stats()["refused"] == 1
+
+
+def fail_deferred(queue, monkeypatch, error, attempts=0):
+    outcomes = []
+    monkeypatch.setattr(workflow_smtp.get_smtp_pool(), "send_batch",
+                        lambda config, messages, background=False: [(False, error)] * len(messages))
+    item = (0, 0, make_message(), CONFIG, "approval_request", 5, attempts, outcomes.append)
+    queue._send(CONFIG, [item])
+    return outcomes
+
+
+def test_still_throttled_after_last_attempt_goes_to_outbox(outbox, monkeypatch):
+    queue = workflow_outbox.DeferredSendQueue(max_attempts=3)
+    error = workflow_smtp.SMTPThrottled("SMTP 421", 30, 421)
+    assert fail_deferred(queue, monkeypatch, error, attempts=2) == [True]
+    assert outbox == [("approver@example.com", "approval_request", 5, "pending", "SMTP 421")]
+    assert len(queue) == 0
+
+
+def test_permanent_failure_is_dead_lettered(outbox, monkeypatch):
+    queue = workflow_outbox.DeferredSendQueue()
+    error = workflow_smtp.smtplib.SMTPDataError(554, b"message rejected")
+    assert fail_deferred(queue, monkeypatch, error) == [False]  # the key is released
+    assert [row[3] for row in outbox] == ["dead"]
+    assert queue.stats()["dead_lettered"] == 1
+
+
+def test_shutdown_spill_needs_the_outbox_table(monkeypatch):
+    monkeypatch.setattr(workflow_outbox, "email_outbox_available", lambda: False)
+    monkeypatch.setattr(workflow_outbox, "enqueue_email", lambda *args, **kwargs: pytest.fail("no outbox table"))
+    queue = workflow_outbox.DeferredSendQueue()
+    outcomes = []
+    queue.add(make_message(), 3600, on_done=outcomes.append)
+
+    assert queue.stop() == 0
+    assert outcomes == [False]
+    assert queue.stats()["lost"] == 1
+
+
+def test_rate_limiter_is_off_by_default(monkeypatch):
+    monkeypatch.delenv("WORKFLOW_SMTP_RATE_LIMIT")
+    assert workflow_smtp.get_send_rate_limiter() is None
@@ -0,0 +1,137 @@
+import pytest
+
+import workflow
+
+HIERARCHY = [
+    {"min_amount": 0, "max_amount": 5000, "level_name": "L1", "approver_name": "Lee", "approver_email": "l1@corp.test"},
+    {"min_amount": 5000.01, "max_amount": 50000, "level_name": "L2", "approver_name": "Sam", "approver_email": "l2@corp.test"},
+]
+RULES = [
+    {"supplier": "Acme Ltd", "cost_centre": None, "currency": None, "min_amount": 0, "max_amount": 100000,
+     "level_name": "ACME", "approver_name": "Ana", "approver_email": "acme@corp.test"},
+]
+
+
+@pytest.fixture
+def routing(fake_db):
+    def handler(sql, params):
+        if "FROM \"DocAI\".approval_hierarchy" in sql:
+            return [dict(row) for row in HIERARCHY]
+        if "FROM \"DocAI\".approval_rules" in sql:
+            return [dict(row) for row in RULES]
+        return []
+
+    fake_db.handler = handler
+    workflow.invalidate_approval_hierarchy()
+    workflow.invalidate_approval_rules()
+    yield fake_db
+    workflow.invalidate_approval_hierarchy()
+    workflow.invalidate_approval_rules()
+
+
+def test_batch_matches_single_path(routing):
+    invoices = [("A", 100), ("B", 20000, "Acme Ltd"), ("C", 20000, "Other"), ("D", 10 ** 9), ("E", None)]
+    result = workflow.check_approval_workflow_batch(invoices)
+
+    for invoice in invoices[:4]:
+        invoice_number, amount = invoice[:2]
+        supplier = invoice[2] if len(invoice) > 2 else None
+        assert result["routed"].get(invoice_number) == workflow.check_approval_workflow(amount, invoice_number, supplier)
+    assert result["routed"]["B"]["level_name"] == "ACME"
+    assert sorted(result["unmatched"]) == ["D", "E"]
+    assert result["duplicates"] == []
+
+
+def test_batch_routes_from_snapshot_without_per_call_queries(routing):
+    workflow.check_approval_workflow_batch([("A", 100)])
+    queries = len(routing.log)
+    workflow.check_approval_workflow_batch([(f"INV-{n}", n * 10) for n in range(200)])
+    assert len(routing.log) == queries
+
+
+def test_duplicate_invoice_numbers_are_rejected(routing):
+    result = workflow.check_approval_workflow_batch([("A", 100), ("A", 20000), ("B", 100)])
+    assert result["duplicates"] == ["A"]
+    assert list(result["routed"]) == ["B"]
+    assert result["unmatched"] == []
+
+
+def test_invalid_amount_fails_the_batch(routing):
+    assert workflow.check_approval_workflow_batch([("A", "not a number")]) is None
+
+
+def test_empty_batch():
+    assert workflow.check_approval_workflow_batch([]) == {"routed": {}, "unmatched": [], "duplicates": []}
+
+
+ENGINE_RULES = [
+    {"min_amount": 0, "max_amount": 5000, "level_name": "L1", "approver_name": "Lee", "approver_email": "l1@corp.test"},
+    {"min_amount": 5000, "level_name": "L2", "approver_name": "Sam", "approver_email": "l2@corp.test"},
+    {"supplier": "Acme Ltd", "max_amount": 20000, "level_name": "ACME", "approver_name": "Ana", "approver_email": "acme@corp.test"},
+    {"currency": "usd", "min_amount": 1000, "max_amount": 1000, "level_name": "USD", "approver_name": "Uma",
+     "approver_email": "usd@corp.test"},
+    {"supplier": "acme ltd", "cost_centre": "CC-9", "currency": "EUR", "level_name": "EXACT", "approver_name": "Eve",
+     "approver_email": "exact@corp.test"},
+    {"cost_centre": "CC-9", "min_amount": -100, "max_amount": -1, "level_name": "CREDIT", "approver_name": "Cy",
+     "approver_email": "credit@corp.test"},
+]
+
+
+def engine_cases():
+    amounts = [-100, -1, -0.5, 0, 999.99, 1000, 1000.01, 4999.99, 5000, 5000.01, 19999.99, 20000, 20000.01, 10 ** 9]
+    for amount in amounts:
+        for supplier in (None, "Acme Ltd", " ACME LTD ", "Other"):
+            for cost_centre in (None, "CC-9", "cc-9", "CC-1"):
+                for currency in (None, "USD", "eur", "GBP"):
+                    yield amount, supplier, currency, cost_centre
+
+
+def test_vectorized_and_scalar_evaluation_agree():
+    engine = workflow.ApprovalRulesEngine(ENGINE_RULES)
+    cases = list(engine_cases())
+    amounts, suppliers, currencies, cost_centres = (list(column) for column in zip(*cases))
+
+    batch = engine.route_batch(amounts, suppliers=suppliers, currencies=currencies, cost_centres=cost_centres)
+    assert batch == [engine.route(*case) for case in cases]
+    assert {route[0] for route in batch if route} == {"L1", "L2", "ACME", "USD", "EXACT", "CREDIT"}
+    assert None in batch
+
+
+def test_scalar_path_is_used_without_numpy(monkeypatch):
+    engine = workflow.ApprovalRulesEngine(ENGINE_RULES)
+    cases = list(engine_cases())
+    amounts = [case[0] for case in cases]
+    vectorized = engine.route_batch(amounts, suppliers=[case[1] for case in cases])
+
+    def missing():
+        raise ImportError("numpy")
+
+    monkeypatch.setattr(workflow._numpy, "_load", missing)
+    assert engine.route_batch(amounts, suppliers=[case[1] for case in cases]) == vectorized
+
+
+def test_empty_engine_routes_nothing():
+    engine = workflow.ApprovalRulesEngine([])
+    assert engine.route(100) is None
+    assert engine.route_batch([100, 200]) == [None, None]
+
+
+def test_no_fallback_approvers_by_default(monkeypatch):
+    monkeypatch.delenv("WORKFLOW_FALLBACK_APPROVAL_RULES", raising=False)
+    monkeypatch.setitem(workflow._fallback_approval_rules, "engine", None)
+    assert workflow.get_temporary_approver(100) is None
+
+
+def test_fallback_approvers_come_from_configuration(monkeypatch, tmp_path):
+    path = tmp_path / "fallback.json"
+    path.write_text('[{"max_amount": 5000, "level_name": "L1", "approver_name": "Lee", "approver_email": "l1@corp.test"}]')
+    monkeypatch.setenv("WORKFLOW_FALLBACK_APPROVAL_RULES", str(path))
+    monkeypatch.setitem(workflow._fallback_approval_rules, "engine", None)
+    assert workflow.get_temporary_approver(100) == ("L1", "Lee", "l1@corp.test")
+    assert workflow.get_temporary_approver(5000.01) is None
+
+
+def test_unrouted_invoice_fails_the_workflow(routing, monkeypatch):
+    monkeypatch.setitem(workflow._fallback_approval_rules, "engine", workflow.ApprovalRulesEngine([]))
+    assert workflow.start_approval_workflow("INV-1", 100, 10 ** 9) is None
+    assert not routing.statements("workflow_audit_log")
@@ -0,0 +1,121 @@
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+
+import pytest
+
+import workflow_sla
+
+TIERS = [
+    {"level_name": "L1", "approver_name": "Lee", "approver_email": "l1@corp.test"},
+    {"level_name": "L2", "approver_name": "Sam", "approver_email": "l2@corp.test"},
+]
+
+
+class Hierarchy:
+    def tier_for_level(self, level_name):
+        return next((tier for tier in TIERS if tier["level_name"] == level_name), None)
+
+    def next_tier(self, level_name):
+        levels = [tier["level_name"] for tier in TIERS]
+        index = levels.index(level_name) + 1 if level_name in levels else len(levels)
+        return TIERS[index] if index < len(TIERS) else None
+
+
+def build_message(invoice_number, amount, approver_email, approver_name, audit_id, changes=None):
+    msg = EmailMessage()
+    msg["To"] = approver_email
+    msg["Subject"] = f"Approval Required: Invoice #{invoice_number}"
+    return msg
+
+
+@pytest.fixture
+def sla(fake_db, monkeypatch):
+    """
+    Scheduler over an in-memory audit table {id: {"anchor", "reminders", "level", "email"}};
+    `sla.clock` is the database's now() in epoch seconds and `sla.sent` collects (subject prefix, invoice, recipient)
+    """
+    audits = {}
+    sent = []
+    scheduler = workflow_sla.SLAScheduler(build_message, lambda invoice_numbers: {}, Hierarchy,
+                                          remind_after=10, escalate_after=35, max_reminders=2, poll_interval=3600)
+
+    def handler(sql, params):
+        if sql == workflow_sla.SLA_PENDING_PAGE_SQL:
+            if params[1] != 0:
+                return []
+            created = datetime(2026, 1, 1)
+            return [(audit_id, created + timedelta(seconds=audit_id), audit["anchor"], audit["reminders"], audit["level"])
+                    for audit_id, audit in sorted(audits.items())]
+        if sql == workflow_sla.SLA_CLAIM_REMINDERS_SQL:
+            rows = []
+            for audit_id in params[2]:
+                audit = audits[audit_id]
+                audit["reminders"] += 1
+                rows.append((audit_id, f"INV-{audit_id}", 100, audit["level"], audit["email"], audit["reminders"],
+                             audit["anchor"]))
+            return rows
+        if sql == workflow_sla.SLA_CLAIM_ESCALATIONS_SQL:
+            rows = []
+            for audit_id, to_level, to_email in zip(params[0], params[2], params[3]):
+                audits[audit_id].update(anchor=scheduler.clock, reminders=0, level=to_level, email=to_email)
+                rows.append((audit_id, f"INV-{audit_id}", 100, to_level, to_email, scheduler.clock))
+            return rows
+        return []
+
+    def deliver(messages):
+        sent.extend((msg["Subject"].split(":")[0], msg["Subject"].rsplit("#", 1)[1], msg["To"]) for msg in messages)
+        return [True] * len(messages)
+
+    fake_db.handler = handler
+    monkeypatch.setattr(workflow_sla, "send_email_messages_batch", deliver)
+    scheduler.audits, scheduler.sent, scheduler.clock = audits, sent, 0.0
+    return scheduler
+
+
+def add_audit(sla, audit_id, anchor, level="L1"):
+    sla.audits[audit_id] = {"anchor": anchor, "reminders": 0, "level": level, "email": f"{level.lower()}@corp.test"}
+
+
+def run_at(sla, now):
+    sla.clock = now
+    sla.sent.clear()
+    sla.run_once(now=now)
+    return list(sla.sent)
+
+
+def test_reminders_then_escalation_in_due_order(sla):
+    add_audit(sla, 1, anchor=0.0)
+    add_audit(sla, 2, anchor=5.0)
+
+    assert run_at(sla, 11) == [("REMINDER", "INV-1", "l1@corp.test")]   # first reminder due at 10
+    assert run_at(sla, 16) == [("REMINDER", "INV-2", "l1@corp.test")]   # due at 15
+    assert run_at(sla, 21) == [("REMINDER", "INV-1", "l1@corp.test")]   # second reminder
+    assert run_at(sla, 26) == [("REMINDER", "INV-2", "l1@corp.test")]
+    assert run_at(sla, 31) == []                                        # no third reminder
+    assert run_at(sla, 36) == [("ESCALATED", "INV-1", "l2@corp.test")]  # deadline 35
+    assert sla.audits[1]["level"] == "L2" and sla.audits[2]["level"] == "L1"
+    assert run_at(sla, 41) == [("ESCALATED", "INV-2", "l2@corp.test")]  # deadline 40
+    # After escalation the clock restarts from the escalation time
+    assert run_at(sla, 47) == [("REMINDER", "INV-1", "l2@corp.test")]   # 36 + 10
+    assert sla.stats()["reminders"] == 5
+    assert sla.stats()["escalations"] == 2
+
+
+def test_reminder_reached_after_the_deadline_escalates_instead(sla):
+    add_audit(sla, 1, anchor=0.0)
+    assert run_at(sla, 40) == [("ESCALATED", "INV-1", "l2@corp.test")]
+    assert sla.audits[1]["reminders"] == 0
+
+
+def test_top_tier_overdue_audit_is_dropped_from_the_heap(sla):
+    add_audit(sla, 1, anchor=0.0, level="L2")
+    sla.max_reminders = 0
+    assert run_at(sla, 36) == []
+    assert sla.stats()["top_tier"] == 1
+
+
+def test_superseded_heap_items_are_skipped(sla):
+    sla._schedule(1, 0.0, 0, "L1")
+    sla._schedule(1, 0.0, 1, "L1")   # the reminder was sent: only the second one is live
+    due = sla._pop_due(100)
+    assert [(item[1], item[2], item[4]) for item in due] == [(1, "remind", 1)]
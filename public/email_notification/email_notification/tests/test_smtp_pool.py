@@ -0,0 +1,92 @@
+import smtplib
+import time
+from email.message import EmailMessage
+
+import workflow_smtp
+
+CONFIG = {"server": "smtp.example.com", "port": 587, "user": "ap@example.com", "password": "x",
+          "timeout": 5, "starttls": True}
+
+
+def make_message(to="approver@example.com"):
+    msg = EmailMessage()
+    msg["To"] = to
+    msg["Subject"] = "Invoice"
+    msg.set_content("body")
+    return msg
+
+
+def test_one_login_serves_consecutive_sends(fake_smtp):
+    pool = workflow_smtp.SMTPSessionPool()
+    for n in range(3):
+        pool.send(CONFIG, make_message(f"a{n}@example.com"))
+
+    assert len(fake_smtp.instances) == 1
+    assert len(fake_smtp.messages) == 3
+    stats = pool.stats()
+    assert (stats["connects"], stats["reuses"], stats["messages"], stats["idle"]) == (1, 2, 3, 1)
+
+
+def test_dropped_idle_session_is_replaced(fake_smtp):
+    pool = workflow_smtp.SMTPSessionPool()
+    pool.send(CONFIG, make_message())
+    fake_smtp.instances[0].sock = None  # server closed it while idle: NOOP fails
+
+    pool.send(CONFIG, make_message())
+    assert len(fake_smtp.instances) == 2
+    assert pool.stats()["probe_failures"] == 1
+
+
+def test_session_idle_past_the_timeout_is_not_reused(fake_smtp, monkeypatch):
+    pool = workflow_smtp.SMTPSessionPool(idle_timeout=60)
+    pool.send(CONFIG, make_message())
+    now = time.monotonic()
+    monkeypatch.setattr(workflow_smtp.time, "monotonic", lambda: now + 61)
+
+    pool.send(CONFIG, make_message())
+    assert len(fake_smtp.instances) == 2
+
+
+def test_disconnect_mid_send_reconnects_once(fake_smtp):
+    pool = workflow_smtp.SMTPSessionPool()
+    pool.send(CONFIG, make_message())
+    fake_smtp.instances[0].fail_with = [smtplib.SMTPServerDisconnected("Connection unexpectedly closed")]
+
+    pool.send(CONFIG, make_message("b@example.com"))
+    assert [msg["To"] for msg in fake_smtp.messages] == ["approver@example.com", "b@example.com"]
+    assert pool.stats()["reconnects"] == 1
+    assert fake_smtp.instances[0].sock is None
+
+
+def test_batch_rotates_sessions_at_the_message_cap(fake_smtp):
+    pool = workflow_smtp.SMTPSessionPool(max_messages_per_session=2)
+    results = pool.send_batch(CONFIG, [make_message(f"a{n}@example.com") for n in range(5)])
+
+    assert results == [(True, None)] * 5
+    assert [len(smtp.sent) for smtp in fake_smtp.instances] == [2, 2, 1]
+
+
+def test_refused_recipient_does_not_stop_the_batch(fake_smtp):
+    pool = workflow_smtp.SMTPSessionPool()
+    pool.send(CONFIG, make_message())
+    refused = smtplib.SMTPRecipientsRefused({"gone@example.com": (550, b"no such user")})
+    fake_smtp.instances[0].fail_with = [refused]
+
+    results = pool.send_batch(CONFIG, [make_message("gone@example.com"), make_message("b@example.com")])
+    assert results == [(False, refused), (True, None)]
+    # A per-recipient refusal leaves the session usable
+    assert pool.stats()["idle"] == 1
+    assert len(fake_smtp.instances) == 1
+
+
+def test_sessions_are_pooled_per_account_and_capped(fake_smtp):
+    pool = workflow_smtp.SMTPSessionPool(max_idle_per_key=1)
+    other = dict(CONFIG, user="ar@example.com")
+    with pool.session(CONFIG) as first, pool.session(CONFIG) as second, pool.session(other) as third:
+        assert len({id(first.smtp), id(second.smtp), id(third.smtp)}) == 3
+    assert pool.stats()["idle"] == 2
+    assert sum(smtp.sock is None for smtp in fake_smtp.instances) == 1
+
+    pool.close()
+    assert pool.stats()["idle"] == 0
+    assert all(smtp.sock is None for smtp in fake_smtp.instances)
@@ -0,0 +1,133 @@
+import re
+import string
+
+import pytest
+
+import workflow
+
+CHANGES = {
+    "header_changes": {"supplier_name": "Acme → Acme Ltd", "invoice_amount": "100 → 120"},
+    "line_changes": {1: {"quantity": "2 → 3"}, 2: {"unit_price": "5 → 6", "description": "Bolt → Bolts"}},
+}
+
+
+@pytest.fixture
+def minify(monkeypatch):
+    def set_minify(enabled):
+        monkeypatch.setenv("WORKFLOW_EMAIL_MINIFY", "1" if enabled else "0")
+        monkeypatch.setattr(workflow, "_compiled_templates", {})
+    yield set_minify
+    workflow._compiled_templates.clear()
+
+
+def baseline_changes_summary_html(changes):
+    """
+    The change summary as the pre-template implementation built it
+    """
+    changes_html = '<div class="changes-section">\n'
+    changes_html += '<h3>📊 CHANGES SUMMARY</h3>\n'
+    if changes.get("header_changes"):
+        changes_html += '<div class="changes-group">\n'
+        changes_html += '<h4>📋 Header Changes</h4>\n'
+        changes_html += '<table class="changes-table">\n'
+        for field, change_desc in changes["header_changes"].items():
+            field_display = field.replace('_', ' ').title()
+            changes_html += f'''
+            <tr>
+                <td class="change-field">{field_display}</td>
+                <td class="change-arrow">→</td>
+                <td class="change-new">{change_desc}</td>
+            </tr>
+            '''
+        changes_html += '</table>\n'
+        changes_html += '</div>\n'
+    if changes.get("line_changes"):
+        changes_html += '<div class="changes-group">\n'
+        changes_html += '<h4>📝 Line Item Changes</h4>\n'
+        for line_num, line_changes in changes["line_changes"].items():
+            changes_html += '<div class="line-change">\n'
+            changes_html += f'<strong>Line {line_num}:</strong>\n'
+            changes_html += '<table class="changes-table">\n'
+            for field, change_desc in line_changes.items():
+                field_display = field.replace('_', ' ').title()
+                changes_html += f'''
+                <tr>
+                    <td class="change-field">{field_display}</td>
+                    <td class="change-arrow">→</td>
+                    <td class="change-new">{change_desc}</td>
+                </tr>
+                '''
+            changes_html += '</table>\n'
+            changes_html += '</div>\n'
+        changes_html += '</div>\n'
+    changes_html += '</div>\n'
+    return changes_html
+
+
+def visible_text(markup):
+    return " ".join(re.sub(r"<[^>]+>", " ", markup).split())
+
+
+@pytest.mark.parametrize("name", sorted(workflow._EMAIL_TEMPLATE_SOURCES))
+def test_compiled_templates_render_like_str_format(name, minify):
+    minify(False)
+    source = workflow.read_email_template_source(name)
+    fields = {field for _, field, _, _ in string.Formatter().parse(source) if field}
+    values = {field: f"<{field}-value>" for field in fields}
+    rendered = workflow.EmailTemplate(source, escape=False).render(values)
+    assert rendered == source.format(**values)
+
+
+def test_default_changes_summary_matches_baseline(minify):
+    minify(False)
+    assert workflow.generate_changes_summary_html(CHANGES) == baseline_changes_summary_html(CHANGES)
+
+
+def test_minified_changes_summary_has_no_indentation(minify):
+    minify(True)
+    compact = workflow.generate_changes_summary_html(CHANGES)
+    assert "\n " not in compact
+    assert visible_text(compact) == visible_text(baseline_changes_summary_html(CHANGES))
+
+
+def test_minified_rows_shrink_large_diffs(minify):
+    changes = {"line_changes": {n: {"quantity": f"{n} → {n + 1}", "unit_price": "10 → 11"} for n in range(100)}}
+    minify(False)
+    indented = workflow.generate_changes_summary_html(changes)
+    minify(True)
+    compact = workflow.generate_changes_summary_html(changes)
+    assert len(compact) < 0.65 * len(indented)
+    assert max(len(line) for line in compact.split("\n")) < 998
+
+
+def test_minified_approval_email_keeps_its_text(minify):
+    args = ("INV-1", "1,250.00", 7, "Asha", "asha@corp.test", "L1", CHANGES,
+            "https://a/approve", "https://a/reject", "https://a/edit")
+    minify(False)
+    full = workflow.generate_approval_email_html(*args)
+    minify(True)
+    compact = workflow.generate_approval_email_html(*args)
+    assert len(compact) < len(full)
+    timestamp = re.compile(r"\d{4}-\d\d-\d\d \d\d:\d\d:\d\d")
+    strip_css = re.compile(r"<style.*?</style>", re.S)
+    assert timestamp.sub("", visible_text(strip_css.sub("", compact))) == \
+        timestamp.sub("", visible_text(strip_css.sub("", full)))
+
+
+def test_template_cache_follows_the_minify_setting(monkeypatch):
+    monkeypatch.setattr(workflow, "_compiled_templates", {})
+    monkeypatch.setenv("WORKFLOW_EMAIL_MINIFY", "0")
+    full = workflow.get_email_template("approval_html")
+    monkeypatch.setenv("WORKFLOW_EMAIL_MINIFY", "1")
+    compact = workflow.get_email_template("approval_html")
+    empty = dict.fromkeys(full.slots, "")
+    assert len(compact.render(empty)) < len(full.render(empty))
+    monkeypatch.setenv("WORKFLOW_EMAIL_MINIFY", "0")
+    assert workflow.get_email_template("approval_html") is full
+
+
+def test_templates_are_compiled_from_their_files(monkeypatch, tmp_path):
+    (tmp_path / "approval_email.txt").write_text("Dear {approver_name},\n", encoding="utf-8")
+    monkeypatch.setattr(workflow, "EMAIL_TEMPLATE_DIR", str(tmp_path))
+    monkeypatch.setattr(workflow, "_compiled_templates", {})
+    assert workflow.get_email_template("approval_plain").render({"approver_name": "Asha"}) == "Dear Asha,\n"
@@ -0,0 +1,164 @@
+import json
+import time
+import types
+
+import pytest
+
+import workflow_db
+import workflow_tracing
+
+
+@pytest.fixture
+def tracing():
+    """
+    Enable tracing with the given WorkflowTracer settings; switched off again afterwards
+    """
+    def configure(**settings):
+        return workflow_tracing.configure_tracing(**settings)
+    yield configure
+    workflow_tracing.configure_tracing(enabled=False)
+
+
+@workflow_tracing.traced()
+def handle(invoice_number, delay=0.0, fail=False):
+    with workflow_tracing.trace_span("stage_one"):
+        workflow_tracing.tag_trace(audit_id=42)
+        with workflow_tracing.trace_span("stage_two", detail="x"):
+            time.sleep(delay)
+    if fail:
+        raise RuntimeError("boom")
+    return invoice_number
+
+
+def spans_by_name(records):
+    return {record["name"]: record for record in records if record.get("type") != "profile"}
+
+
+def test_tracing_off_costs_nothing():
+    assert workflow_tracing.get_tracer() is None
+    assert workflow_tracing.trace_span("stage", root=True) is workflow_tracing._NO_SPAN
+    assert handle("INV-1") == "INV-1"
+    assert workflow_tracing.get_recent_traces() == []
+
+
+def test_child_spans_outside_a_trace_are_not_recorded(tracing):
+    tracer = tracing()
+    with workflow_tracing.trace_span("stage"):
+        pass
+    assert tracer.stats()["traces"] == 0
+
+
+def test_spans_nest_under_the_root_and_share_its_tags(tracing):
+    tracing()
+    handle("INV-1")
+
+    records, = workflow_tracing.get_recent_traces()
+    spans = spans_by_name(records)
+    assert [record["name"] for record in records] == ["handle", "stage_one", "stage_two"]
+    assert spans["handle"]["parent_id"] is None
+    assert spans["stage_one"]["parent_id"] == spans["handle"]["span_id"]
+    assert spans["stage_two"]["parent_id"] == spans["stage_one"]["span_id"]
+    assert len({record["trace_id"] for record in records}) == 1
+    # audit_id is known only midway but is attached to every span of the trace
+    assert all(record["invoice_number"] == "INV-1" and record["audit_id"] == 42 for record in records)
+    assert spans["stage_two"]["tags"] == {"detail": "x"}
+
+
+def test_failed_root_records_the_error(tracing):
+    tracing()
+    with pytest.raises(RuntimeError):
+        handle("INV-1", fail=True)
+
+    records, = workflow_tracing.get_recent_traces()
+    assert spans_by_name(records)["handle"]["error"] == "RuntimeError: boom"
+    assert "error" not in spans_by_name(records)["stage_one"]
+
+
+def test_sql_inside_a_trace_becomes_db_execute_spans(tracing, fake_db):
+    tracing()
+    with workflow_tracing.trace_span("load", root=True):
+        with workflow_db.get_db_pool().connection() as conn:
+            conn.cursor().execute("SELECT 1")
+    conn = workflow_db.get_db_connection()
+    conn.cursor().execute("SELECT 2")
+    conn.close()
+
+    records, = workflow_tracing.get_recent_traces()
+    spans = spans_by_name(records)
+    assert spans["db_execute"]["tags"] == {"sql": "SELECT 1"}
+    assert spans["db_execute"]["parent_id"] == spans["load"]["span_id"]
+    assert spans["db_acquire"]["parent_id"] == spans["load"]["span_id"]
+    assert fake_db.statements("SELECT 2")  # ran untraced: still a single trace
+
+
+def test_fast_traces_below_min_ms_are_counted_not_kept(tracing, tmp_path):
+    path = tmp_path / "traces.jsonl"
+    tracer = tracing(path=str(path), min_ms=30)
+    handle("INV-1")
+    handle("INV-2", delay=0.05)
+
+    assert tracer.stats() == {"traces": 2, "exported": 1, "profiled": 0, "buffered": 1}
+    lines = [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()]
+    assert {line["invoice_number"] for line in lines} == {"INV-2"}
+    assert len(lines) == 3
+
+    export = tmp_path / "export.jsonl"
+    assert workflow_tracing.export_traces_jsonl(str(export)) == 3
+
+
+def test_stack_profiler_samples_only_slow_roots(tracing, caplog):
+    tracer = tracing(profile="stack", profile_threshold_ms=20, profile_interval_ms=1, min_ms=10 ** 6)
+    handle("INV-FAST")
+    handle("INV-SLOW", delay=0.2)
+
+    records, = workflow_tracing.get_recent_traces()
+    profile = records[-1]
+    assert profile["type"] == "profile" and profile["mode"] == "stack"
+    assert profile["invoice_number"] == "INV-SLOW" and profile["audit_id"] == 42
+    assert any("handle (" in sample["stack"] for sample in profile["samples"])
+    assert tracer.stats()["profiled"] == 1
+    assert "Slow workflow call profiled" in caplog.text
+
+
+@pytest.mark.parametrize("draw, profiled", [(0.05, True), (0.5, False)])
+def test_cprofile_runs_on_the_sampled_share_of_roots(tracing, monkeypatch, draw, profiled):
+    monkeypatch.setattr(workflow_tracing, "_random", types.SimpleNamespace(random=lambda: draw))
+    tracer = tracing(profile="cprofile", sample_rate=0.1, profile_threshold_ms=0, min_ms=10 ** 6)
+    handle("INV-1")
+
+    assert tracer.stats()["profiled"] == int(profiled)
+    if profiled:
+        profile = workflow_tracing.get_recent_traces()[0][-1]
+        assert any("(handle)" in entry["function"] for entry in profile["functions"])
+
+
+def test_cprofile_drops_sampled_roots_under_the_threshold(tracing, monkeypatch):
+    monkeypatch.setattr(workflow_tracing, "_random", types.SimpleNamespace(random=lambda: 0.0))
+    tracer = tracing(profile="cprofile", sample_rate=1.0, profile_threshold_ms=10 ** 6, min_ms=10 ** 6)
+    handle("INV-1")
+    assert tracer.stats() == {"traces": 1, "exported": 0, "profiled": 0, "buffered": 0}
+
+
+def test_unknown_profile_mode_is_rejected():
+    with pytest.raises(ValueError):
+        workflow_tracing.WorkflowTracer(profile="perf")
+
+
+@pytest.mark.parametrize("env, enabled, profile", [
+    ({}, False, None),
+    ({"WORKFLOW_TRACE": "1"}, True, None),
+    ({"WORKFLOW_PROFILE": "Stack"}, True, "stack"),
+    ({"WORKFLOW_TRACE": "0", "WORKFLOW_PROFILE": "cprofile", "WORKFLOW_PROFILE_SAMPLE_RATE": "0.25"}, True, "cprofile"),
+])
+def test_configure_from_env(tracing, monkeypatch, env, enabled, profile):
+    for name in ("WORKFLOW_TRACE", "WORKFLOW_PROFILE", "WORKFLOW_PROFILE_SAMPLE_RATE"):
+        monkeypatch.delenv(name, raising=False)
+    for name, value in env.items():
+        monkeypatch.setenv(name, value)
+
+    tracer = workflow_tracing.configure_tracing_from_env()
+    assert (tracer is not None) is enabled
+    if enabled:
+        assert workflow_tracing.get_tracer() is tracer
+        assert tracer.profile == profile
+        assert tracer.sample_rate == float(env.get("WORKFLOW_PROFILE_SAMPLE_RATE", 0.1))
@@ -1,56 +1,311 @@
-import datetime
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
 import os
+import re
+import base64
 import logging
-import psycopg2
-from psycopg2.extras import RealDictCursor
+import html
+import string
+import textwrap
+import csv
+import io
+import json
+import mimetypes
+import itertools
+import functools
+import threading
+import time
+import bisect
+import select
+import queue
+import atexit
+from concurrent.futures import Future
+from collections import OrderedDict
 from decimal import Decimal
+from datetime import datetime
 
-from datetime import datetime, timezone
-from datetime import datetime, timezone
-import smtplib
-import os
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-import logging
+# The subsystems live in sibling modules; their public names are re-exported here so
+# `import workflow` keeps exposing the whole API
+from workflow_core import *
+from workflow_core import (
+    _BoundedCache, _LazyModule, _create_raw_db_connection, _log_event, _psycopg2_extras, _unifycode_attr,
+    _unifycode_attrs, psycopg2, smtplib,
+)
+from workflow_tracing import *
+from workflow_metrics import *
+from workflow_metrics import _record_stage_failure, _timed_stage, _workflow_metrics
+from workflow_db import *
+from workflow_mime import *
+from workflow_mime import _mime_base, _mime_multipart, _mime_text
+from workflow_smtp import *
+from workflow_smtp import _get_smtp_config
+from workflow_outbox import *
+from workflow_sla import *
+from workflow_partitions import *
+import workflow_db
+import workflow_smtp
+import workflow_sla
+
+def render_prometheus_metrics():
+    """
+    Prometheus text exposition (format 0.0.4) of the workflow stage metrics, plus
+    DB and SMTP pool gauges for pools that have been created
+    """
+    pool_values = {}
+    for pool_name, pool in (("db", workflow_db._db_pool), ("smtp", workflow_smtp._smtp_pool)):
+        if pool is None:
+            continue
+        for key, value in pool.stats().items():
+            if isinstance(value, (int, float)):
+                pool_values.setdefault(key, []).append((pool_name, value))
+    
+    lines = [_workflow_metrics.render_prometheus()]
+    for key in sorted(pool_values):
+        lines.append(f"# TYPE workflow_pool_{key} gauge\n")
+        for pool_name, value in pool_values[key]:
+            lines.append(f'workflow_pool_{key}{{pool="{pool_name}"}} {value}\n')
+    return "".join(lines)
+
+# 🔥 NEW: In-memory approval hierarchy snapshot. The table changes about once a month,
+# so routing reads a sorted in-process copy and only goes back to Postgres when the
+# snapshot is invalidated (LISTEN/NOTIFY) or its TTL runs out.
+
+APPROVAL_HIERARCHY_CHANNEL = "approval_hierarchy_changed"
+
+# One-off DDL so edits to the hierarchy table notify listening workers
+APPROVAL_HIERARCHY_NOTIFY_SQL = """
+    CREATE OR REPLACE FUNCTION "DocAI".notify_approval_hierarchy_changed()
+    RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('approval_hierarchy_changed', TG_OP);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS approval_hierarchy_changed ON "DocAI".approval_hierarchy;
+    CREATE TRIGGER approval_hierarchy_changed
+        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON "DocAI".approval_hierarchy
+        FOR EACH STATEMENT EXECUTE PROCEDURE "DocAI".notify_approval_hierarchy_changed();
+"""
+
+class ApprovalHierarchySnapshot:
+    """
+    Sorted copy of "DocAI".approval_hierarchy with O(log n) lookup by amount.
+    Matches the old `amount BETWEEN min_amount AND max_amount ORDER BY min_amount LIMIT 1` query.
+    """
+
+    def __init__(self, ttl=300.0):
+        self.ttl = ttl
+        self._tiers = []
+        self._min_amounts = []
+        self._prefix_max = []
+        self._loaded_at = None
+        self._stale = True
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        self._stale = True
+
+    def _needs_refresh(self):
+        return (
+            self._stale
+            or self._loaded_at is None
+            or time.monotonic() - self._loaded_at > self.ttl
+        )
+
+    def load(self):
+        with db_connection() as conn:
+            cur = conn.cursor(cursor_factory=_psycopg2_extras.RealDictCursor)
+            cur.execute("""
+                SELECT min_amount, max_amount, level_name, approver_name, approver_email
+                FROM "DocAI".approval_hierarchy
+                WHERE min_amount IS NOT NULL AND max_amount IS NOT NULL
+                ORDER BY min_amount
+            """)
+            rows = cur.fetchall()
+            cur.close()
+
+        tiers = sorted(
+            (
+                (
+                    Decimal(str(row['min_amount'])),
+                    Decimal(str(row['max_amount'])),
+                    {
+                        'level_name': row['level_name'],
+                        'approver_name': row['approver_name'],
+                        'approver_email': row['approver_email'],
+                    },
+                )
+                for row in rows
+            ),
+            key=lambda tier: tier[0],
+        )
+
+        # Running maximum of max_amount: the first tier (by min_amount) whose range
+        # reaches the amount is the first index where this prefix max reaches it.
+        prefix_max = []
+        running = None
+        for _, max_amount, _ in tiers:
+            running = max_amount if running is None else max(running, max_amount)
+            prefix_max.append(running)
+
+        self._tiers = tiers
+        self._min_amounts = [tier[0] for tier in tiers]
+        self._prefix_max = prefix_max
+        self._loaded_at = time.monotonic()
+        self._stale = False
+        logger.info("📚 Approval hierarchy snapshot loaded (%s tiers)", len(tiers))
+
+    def refresh_if_needed(self):
+        if not self._needs_refresh():
+            return
+        with self._lock:
+            if not self._needs_refresh():
+                return
+            try:
+                self.load()
+            except Exception as e:
+                if self._loaded_at is None:
+                    raise
+                # Keep routing on the last good snapshot; try again after another TTL
+                self._loaded_at = time.monotonic()
+                self._stale = False
+                logger.warning("⚠️ Approval hierarchy refresh failed, using previous snapshot: %s", e)
+
+    def tiers(self):
+        """
+        Tiers as (min_amount, max_amount, info) tuples ordered by min_amount
+        """
+        self.refresh_if_needed()
+        return list(self._tiers)
+
+    def tier_for_level(self, level_name):
+        """
+        Approver info for `level_name`, or None if the level is not in the hierarchy
+        """
+        for _, _, info in self.tiers():
+            if info['level_name'] == level_name:
+                return dict(info)
+        return None
+
+    def next_tier(self, level_name):
+        """
+        Approver info for the tier above `level_name` (next by min_amount), or None at the top
+        """
+        tiers = self.tiers()
+        for index, (_, _, info) in enumerate(tiers):
+            if info['level_name'] == level_name:
+                return dict(tiers[index + 1][2]) if index + 1 < len(tiers) else None
+        return None
+
+    def lookup(self, amount):
+        self.refresh_if_needed()
+        tiers, min_amounts, prefix_max = self._tiers, self._min_amounts, self._prefix_max
+
+        amount = Decimal(str(amount))
+        candidates = bisect.bisect_right(min_amounts, amount)
+        first = bisect.bisect_left(prefix_max, amount, 0, candidates)
+        if first >= candidates:
+            return None
+        return dict(tiers[first][2])
+
+_approval_hierarchy = ApprovalHierarchySnapshot(ttl=float(os.getenv('WORKFLOW_HIERARCHY_TTL', 300)))
+_hierarchy_listener = None
+_hierarchy_listener_lock = threading.Lock()
+
+def get_approval_hierarchy():
+    """
+    Return the shared hierarchy snapshot, starting the change listener if enabled
+    """
+    if os.getenv('WORKFLOW_HIERARCHY_LISTEN', '0') == '1' and _hierarchy_listener is None:
+        start_approval_hierarchy_listener()
+    return _approval_hierarchy
+
+def invalidate_approval_hierarchy():
+    _approval_hierarchy.invalidate()
+
+def install_approval_hierarchy_trigger():
+    """
+    Install the NOTIFY trigger on approval_hierarchy (run once per database)
+    """
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(APPROVAL_HIERARCHY_NOTIFY_SQL)
+        conn.commit()
+        cur.close()
+    logger.info("🔔 approval_hierarchy change trigger installed")
+
+class _ApprovalHierarchyListener(threading.Thread):
+    """
+    Background LISTEN on a dedicated connection; invalidates the snapshot on NOTIFY
+    """
 
+    def __init__(self, snapshot, poll_interval=5.0):
+        super().__init__(name="approval-hierarchy-listener", daemon=True)
+        self.snapshot = snapshot
+        self.poll_interval = poll_interval
+        self._stop_event = threading.Event()
 
-# Import logger from unifycode
-try:
-    from unifycode import logger
-except ImportError:
-    # Create a fallback logger if import fails
-    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
-    logger = logging.getLogger(__name__)
+    def stop(self):
+        self._stop_event.set()
 
-# Use the same DB connection function from unifycode.py
-def get_db_connection():
-    from unifycode import get_db_connection as original_get_db_connection
-    return original_get_db_connection()
+    def run(self):
+        backoff = 1.0
+        while not self._stop_event.is_set():
+            conn = None
+            try:
+                conn = _create_raw_db_connection()
+                conn.autocommit = True
+                cur = conn.cursor()
+                cur.execute(f"LISTEN {APPROVAL_HIERARCHY_CHANNEL}")
+                # Anything may have changed while we were not listening
+                self.snapshot.invalidate()
+                backoff = 1.0
+                while not self._stop_event.is_set():
+                    if select.select([conn], [], [], self.poll_interval) == ([], [], []):
+                        continue
+                    conn.poll()
+                    if conn.notifies:
+                        conn.notifies.clear()
+                        self.snapshot.invalidate()
+                        logger.info("🔔 approval_hierarchy changed, snapshot invalidated")
+            except Exception as e:
+                self.snapshot.invalidate()
+                logger.warning("⚠️ approval_hierarchy listener error, retrying in %.0fs: %s", backoff, e)
+                self._stop_event.wait(backoff)
+                backoff = min(backoff * 2, 60.0)
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+
+def start_approval_hierarchy_listener():
+    global _hierarchy_listener
+    with _hierarchy_listener_lock:
+        if _hierarchy_listener is None or not _hierarchy_listener.is_alive():
+            _hierarchy_listener = _ApprovalHierarchyListener(_approval_hierarchy)
+            _hierarchy_listener.start()
+    return _hierarchy_listener
+
+def stop_approval_hierarchy_listener():
+    global _hierarchy_listener
+    listener, _hierarchy_listener = _hierarchy_listener, None
+    if listener is not None:
+        listener.stop()
 
 # 🔥 WORKFLOW FUNCTIONS - Enhanced to work with pending changes
 
-def check_approval_workflow(invoice_amount, invoice_number, supplier_name, user_id=1):
+def check_approval_workflow(invoice_amount, invoice_number, supplier_name, user_id=1, currency=None, cost_centre=None):
     """
-    Check which approval level is needed based on amount
+    Check which approval level is needed based on amount.
+    Supplier / currency / cost centre rules from "DocAI".approval_rules are tried
+    first, then the in-memory hierarchy snapshot; no DB round trip per invoice.
     """
     try:
-        conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        
-        cur.execute("""
-            SELECT level_name, approver_name, approver_email 
-            FROM "DocAI".approval_hierarchy 
-            WHERE %s BETWEEN min_amount AND max_amount
-            ORDER BY min_amount
-            LIMIT 1
-        """, (invoice_amount,))
-        
-        result = cur.fetchone()
-        cur.close()
-        conn.close()
+        with _timed_stage("check_approval_workflow"):
+            result = get_approval_rules_engine().lookup(invoice_amount, supplier_name, currency, cost_centre)
+            if result is None:
+                result = get_approval_hierarchy().lookup(invoice_amount)
         
         if result:
             logger.info(f"🔄 WORKFLOW: Invoice {invoice_number} (Amount: {invoice_amount}) needs {result['level_name']} approval - {result['approver_name']}")
@@ -63,26 +318,76 @@ def check_approval_workflow(invoice_amount, invoice_number, supplier_name, user_
         logger.error(f"❌ Workflow check failed: {e}")
         return None
 
+def check_approval_workflow_batch(invoices):
+    """
+    Resolve approval levels for many invoices in memory, in the same order as
+    check_approval_workflow: dimension rules first, then the hierarchy snapshot.
+    `invoices` are (invoice_number, amount[, supplier_name[, currency[, cost_centre]]])
+    tuples. An invoice_number given more than once is not routed and is listed under
+    "duplicates" instead, since its entries could route differently.
+    Returns {"routed": {invoice_number: {level_name, approver_name, approver_email}},
+             "unmatched": [invoice_number, ...], "duplicates": [invoice_number, ...]}
+    or None if routing fails.
+    """
+    invoices = list(invoices)
+    routed = {}
+    unmatched = []
+    counts = {}
+    for invoice in invoices:
+        counts[invoice[0]] = counts.get(invoice[0], 0) + 1
+    duplicates = [invoice_number for invoice_number, count in counts.items() if count > 1]
+    if duplicates:
+        logger.warning("⚠️ Batch routing skipped %s invoice numbers given more than once", len(duplicates))
+    
+    try:
+        candidates = []
+        for invoice in invoices:
+            invoice_number, amount = invoice[0], invoice[1]
+            if counts[invoice_number] > 1:
+                continue
+            if amount is None:
+                unmatched.append(invoice_number)
+                continue
+            supplier, currency, cost_centre = (tuple(invoice[2:5]) + (None, None, None))[:3]
+            candidates.append({"invoice_number": invoice_number, "amount": Decimal(str(amount)),
+                               "supplier": supplier, "currency": currency, "cost_centre": cost_centre})
+        
+        with _timed_stage("check_approval_workflow_batch"):
+            results = route_approvals_batch(candidates) if candidates else []
+    except Exception as e:
+        logger.error("❌ Batch workflow check failed: %s", e)
+        return None
+    
+    for invoice, result in zip(candidates, results):
+        if result is None:
+            unmatched.append(invoice["invoice_number"])
+        else:
+            routed[invoice["invoice_number"]] = result
+    
+    logger.info("🔄 WORKFLOW: Batch routed %s invoices, %s without a matching tier", len(routed), len(unmatched))
+    return {"routed": routed, "unmatched": unmatched, "duplicates": duplicates}
+
 def create_workflow_audit(invoice_number, original_amount, changed_amount, approver_level, approver_email, approver_name, user_id=1):
     """
-    Create audit entry in workflow_audit_log
+    Create audit entry in workflow_audit_log.
+    With group commit enabled the insert is batched with concurrent callers.
     """
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
+        row = (invoice_number, original_amount, changed_amount, approver_level, approver_email, f"user_{user_id}")
         
-        cur.execute("""
-            INSERT INTO "DocAI".workflow_audit_log 
-            (invoice_number, original_amount, changed_amount, current_approver_level, 
-             current_approver_email, status, change_requested_by)
-            VALUES (%s, %s, %s, %s, %s, 'pending', %s)
-            RETURNING id
-        """, (invoice_number, original_amount, changed_amount, approver_level, approver_email, f"user_{user_id}"))
+        committer = _audit_committer
+        if committer is None and os.getenv('WORKFLOW_AUDIT_GROUP_COMMIT', '0') == '1':
+            committer = enable_audit_group_commit()
         
-        audit_id = cur.fetchone()[0]
-        conn.commit()
-        cur.close()
-        conn.close()
+        with _timed_stage("create_workflow_audit"):
+            if committer is not None:
+                audit_id = committer.submit(row).result(timeout=committer.result_timeout)
+            else:
+                with db_connection() as conn:
+                    cur = conn.cursor()
+                    audit_id = _insert_workflow_audits(cur, [row])[0]
+                    conn.commit()
+                    cur.close()
         
         logger.info(f"📝 Workflow audit created for {invoice_number} (Audit ID: {audit_id})")
         return audit_id
@@ -91,701 +396,3140 @@ def create_workflow_audit(invoice_number, original_amount, changed_amount, appro
         logger.error(f"❌ Workflow audit creation failed: {e}")
         return None
 
-def should_trigger_workflow(invoice_amount, invoice_number):
-    """
-    Basic check to see if workflow should be triggered
-    For now, we'll trigger for any amount change, but later we can add conditions
-    """
-    if invoice_amount is None:
-        return False
-    
-    try:
-        # Convert to Decimal for proper comparison
-        amount = Decimal(str(invoice_amount))
-        # Trigger workflow for any amount (we'll add conditions later)
-        return True
-    except:
-        return False
+# 🔥 NEW: Bulk and group-commit audit inserts. At peak intake the number of commits,
+# not the data volume, is what limits Postgres.
 
-def get_temporary_approver(invoice_amount):
+def _insert_workflow_audits(cur, rows):
     """
-    Temporary function until we have data in approval_hierarchy table
+    Insert (invoice_number, original_amount, changed_amount, approver_level,
+    approver_email, change_requested_by) rows in one statement; ids come back in input order
     """
-    amount = Decimal(str(invoice_amount))
-    if amount <= 5000:
-        return "L1", "Temporary Approver L1", "approverl1bee@gmail.com"
-    elif amount <= 20000:
-        return "L2", "Temporary Approver L2", "mrupatil333@gmail.com"
-    else:
-        return "L3", "Temporary Approver L3", "beeat2024@gmail.com"
+    result = _psycopg2_extras.execute_values(cur, """
+        INSERT INTO "DocAI".workflow_audit_log 
+        (invoice_number, original_amount, changed_amount, current_approver_level, 
+         current_approver_email, status, change_requested_by)
+        VALUES %s
+        RETURNING id
+    """, rows, template="(%s, %s, %s, %s, %s, 'pending', %s)", page_size=max(len(rows), 1), fetch=True)
+    return [r[0] for r in result]
 
-# 🔥 ENHANCED: Function to get pending changes for email content
-def get_pending_changes_for_email(invoice_number):
+def _audit_row(entry):
+    if isinstance(entry, dict):
+        return (
+            entry['invoice_number'],
+            entry.get('original_amount'),
+            entry.get('changed_amount'),
+            entry.get('approver_level'),
+            entry.get('approver_email'),
+            f"user_{entry.get('user_id', 1)}",
+        )
+    invoice_number, original_amount, changed_amount, approver_level, approver_email = entry[:5]
+    user_id = entry[6] if len(entry) > 6 else 1
+    return (invoice_number, original_amount, changed_amount, approver_level, approver_email, f"user_{user_id}")
+
+def create_workflow_audits_bulk(entries):
     """
-    Get pending changes from history tables for email content
+    Create many audit entries with one multi-row INSERT and a single commit.
+    Entries are dicts keyed like create_workflow_audit's arguments, or tuples in the same order.
+    Returns the audit ids in input order, or None if the insert fails.
     """
     try:
-        from unifycode import get_pending_changes_from_history
-        pending_changes = get_pending_changes_from_history(invoice_number)
+        rows = [_audit_row(entry) for entry in entries]
+        if not rows:
+            return []
+        
+        with db_connection() as conn:
+            cur = conn.cursor()
+            audit_ids = _insert_workflow_audits(cur, rows)
+            conn.commit()
+            cur.close()
+        
+        logger.info("📝 Workflow audits created in bulk: %s rows", len(audit_ids))
+        return audit_ids
         
-        if pending_changes and (pending_changes.get("header_changes") or pending_changes.get("line_changes")):
-            logger.info(f"📊 Found pending changes for email: {invoice_number}")
-            return pending_changes
-        else:
-            logger.info(f"ℹ️ No pending changes found for email: {invoice_number}")
-            return None
-            
     except Exception as e:
-        logger.error(f"❌ Error getting pending changes for email: {e}")
+        logger.error("❌ Bulk workflow audit creation failed: %s", e)
         return None
 
-def send_approval_email(invoice_number, invoice_amount, approver_email, approver_name, audit_id, changes=None):
+class AuditGroupCommitter:
     """
-    🔥 ENHANCED: Send approval request email with change diffs from pending changes
+    Background batcher for create_workflow_audit: collects concurrent inserts for a few
+    milliseconds and commits them together, handing each caller its own audit id
     """
-    try:
-        # Email configuration
-        smtp_server = os.getenv('SMTP_SERVER', 'smtp.gmail.com')
-        smtp_port = int(os.getenv('SMTP_PORT', 587))
-        sender_email = os.getenv('SMTP_USER', '')
-        sender_password = os.getenv('SMTP_PASSWORD', '')
-        
-        print(f"🔧 SMTP Configuration:")
-        print(f"   Server: {smtp_server}:{smtp_port}")
-        print(f"   From: {sender_email}")
-        print(f"   To: {approver_email}")
-        print(f"   Password: {'*' * len(sender_password) if sender_password else 'Not set'}")
-        
-        # Validate that we have email credentials
-        if not sender_email or not sender_password:
-            error_msg = "❌ Email credentials not configured"
-            print(error_msg)
-            logger.error(error_msg)
-            return False
-        
-        if 'example.com' in sender_email or 'your-email' in sender_email:
-            error_msg = "❌ Please update SMTP_USER with your actual email address"
-            print(error_msg)
-            logger.error(error_msg)
-            return False
 
-        # 🔥 FIX: Handle both string changes and structured changes
-        email_changes = changes
-        if not email_changes:
-            email_changes = get_pending_changes_for_email(invoice_number)
-            if email_changes:
-                print(f"📧 Using pending changes from history for email content")
-            else:
-                print(f"ℹ️ No pending changes found, using basic email")
-        elif isinstance(email_changes, str):
-            # 🔥 FIX: Convert string changes to proper structure
-            print(f"📧 Converting string changes to structured format")
-            email_changes = {"notes": email_changes}
-        
-        # Ensure email_changes is always a dictionary
-        if not email_changes:
-            email_changes = {"notes": "No changes specified"}
-        elif not isinstance(email_changes, dict):
-            print(f"⚠️ Unexpected changes type: {type(email_changes)}, converting to dict")
-            email_changes = {"notes": str(email_changes)}
-
-        # Create message
-        msg = MIMEMultipart()
-        msg['From'] = sender_email
-        msg['To'] = approver_email
-        
-        # Format amount with commas
-        formatted_amount = f"{invoice_amount:,.2f}"
-        msg['Subject'] = f'APPROVAL REQUIRED: Invoice #{invoice_number} - Amount: ₹{formatted_amount}'
-        
-        # Generate action URLs
-        base_url = "http://127.0.0.1:8000"
-        approve_url = f"{base_url}/api/workflow/action?audit_id={audit_id}&action=approve"
-        reject_url = f"{base_url}/api/workflow/action?audit_id={audit_id}&action=reject"
-        request_edit_url = f"{base_url}/api/workflow/action?audit_id={audit_id}&action=request_edit"
-        
-        # 🔥 ENHANCED: Create HTML email body with change diffs section
-        html_content = generate_approval_email_html(
-            invoice_number=invoice_number,
-            formatted_amount=formatted_amount,
-            audit_id=audit_id,
-            approver_name=approver_name,
-            approver_email=approver_email,
-            approver_level="",  # Will be filled from approver info
-            changes=email_changes,
-            approve_url=approve_url,
-            reject_url=reject_url,
-            request_edit_url=request_edit_url
-        )
-        
-        # Create both HTML and plain text versions
-        msg.attach(MIMEText(html_content, 'html'))
-        
-        # Also include plain text version for email clients that don't support HTML
-        plain_text = generate_approval_email_plain_text(
-            invoice_number=invoice_number,
-            formatted_amount=formatted_amount,
-            audit_id=audit_id,
-            approver_name=approver_name,
-            changes=email_changes,
-            approve_url=approve_url,
-            reject_url=reject_url,
-            request_edit_url=request_edit_url
-        )
-        msg.attach(MIMEText(plain_text, 'plain'))
-        
-        # Send email with detailed error handling
-        print(f"🔗 Connecting to SMTP server: {smtp_server}:{smtp_port}")
-        try:
-            server = smtplib.SMTP(smtp_server, smtp_port, timeout=15)
-            print("✅ Connected to SMTP server")
-        except Exception as e:
-            print(f"❌ Failed to connect to SMTP server: {e}")
-            return False
-            
-        try:
-            server.starttls()
-            print("✅ TLS started")
-        except Exception as e:
-            print(f"❌ Failed to start TLS: {e}")
-            server.quit()
-            return False
-            
-        try:
-            print("🔐 Attempting to login...")
-            server.login(sender_email, sender_password)
-            print("✅ Logged in successfully")
-        except smtplib.SMTPAuthenticationError as e:
-            print(f"❌ SMTP Authentication failed: {e}")
-            print("💡 For Gmail, make sure:")
-            print("   - You're using an App Password (not your regular password)")
-            print("   - 2-Factor Authentication is enabled")
-            print("   - You've generated a 16-character App Password")
-            server.quit()
-            return False
-        except Exception as e:
-            print(f"❌ Login failed: {e}")
-            server.quit()
-            return False
-            
+    def __init__(self, window_ms=5, max_batch=500, result_timeout=30.0):
+        self.window = window_ms / 1000.0
+        self.max_batch = max_batch
+        self.result_timeout = result_timeout
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="workflow-audit-group-commit", daemon=True)
+        self._thread.start()
+
+    def submit(self, row):
+        future = Future()
+        self._queue.put((row, future))
+        return future
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._flush(batch)
+
+        # Drain anything submitted before close()
+        leftover = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                leftover.append(item)
+        if leftover:
+            self._flush(leftover)
+
+    def _flush(self, batch):
         try:
-            print("📤 Sending email...")
-            server.send_message(msg)
-            print("✅ HTML email sent successfully!")
-            server.quit()
-            return True
-        except smtplib.SMTPRecipientsRefused as e:
-            print(f"❌ Recipient refused: {approver_email}")
-            print(f"   Error: {e}")
-            server.quit()
-            return False
-        except smtplib.SMTPException as e:
-            print(f"❌ SMTP error while sending: {e}")
-            server.quit()
-            return False
+            with db_connection() as conn:
+                cur = conn.cursor()
+                audit_ids = _insert_workflow_audits(cur, [row for row, _ in batch])
+                conn.commit()
+                cur.close()
         except Exception as e:
-            print(f"❌ Failed to send email: {e}")
-            server.quit()
-            return False
-        
-    except Exception as e:
-        logger.error(f"❌ Unexpected error in send_approval_email: {e}")
-        print(f"❌ Unexpected error: {e}")
-        return False
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+                return
+            # One bad row must not fail everybody else's insert
+            logger.warning("⚠️ Group audit commit of %s rows failed, retrying individually: %s", len(batch), e)
+            for item in batch:
+                self._flush([item])
+            return
 
-# 🔥 NEW: Function to generate HTML email with change diffs
-def generate_approval_email_html(invoice_number, formatted_amount, audit_id, approver_name, 
-                               approver_email, approver_level, changes, approve_url, 
-                               reject_url, request_edit_url):
-    """
-    Generate HTML email content with change diffs section + Check Invoice button
-    """
-    
-    # Generate the invoice viewing URL
-    base_url = "http://127.0.0.1:8000"  # Your server URL
-    invoice_view_url = f"{base_url}/invoice-view/{invoice_number}"
-    
-    # 🔥 ENHANCED: Generate changes summary HTML if changes exist
-    changes_html = ""
-    if changes and (changes.get("header_changes") or changes.get("line_changes")):
-        changes_html = generate_changes_summary_html(changes)
-    
-    html_content = f"""
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <meta charset="utf-8">
-        <meta name="viewport" content="width=device-width, initial-scale=1.0">
-        <title>Invoice Approval Required</title>
-        <style>
-            body {{
-                font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-                line-height: 1.6;
-                color: #333;
-                max-width: 600px;
-                margin: 0 auto;
-                padding: 20px;
-            }}
-            .header {{
-                background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-                color: white;
-                padding: 20px;
-                border-radius: 10px 10px 0 0;
-                text-align: center;
-            }}
-            .content {{
-                background: #f8f9fa;
-                padding: 25px;
-                border-radius: 0 0 10px 10px;
-            }}
-            .invoice-details {{
-                background: white;
-                padding: 20px;
-                border-radius: 8px;
-                margin: 20px 0;
-                box-shadow: 0 2px 4px rgba(0,0,0,0.1);
-            }}
-            .detail-row {{
-                display: flex;
-                justify-content: space-between;
-                margin-bottom: 8px;
-                padding: 8px 0;
-                border-bottom: 1px solid #eee;
-            }}
-            .detail-label {{
-                font-weight: 600;
-                color: #555;
-            }}
-            .detail-value {{
-                color: #333;
-                font-weight: 500;
-            }}
-            .action-buttons {{
-                text-align: center;
-                margin: 30px 0;
-            }}
-            .btn {{
-                display: inline-block;
-                padding: 12px 24px;
-                margin: 0 10px;
-                border: none;
-                border-radius: 6px;
-                text-decoration: none;
-                font-weight: 600;
-                font-size: 14px;
-                cursor: pointer;
-                transition: all 0.3s ease;
-            }}
-            .btn-approve {{
-                background: #28a745;
-                color: white;
-            }}
-            .btn-reject {{
-                background: #dc3545;
-                color: white;
-            }}
-            .btn-edit {{
-                background: #ffc107;
-                color: #212529;
-            }}
-            .btn-view {{
-                background: #17a2b8;
-                color: white;
-            }}
-            .btn:hover {{
-                transform: translateY(-2px);
-                box-shadow: 0 4px 8px rgba(0,0,0,0.2);
-            }}
-            .footer {{
-                text-align: center;
-                margin-top: 30px;
-                padding-top: 20px;
-                border-top: 1px solid #ddd;
-                color: #666;
-                font-size: 12px;
-            }}
-            .changes-section {{
-                background: #fff3cd;
-                padding: 15px;
-                border-radius: 6px;
-                margin: 15px 0;
-                border-left: 4px solid #ffc107;
-            }}
-            .audit-info {{
-                background: #e7f3ff;
-                padding: 15px;
-                border-radius: 6px;
-                margin: 15px 0;
-                border-left: 4px solid #007bff;
-            }}
-            .view-invoice-section {{
-                background: #d4edda;
-                padding: 15px;
-                border-radius: 6px;
-                margin: 15px 0;
-                border-left: 4px solid #28a745;
-                text-align: center;
-            }}
-            /* 🔥 NEW: Changes table styles */
-            .changes-table {{
-                width: 100%;
-                border-collapse: collapse;
-                margin: 10px 0;
-            }}
-            .changes-table tr {{
-                border-bottom: 1px solid #e9ecef;
-            }}
-            .changes-table td {{
-                padding: 8px;
-                vertical-align: top;
-            }}
-            .change-field {{
-                font-weight: 600;
-                width: 30%;
-                color: #495057;
-            }}
-            .change-arrow {{
-                text-align: center;
-                width: 10%;
-                color: #6c757d;
-                font-weight: bold;
-            }}
-            .change-new {{
-                width: 60%;
-                color: #28a745;
-                font-weight: 500;
-            }}
-            .changes-group {{
-                margin-bottom: 20px;
-            }}
-            .changes-group h4 {{
-                margin: 0 0 10px 0;
-                color: #495057;
-                font-size: 14px;
-            }}
-            .line-change {{
-                margin-bottom: 15px;
-                padding: 10px;
-                background: #f8f9fa;
-                border-radius: 5px;
-                border-left: 3px solid #6c757d;
-            }}
-        </style>
-    </head>
-    <body>
-        <div class="header">
-            <h1>📋 Invoice Approval Required</h1>
-            <p>Your action is needed for the following invoice</p>
-        </div>
-        
-        <div class="content">
-            <div class="invoice-details">
-                <h2>Invoice Details</h2>
-                <div class="detail-row">
-                    <span class="detail-label">Invoice Number:</span>
-                    <span class="detail-value">{invoice_number}</span>
-                </div>
-                <div class="detail-row">
-                    <span class="detail-label">Invoice Amount:</span>
-                    <span class="detail-value">₹{formatted_amount}</span>
-                </div>
-                <div class="detail-row">
-                    <span class="detail-label">Audit ID:</span>
-                    <span class="detail-value">{audit_id}</span>
-                </div>
-                <div class="detail-row">
-                    <span class="detail-label">Submission Date:</span>
-                    <span class="detail-value">{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}</span>
-                </div>
-                <div class="detail-row">
-                    <span class="detail-label">Approver:</span>
-                    <span class="detail-value">{approver_name}</span>
-                </div>
-            </div>
-
-            {changes_html}
-
-
-            <!-- 🔥 NEW: Check Invoice Section -->
-<div class="view-invoice-section">
-    <h3>🔍 Review Invoice Document</h3>
-    <p>View the original invoice PDF/image with all details</p>
-    <a href="{invoice_view_url}" target="_blank" class="btn btn-view">
-        📄 View Invoice Document
-    </a>
-    <p style="margin-top: 10px; font-size: 12px; color: #666;">
-        <em>Opens invoice document directly - no need to search</em>
-    </p>
-</div>
-                
-                <a href="{approve_url}" class="btn btn-approve">✅ Approve</a>
-                <a href="{reject_url}" class="btn btn-reject">❌ Reject</a>
-                <a href="{request_edit_url}" class="btn btn-edit">✏️ Request Edit</a>
-            </div>
-
-            <div class="footer">
-                <p>This is an automated message from the Invoice Approval System.</p>
-                <p>If you believe you received this email in error, please contact the system administrator.</p>
-                <p><small>Audit ID: {audit_id} | Invoice: {invoice_number}</small></p>
-            </div>
-        </div>
-    </body>
-    </html>
-    """
-    
-    return html_content
+        for (_, future), audit_id in zip(batch, audit_ids):
+            future.set_result(audit_id)
 
-# 🔥 NEW: Function to generate changes summary HTML
-def generate_changes_summary_html(changes):
+_audit_committer = None
+_audit_committer_lock = threading.Lock()
+
+def enable_audit_group_commit(window_ms=None, max_batch=None):
     """
-    Generate HTML for the changes summary section
+    Route create_workflow_audit through the background group-commit batcher
     """
-    changes_html = '<div class="changes-section">\n'
-    changes_html += '<h3>📊 CHANGES SUMMARY</h3>\n'
-    
-    # Header changes
-    if changes.get("header_changes"):
-        changes_html += '<div class="changes-group">\n'
-        changes_html += '<h4>📋 Header Changes</h4>\n'
-        changes_html += '<table class="changes-table">\n'
-        
-        for field, change_desc in changes["header_changes"].items():
-            # Format field name for display
-            field_display = field.replace('_', ' ').title()
-            changes_html += f'''
-            <tr>
-                <td class="change-field">{field_display}</td>
-                <td class="change-arrow">→</td>
-                <td class="change-new">{change_desc}</td>
-            </tr>
-            '''
-        
-        changes_html += '</table>\n'
-        changes_html += '</div>\n'
-    
-    # Line changes
-    if changes.get("line_changes"):
-        changes_html += '<div class="changes-group">\n'
-        changes_html += '<h4>📝 Line Item Changes</h4>\n'
-        
-        for line_num, line_changes in changes["line_changes"].items():
-            changes_html += f'<div class="line-change">\n'
-            changes_html += f'<strong>Line {line_num}:</strong>\n'
-            changes_html += '<table class="changes-table">\n'
-            
-            for field, change_desc in line_changes.items():
-                field_display = field.replace('_', ' ').title()
-                changes_html += f'''
-                <tr>
-                    <td class="change-field">{field_display}</td>
-                    <td class="change-arrow">→</td>
-                    <td class="change-new">{change_desc}</td>
-                </tr>
-                '''
-            
-            changes_html += '</table>\n'
-            changes_html += '</div>\n'
-        
-        changes_html += '</div>\n'
-    
-    changes_html += '</div>\n'
-    return changes_html
+    global _audit_committer
+    with _audit_committer_lock:
+        if _audit_committer is None:
+            _audit_committer = AuditGroupCommitter(
+                window_ms=float(window_ms if window_ms is not None else os.getenv('WORKFLOW_AUDIT_BATCH_WINDOW_MS', 5)),
+                max_batch=int(max_batch if max_batch is not None else os.getenv('WORKFLOW_AUDIT_BATCH_MAX', 500)),
+            )
+        return _audit_committer
 
-# 🔥 NEW: Function to generate plain text email with change diffs
-def generate_approval_email_plain_text(invoice_number, formatted_amount, audit_id, approver_name, 
-                                     changes, approve_url, reject_url, request_edit_url):
+def disable_audit_group_commit():
     """
-    Generate plain text email content with change diffs
+    Flush pending grouped inserts and go back to one commit per call
     """
-    
-    # 🔥 ENHANCED: Generate changes summary for plain text
-    changes_text = ""
-    if changes and (changes.get("header_changes") or changes.get("line_changes")):
-        changes_text = generate_changes_summary_plain_text(changes)
-    
-    plain_text = f"""
-INVOICE APPROVAL REQUEST
+    global _audit_committer
+    with _audit_committer_lock:
+        committer, _audit_committer = _audit_committer, None
+    if committer is not None:
+        committer.close()
 
-Dear {approver_name},
+# 🔥 NEW: Compiled approval rules. Rules route on supplier, cost centre, currency and
+# amount together. They compile into a hash map keyed by the non-wildcard dimensions,
+# each holding a threshold table searched with bisect, so a lookup is at most eight
+# dict probes plus a binary search. route_batch() does the same for whole arrays
+# with NumPy when it is installed.
 
-An invoice requires your approval:
+# Most specific first: supplier beats cost centre beats currency; None is a wildcard
+APPROVAL_RULE_DIMENSIONS = ("supplier", "cost_centre", "currency")
+_RULE_PATTERNS = tuple(itertools.product((True, False), repeat=len(APPROVAL_RULE_DIMENSIONS)))
 
-Invoice Number: {invoice_number}
-Invoice Amount: ₹{formatted_amount}
-Audit ID: {audit_id}
-Submission Date: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+APPROVAL_RULES_DDL = """
+CREATE TABLE IF NOT EXISTS "DocAI".approval_rules (
+    id              bigserial PRIMARY KEY,
+    supplier        text,
+    cost_centre     text,
+    currency        text,
+    min_amount      numeric,
+    max_amount      numeric,
+    level_name      text NOT NULL,
+    approver_name   text NOT NULL,
+    approver_email  text NOT NULL,
+    active          boolean NOT NULL DEFAULT true
+);
+"""
 
-{changes_text if changes_text else "No specific changes mentioned."}
+_numpy = _LazyModule("numpy")
 
-Please take action using one of these links:
+# Per-dimension normalisation, in APPROVAL_RULE_DIMENSIONS order
+_RULE_NORMALIZERS = (
+    lambda value: str(value).strip().casefold(),
+    lambda value: str(value).strip().upper(),
+    lambda value: str(value).strip().upper(),
+)
 
-✅ APPROVE: {approve_url}
-❌ REJECT: {reject_url}
-✏️ REQUEST EDIT: {request_edit_url}
+def _normalize_rule_value(dim, value):
+    if value is None:
+        return None
+    return _RULE_NORMALIZERS[dim](value) or None
 
-Thank you,
-Invoice Approval System
-"""
-    return plain_text
+def _normalize_rule_key(supplier=None, cost_centre=None, currency=None):
+    return tuple(_normalize_rule_value(dim, value) for dim, value in enumerate((supplier, cost_centre, currency)))
 
-# 🔥 NEW: Function to generate plain text changes summary
-def generate_changes_summary_plain_text(changes):
+class _ThresholdTable:
     """
-    Generate plain text for the changes summary section
+    Amount ranges for one dimension key; first range by min_amount containing the amount wins
     """
-    changes_text = "CHANGES SUMMARY:\n\n"
-    
-    # Header changes
-    if changes.get("header_changes"):
-        changes_text += "Header Changes:\n"
-        changes_text += "-" * 40 + "\n"
-        
-        for field, change_desc in changes["header_changes"].items():
-            field_display = field.replace('_', ' ').title()
-            changes_text += f"  {field_display}: {change_desc}\n"
-        
-        changes_text += "\n"
-    
-    # Line changes
-    if changes.get("line_changes"):
-        changes_text += "Line Item Changes:\n"
-        changes_text += "-" * 40 + "\n"
-        
-        for line_num, line_changes in changes["line_changes"].items():
-            changes_text += f"Line {line_num}:\n"
-            
-            for field, change_desc in line_changes.items():
-                field_display = field.replace('_', ' ').title()
-                changes_text += f"  {field_display}: {change_desc}\n"
-            
-            changes_text += "\n"
-    
-    return changes_text
 
-def send_action_notification_email(invoice_number, action, notes, recipient_email):
+    def __init__(self, entries):
+        entries = sorted(entries, key=lambda entry: entry[0])
+        self.min_amounts = [entry[0] for entry in entries]
+        self.rule_ids = [entry[2] for entry in entries]
+        self.prefix_max = []
+        running = None
+        for _, max_amount, _ in entries:
+            running = max_amount if running is None else max(running, max_amount)
+            self.prefix_max.append(running)
+        self._arrays = None
+
+    def find(self, amount):
+        candidates = bisect.bisect_right(self.min_amounts, amount)
+        first = bisect.bisect_left(self.prefix_max, amount, 0, candidates)
+        return self.rule_ids[first] if first < candidates else None
+
+    def arrays(self):
+        if self._arrays is None:
+            np = _numpy
+            self._arrays = (
+                np.array([float(v) for v in self.min_amounts]),
+                np.array([float(v) for v in self.prefix_max]),
+                np.array(self.rule_ids, dtype=np.int64),
+            )
+        return self._arrays
+
+class ApprovalRulesEngine:
     """
-    Send notification email back to the requester with HTML formatting
+    Rules are dicts with optional supplier / cost_centre / currency (None = any),
+    optional min_amount / max_amount (inclusive, None = unbounded) and level_name,
+    approver_name, approver_email.
     """
-    try:
-        smtp_server = os.getenv('SMTP_SERVER', 'smtp.gmail.com')
-        smtp_port = int(os.getenv('SMTP_PORT', 587))
-        sender_email = os.getenv('SMTP_USER', '')
-        sender_password = os.getenv('SMTP_PASSWORD', '')
-        
-        msg = MIMEMultipart()
-        msg['From'] = sender_email
-        msg['To'] = recipient_email
-        
-        action_display = {
-            'approve': {'text': '✅ APPROVED', 'color': '#28a745'},
-            'reject': {'text': '❌ REJECTED', 'color': '#dc3545'}, 
-            'request_edit': {'text': '✏️ EDIT REQUESTED', 'color': '#ffc107'}
-        }
-        
-        action_info = action_display.get(action, {'text': action.upper(), 'color': '#6c757d'})
-        
-        msg['Subject'] = f'Update: Invoice #{invoice_number} - {action_info["text"]}'
-        
-        html_content = f"""
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <meta charset="utf-8">
-            <style>
-                body {{
-                    font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-                    line-height: 1.6;
-                    color: #333;
-                    max-width: 600px;
-                    margin: 0 auto;
-                    padding: 20px;
-                }}
-                .header {{
-                    background: {action_info['color']};
-                    color: white;
-                    padding: 20px;
-                    border-radius: 10px;
-                    text-align: center;
-                }}
-                .content {{
-                    background: #f8f9fa;
-                    padding: 25px;
-                    border-radius: 10px;
-                    margin-top: 20px;
-                }}
-                .status-badge {{
-                    display: inline-block;
-                    background: {action_info['color']};
-                    color: white;
-                    padding: 10px 20px;
-                    border-radius: 20px;
-                    font-weight: bold;
-                    margin: 10px 0;
-                }}
-                .notes-section {{
-                    background: white;
-                    padding: 15px;
-                    border-radius: 8px;
-                    margin: 15px 0;
-                    border-left: 4px solid {action_info['color']};
-                }}
-            </style>
-        </head>
-        <body>
-            <div class="header">
-                <h1>Invoice Status Update</h1>
-                <p>Your invoice has been processed</p>
-            </div>
-            
-            <div class="content">
-                <h2>Invoice #{invoice_number}</h2>
-                <div class="status-badge">{action_info['text']}</div>
-                
-                <div class="notes-section">
-                    <h3>📝 Notes from Approver:</h3>
-                    <p>{notes if notes else 'No additional notes provided.'}</p>
-                </div>
-                
-                <p><strong>Next Steps:</strong></p>
-                <ul>
-                    <li>If approved: Invoice will proceed to payment processing</li>
-                    <li>If rejected: Please review and resubmit with corrections</li>
-                    <li>If edit requested: Please make the requested changes and resubmit</li>
-                </ul>
-                
-                <div style="margin-top: 30px; padding-top: 20px; border-top: 1px solid #ddd; color: #666; font-size: 12px;">
-                    <p>This is an automated notification from the Invoice Approval System.</p>
-                </div>
-            </div>
-        </body>
-        </html>
+
+    def __init__(self, rules):
+        self._results = []
+        grouped = {}
+        for rule in rules:
+            key = _normalize_rule_key(rule.get("supplier"), rule.get("cost_centre"), rule.get("currency"))
+            min_amount = rule.get("min_amount")
+            max_amount = rule.get("max_amount")
+            entry = (
+                Decimal(str(min_amount)) if min_amount is not None else Decimal("-Infinity"),
+                Decimal(str(max_amount)) if max_amount is not None else Decimal("Infinity"),
+                len(self._results),
+            )
+            self._results.append((rule["level_name"], rule["approver_name"], rule["approver_email"]))
+            grouped.setdefault(key, []).append(entry)
+        self._tables = {key: _ThresholdTable(entries) for key, entries in grouped.items()}
+        # Only probe the wildcard shapes some rule actually uses
+        shapes = {tuple(value is not None for value in key) for key in self._tables}
+        self._patterns = tuple(pattern for pattern in _RULE_PATTERNS if pattern in shapes)
+
+    def __len__(self):
+        return len(self._results)
+
+    def _find(self, amount, key):
+        for pattern in self._patterns:
+            if any(use and value is None for value, use in zip(key, pattern)):
+                continue
+            table = self._tables.get(tuple(value if use else None for value, use in zip(key, pattern)))
+            if table is not None:
+                rule_id = table.find(amount)
+                if rule_id is not None:
+                    return rule_id
+        return None
+
+    def route(self, amount, supplier=None, currency=None, cost_centre=None):
         """
+        (level_name, approver_name, approver_email) for one invoice, or None
+        """
+        rule_id = self._find(Decimal(str(amount)), _normalize_rule_key(supplier, cost_centre, currency))
+        return self._results[rule_id] if rule_id is not None else None
+
+    def lookup(self, amount, supplier=None, currency=None, cost_centre=None):
+        """
+        Same as route() in the dict shape check_approval_workflow returns
+        """
+        result = self.route(amount, supplier, currency, cost_centre)
+        if result is None:
+            return None
+        return {"level_name": result[0], "approver_name": result[1], "approver_email": result[2]}
+
+    def route_batch(self, amounts, suppliers=None, currencies=None, cost_centres=None):
+        """
+        Route many invoices at once; the dimension arguments are sequences parallel to
+        `amounts` (or None for "not given"). Returns a list of route() results.
+        Uses NumPy when available (amounts compared as float64), else routes one by one.
+        """
+        amounts = list(amounts)
+        n = len(amounts)
+        columns = [
+            list(values) if values is not None else [None] * n
+            for values in (suppliers, cost_centres, currencies)
+        ]
+        try:
+            np = _numpy._load()
+        except ImportError:
+            np = None
+        if np is None or not self._patterns:
+            return [
+                self.route(amount, supplier, currency, cost_centre)
+                for amount, supplier, cost_centre, currency in zip(amounts, *columns)
+            ]
         
-        msg.attach(MIMEText(html_content, 'html'))
-        
-        # Plain text fallback
-        plain_text = f"""
-        Your invoice has been processed:
-        
-        Invoice Number: {invoice_number}
-        Status: {action_info['text']}
-        
-        Notes from approver:
-        {notes if notes else 'No additional notes provided.'}
+        # Factorize each dimension: 0 = value no rule mentions, 1 = wildcard, 2.. = known value
+        codes = []
+        vocabularies = []
+        for dim in range(len(APPROVAL_RULE_DIMENSIONS)):
+            vocabulary = {}
+            for key in self._tables:
+                if key[dim] is not None:
+                    vocabulary.setdefault(key[dim], len(vocabulary) + 2)
+            vocabularies.append(vocabulary)
+            codes.append(np.fromiter(
+                (vocabulary.get(_normalize_rule_value(dim, value), 0) for value in columns[dim]),
+                dtype=np.int64, count=n,
+            ))
+        radix = [len(vocabulary) + 2 for vocabulary in vocabularies]
         
-        Thank you,
-        Invoice Approval System
-        """
-        msg.attach(MIMEText(plain_text, 'plain'))
+        def combine(parts):
+            return (parts[0] * radix[1] + parts[1]) * radix[2] + parts[2]
         
-        with smtplib.SMTP(smtp_server, smtp_port) as server:
-            server.starttls()
-            server.login(sender_email, sender_password)
-            server.send_message(msg)
+        table_codes = {}
+        for key, table in self._tables.items():
+            parts = [vocabularies[dim][key[dim]] if key[dim] is not None else 1 for dim in range(3)]
+            table_codes[combine(parts)] = table
         
-        logger.info(f"📧 HTML notification email sent to {recipient_email}")
-        return True
+        values = np.array([float(amount) for amount in amounts], dtype=np.float64)
+        result = np.full(n, -1, dtype=np.int64)
+        for pattern in self._patterns:
+            pending = np.flatnonzero(result < 0)
+            if not pending.size:
+                break
+            parts = [codes[dim][pending] if pattern[dim] else 1 for dim in range(3)]
+            # An unknown value can never satisfy a non-wildcard dimension
+            usable = np.ones(pending.size, dtype=bool)
+            for dim in range(3):
+                if pattern[dim]:
+                    usable &= codes[dim][pending] > 1
+            keys = combine(parts) if any(pattern) else np.full(pending.size, combine([1, 1, 1]), dtype=np.int64)
+            for code in np.unique(keys[usable]):
+                table = table_codes.get(int(code))
+                if table is None:
+                    continue
+                rows = pending[usable & (keys == code)]
+                min_amounts, prefix_max, rule_ids = table.arrays()
+                subset = values[rows]
+                candidates = np.searchsorted(min_amounts, subset, side="right")
+                first = np.searchsorted(prefix_max, subset, side="left")
+                hit = first < candidates
+                result[rows[hit]] = rule_ids[first[hit]]
+        
+        results = self._results
+        return [results[rule_id] if rule_id >= 0 else None for rule_id in result.tolist()]
+
+# Last-resort approvers for amounts neither the rules table nor the hierarchy covers.
+# WORKFLOW_FALLBACK_APPROVAL_RULES holds a JSON list of rules (inline or a file path),
+# e.g. [{"max_amount": 5000, "level_name": "L1", "approver_name": ..., "approver_email": ...}].
+# There is no built-in fallback: without configuration an unrouted invoice fails.
+_fallback_approval_rules = {"engine": None}
+
+def _load_fallback_approval_rules():
+    raw = os.getenv('WORKFLOW_FALLBACK_APPROVAL_RULES', '').strip()
+    if not raw:
+        return ()
+    if not raw.startswith("["):
+        with open(raw, encoding="utf-8") as f:
+            raw = f.read()
+    return json.loads(raw)
+
+def configure_fallback_approval_rules(rules=None):
+    """
+    Replace the fallback approvers (None re-reads WORKFLOW_FALLBACK_APPROVAL_RULES)
+    """
+    engine = ApprovalRulesEngine(rules if rules is not None else _load_fallback_approval_rules())
+    _fallback_approval_rules["engine"] = engine
+    return engine
+
+def get_temporary_approver(invoice_amount):
+    """
+    Fallback (level_name, approver_name, approver_email) when approval_hierarchy has no
+    match, or None when no fallback rule covers the amount
+    """
+    engine = _fallback_approval_rules["engine"]
+    if engine is None:
+        try:
+            engine = configure_fallback_approval_rules()
+        except Exception as e:
+            logger.error("❌ Invalid WORKFLOW_FALLBACK_APPROVAL_RULES, no fallback approvers: %s", e)
+            engine = configure_fallback_approval_rules(())
+    return engine.route(invoice_amount)
+
+_approval_rules = {"engine": None, "loaded_at": None}
+_approval_rules_lock = threading.Lock()
+_approval_rules_table_available = True
+
+def ensure_approval_rules_table():
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(APPROVAL_RULES_DDL)
+        conn.commit()
+        cur.close()
+    invalidate_approval_rules()
+
+def invalidate_approval_rules():
+    global _approval_rules_table_available
+    _approval_rules_table_available = True
+    _approval_rules["loaded_at"] = None
+
+def get_approval_rules_engine():
+    """
+    Compiled rules from "DocAI".approval_rules, reloaded every WORKFLOW_RULES_TTL seconds.
+    Empty when the table does not exist, so routing falls through to the hierarchy.
+    """
+    global _approval_rules_table_available
+    ttl = float(os.getenv('WORKFLOW_RULES_TTL', 300))
+    loaded_at = _approval_rules["loaded_at"]
+    if loaded_at is not None and time.monotonic() - loaded_at <= ttl:
+        return _approval_rules["engine"]
+    
+    with _approval_rules_lock:
+        loaded_at = _approval_rules["loaded_at"]
+        if loaded_at is not None and time.monotonic() - loaded_at <= ttl:
+            return _approval_rules["engine"]
+        rules = []
+        if _approval_rules_table_available:
+            try:
+                with db_connection() as conn:
+                    cur = conn.cursor(cursor_factory=_psycopg2_extras.RealDictCursor)
+                    cur.execute("""
+                        SELECT supplier, cost_centre, currency, min_amount, max_amount,
+                               level_name, approver_name, approver_email
+                        FROM "DocAI".approval_rules
+                        WHERE active
+                    """)
+                    rules = cur.fetchall()
+                    cur.close()
+            except Exception as e:
+                if getattr(e, 'pgcode', None) == '42P01':
+                    _approval_rules_table_available = False
+                    logger.info("ℹ️ \"DocAI\".approval_rules not found, routing on the approval hierarchy only")
+                elif _approval_rules["engine"] is not None:
+                    logger.warning("⚠️ Approval rules reload failed, keeping previous rules: %s", e)
+                    _approval_rules["loaded_at"] = time.monotonic()
+                    return _approval_rules["engine"]
+                else:
+                    logger.warning("⚠️ Could not load approval rules: %s", e)
+        engine = ApprovalRulesEngine(rules)
+        _approval_rules["engine"] = engine
+        _approval_rules["loaded_at"] = time.monotonic()
+        if len(engine):
+            logger.info("📚 Approval rules compiled (%s rules)", len(engine))
+        return engine
+
+def route_approvals_batch(invoices):
+    """
+    Route many invoices in memory. `invoices` are dicts with amount and optional
+    supplier / currency / cost_centre. Dimension rules are tried first, then the
+    amount-only hierarchy snapshot; returns a parallel list of
+    {level_name, approver_name, approver_email} dicts (None where nothing matched).
+    """
+    invoices = list(invoices)
+    routed = get_approval_rules_engine().route_batch(
+        [invoice["amount"] for invoice in invoices],
+        suppliers=[invoice.get("supplier") for invoice in invoices],
+        currencies=[invoice.get("currency") for invoice in invoices],
+        cost_centres=[invoice.get("cost_centre") for invoice in invoices],
+    )
+    hierarchy = get_approval_hierarchy()
+    results = []
+    for invoice, route in zip(invoices, routed):
+        if route is not None:
+            results.append({"level_name": route[0], "approver_name": route[1], "approver_email": route[2]})
+        else:
+            results.append(hierarchy.lookup(invoice["amount"]))
+    return results
+
+# 🔥 NEW: Materiality-based triggering. Policies come from WORKFLOW_MATERIALITY (JSON,
+# inline or a file path) and are compiled once, e.g.
+#   {"abs": 100, "pct": 1.0, "combine": "any",
+#    "fields": {"unit_price": {"pct": 0.5}, "quantity": "any", "*": "ignore"},
+#    "suppliers": {"Acme Ltd": {"abs": 1000}}}
+# A change is material when the amount moves by at least `abs` and/or `pct` percent
+# ("combine": "any" or "all"; without either, any amount change), or when a line/header
+# field change satisfies its rule. Without configuration every non-null amount triggers,
+# as before. Evaluation is in-process only: the decision uses what the caller passes
+# (the prior amount may also come from the amount diff in `changes`), and whenever the
+# prior amount is unknown or the policy cannot be evaluated the workflow triggers.
+
+# Header fields whose "old → new" diff carries the invoice amount
+INVOICE_AMOUNT_FIELDS = ("invoice_amount", "total_amount", "amount")
+
+def _parse_change_pair(change):
+    """
+    Split an "old → new" change string into two Decimals; None if either side is not numeric
+    """
+    if not isinstance(change, str):
+        return None
+    for arrow in ("→", "->"):
+        if arrow in change:
+            old, _, new = change.partition(arrow)
+            try:
+                return Decimal(old.strip().replace(",", "")), Decimal(new.strip().replace(",", ""))
+            except (ArithmeticError, ValueError):
+                return None
+    return None
+
+def _change_is_material(old, new, abs_threshold, pct_threshold, combine_all):
+    delta = abs(new - old)
+    if delta == 0:
+        return False
+    checks = []
+    if abs_threshold is not None:
+        checks.append(delta >= abs_threshold)
+    if pct_threshold is not None:
+        checks.append(old == 0 or delta * 100 / abs(old) >= pct_threshold)
+    if not checks:
+        return True
+    return all(checks) if combine_all else any(checks)
+
+class MaterialityPolicy:
+    """
+    Compiled thresholds for the invoice amount plus per-field rules for line/header changes.
+    Field rules are "any" (any change is material), "ignore", or {"abs": x, "pct": y}.
+    """
+
+    def __init__(self, config=None):
+        config = config or {}
+        self.abs_threshold = Decimal(str(config["abs"])) if config.get("abs") is not None else None
+        self.pct_threshold = Decimal(str(config["pct"])) if config.get("pct") is not None else None
+        self.combine_all = config.get("combine", "any") == "all"
+        self.field_rules = {}
+        for field, rule in (config.get("fields") or {}).items():
+            self.field_rules[field] = self._compile_field_rule(rule)
+        self.default_field_rule = self.field_rules.pop("*", None) or ("ignore", None, None)
+        self.configured = bool(config)
+
+    @staticmethod
+    def _compile_field_rule(rule):
+        if rule in ("any", "ignore"):
+            return (rule, None, None)
+        if not isinstance(rule, dict):
+            raise ValueError(f"Unsupported materiality field rule: {rule!r}")
+        return (
+            "threshold",
+            Decimal(str(rule["abs"])) if rule.get("abs") is not None else None,
+            Decimal(str(rule["pct"])) if rule.get("pct") is not None else None,
+        )
+
+    def _field_is_material(self, field, change):
+        kind, abs_threshold, pct_threshold = self.field_rules.get(field, self.default_field_rule)
+        if kind == "ignore":
+            return False
+        if kind == "any":
+            return True
+        pair = _parse_change_pair(change)
+        if pair is None:
+            # Not numeric: any actual change counts
+            return True
+        return _change_is_material(pair[0], pair[1], abs_threshold, pct_threshold, self.combine_all)
+
+    def evaluate(self, original_amount, changed_amount, changes=None):
+        """
+        Returns (trigger, reason)
+        """
+        changed = Decimal(str(changed_amount))
+        if not self.configured:
+            return True, "unconditional"
+        if original_amount is None:
+            return True, "no_original_amount"
+        
+        # The amount rule always applies; a policy with only field rules treats any amount change as material
+        original = Decimal(str(original_amount))
+        if _change_is_material(original, changed, self.abs_threshold, self.pct_threshold, self.combine_all):
+            return True, "amount"
+        
+        if isinstance(changes, dict):
+            for field, change in (changes.get("header_changes") or {}).items():
+                if self._field_is_material(field, change):
+                    return True, f"field:{field}"
+            for line_fields in (changes.get("line_changes") or {}).values():
+                if not isinstance(line_fields, dict):
+                    continue
+                for field, change in line_fields.items():
+                    if self._field_is_material(field, change):
+                        return True, f"field:{field}"
+        return False, "immaterial"
+
+class MaterialityPolicies:
+    """
+    Default policy plus per-supplier overrides (override keys replace the default's,
+    "fields" are merged field by field)
+    """
+
+    def __init__(self, config=None):
+        config = dict(config or {})
+        suppliers = config.pop("suppliers", None) or {}
+        self.default = MaterialityPolicy(config)
+        self.by_supplier = {}
+        for supplier, override in suppliers.items():
+            merged = dict(config, **{k: v for k, v in override.items() if k != "fields"})
+            merged["fields"] = dict(config.get("fields") or {}, **(override.get("fields") or {}))
+            self.by_supplier[_normalize_rule_value(0, supplier)] = MaterialityPolicy(merged)
+
+    def policy_for(self, supplier_name=None):
+        if supplier_name is not None and self.by_supplier:
+            return self.by_supplier.get(_normalize_rule_value(0, supplier_name), self.default)
+        return self.default
+
+    def evaluate(self, original_amount, changed_amount, supplier_name=None, changes=None):
+        return self.policy_for(supplier_name).evaluate(original_amount, changed_amount, changes)
+
+_materiality = {"policies": None}
+_materiality_lock = threading.Lock()
+_materiality_counters = {"triggered": 0, "skipped": 0}
+
+def _load_materiality_config():
+    raw = os.getenv('WORKFLOW_MATERIALITY', '').strip()
+    if not raw:
+        return None
+    if not raw.startswith("{"):
+        with open(raw, encoding="utf-8") as f:
+            raw = f.read()
+    return json.loads(raw)
+
+def configure_materiality(config=None):
+    """
+    Replace the trigger policies (None re-reads WORKFLOW_MATERIALITY)
+    """
+    policies = MaterialityPolicies(config if config is not None else _load_materiality_config())
+    _materiality["policies"] = policies
+    return policies
+
+def get_materiality_policies():
+    policies = _materiality["policies"]
+    if policies is None:
+        with _materiality_lock:
+            policies = _materiality["policies"]
+            if policies is None:
+                try:
+                    policies = configure_materiality()
+                except Exception as e:
+                    # A broken policy must not silently stop approvals
+                    logger.error("❌ Invalid WORKFLOW_MATERIALITY, triggering every workflow: %s", e)
+                    policies = configure_materiality({})
+    return policies
+
+def _record_trigger_decision(trigger, reason):
+    name = "triggered" if trigger else "skipped"
+    with _materiality_lock:
+        _materiality_counters[name] += 1
+    _workflow_metrics.increment("materiality_decisions", decision=name, reason=reason.split(":", 1)[0])
+
+def get_materiality_stats():
+    with _materiality_lock:
+        return dict(_materiality_counters)
+
+def _prior_amount_from_changes(changes):
+    header_changes = (changes or {}).get("header_changes") or {}
+    for field in INVOICE_AMOUNT_FIELDS:
+        pair = _parse_change_pair(header_changes.get(field))
+        if pair is not None:
+            return pair[0]
+    return None
+
+def _evaluate_materiality(policies, invoice_amount, invoice_number, original_amount, supplier_name, changes):
+    try:
+        if original_amount is None:
+            original_amount = _prior_amount_from_changes(changes)
+        return policies.policy_for(supplier_name).evaluate(original_amount, invoice_amount, changes)
+    except (ArithmeticError, ValueError, TypeError, AttributeError) as e:
+        # Fail open: an approval that should not have been asked for beats a missed one
+        logger.warning("⚠️ Could not evaluate materiality for %s, triggering the workflow: %s", invoice_number, e)
+        return True, "error"
+
+def should_trigger_workflow(invoice_amount, invoice_number, original_amount=None, supplier_name=None, changes=None):
+    """
+    Decide whether a change needs an approval workflow, in-process (no DB or unifycode calls).
+    Immaterial changes (per the configured policies) skip the audit row and the email.
+    Without a prior amount (from `original_amount` or the amount diff in `changes`) it triggers.
+    """
+    if invoice_amount is None:
+        return False
+    
+    trigger, reason = _evaluate_materiality(get_materiality_policies(), invoice_amount, invoice_number,
+                                            original_amount, supplier_name, changes)
+    _record_trigger_decision(trigger, reason)
+    if not trigger:
+        logger.info("⏭️ Workflow skipped for %s: change is immaterial", invoice_number)
+    return trigger
+
+def should_trigger_workflow_batch(items):
+    """
+    Batch form for bulk edits. `items` are dicts with invoice_number, changed_amount and
+    optional original_amount, supplier_name, changes. Returns a parallel list of booleans.
+    """
+    policies = get_materiality_policies()
+    decisions = []
+    for item in items:
+        amount = item.get("changed_amount")
+        if amount is None:
+            decisions.append(False)
+            continue
+        trigger, reason = _evaluate_materiality(policies, amount, item.get("invoice_number"), item.get("original_amount"),
+                                                item.get("supplier_name"), item.get("changes"))
+        _record_trigger_decision(trigger, reason)
+        decisions.append(trigger)
+    
+    skipped = decisions.count(False)
+    if skipped:
+        logger.info("⏭️ Materiality: %s workflows triggered, %s skipped", len(decisions) - skipped, skipped)
+    return decisions
+
+# 🔥 ENHANCED: Function to get pending changes for email content
+# Results are cached per invoice and history version, so an invoice that was already
+# summarized is not fetched again while its history is unchanged. Without a version
+# there is no way to tell a stale diff from a fresh one, so nothing is cached.
+# Batches can read the history tables directly, one query for header changes and one
+# for line changes whatever the number of invoices. Those tables belong to unifycode,
+# so this is opt-in: WORKFLOW_HISTORY_SCHEMA (JSON, inline or a file path) names the
+# tables and columns, e.g.
+#   {"header_table": "DocAI.invoice_header_history", "line_table": "DocAI.invoice_line_history",
+#    "invoice_column": "invoice_number", "line_column": "line_number", "field_column": "field_name",
+#    "old_column": "old_value", "new_column": "new_value", "order_column": "changed_at",
+#    "status_column": "status", "pending_statuses": ["draft", "pending"]}
+# status_column/pending_statuses and a tie-breaking id_column are optional. Without it
+# every invoice goes through get_pending_changes_from_history, as single lookups do.
+
+HISTORY_SCHEMA_REQUIRED = ("header_table", "line_table", "invoice_column", "line_column", "field_column",
+                           "old_column", "new_column", "order_column")
+
+def _quote_identifier(name):
+    """
+    "schema.table" or "column" as a quoted SQL identifier
+    """
+    if not isinstance(name, str) or not name.strip():
+        raise ValueError(f"invalid identifier: {name!r}")
+    return ".".join('"' + part.strip().replace('"', '""') + '"' for part in name.split("."))
+
+def _history_changes_sql(config, table, line_column=None):
+    q = {key: _quote_identifier(config[key]) for key in HISTORY_SCHEMA_REQUIRED}
+    tiebreak = f", {_quote_identifier(config['id_column'])}" if config.get("id_column") else ""
+    tiebreak_desc = f", {_quote_identifier(config['id_column'])} DESC" if config.get("id_column") else ""
+    keys = f"{q['invoice_column']}, {q['line_column']}, " if line_column else f"{q['invoice_column']}, "
+    where = f"{q['invoice_column']} = ANY(%s)"
+    if config.get("status_column"):
+        where += f" AND {_quote_identifier(config['status_column'])} = ANY(%s)"
+    return f"""
+    SELECT {keys}{q['field_column']},
+           (array_agg({q['old_column']} ORDER BY {q['order_column']}{tiebreak}))[1] AS old_value,
+           (array_agg({q['new_column']} ORDER BY {q['order_column']} DESC{tiebreak_desc}))[1] AS new_value
+    FROM {q[table]}
+    WHERE {where}
+    GROUP BY {keys}{q['field_column']}
+    ORDER BY {keys.rstrip(', ')}
+"""
+
+class HistorySchema:
+    """
+    Batched pending-changes queries compiled from a WORKFLOW_HISTORY_SCHEMA mapping
+    """
+
+    def __init__(self, config):
+        missing = [key for key in HISTORY_SCHEMA_REQUIRED if not config.get(key)]
+        if missing:
+            raise ValueError(f"missing {', '.join(missing)}")
+        self.header_sql = _history_changes_sql(config, "header_table")
+        self.line_sql = _history_changes_sql(config, "line_table", line_column=True)
+        if config.get("status_column"):
+            self.params = (list(config.get("pending_statuses") or ["draft", "pending"]),)
+        else:
+            self.params = ()
+
+_history_schema = {"schema": None, "loaded": False}
+
+def _load_history_schema_config():
+    raw = os.getenv('WORKFLOW_HISTORY_SCHEMA', '').strip()
+    if not raw:
+        return None
+    if not raw.startswith("{"):
+        with open(raw, encoding="utf-8") as f:
+            raw = f.read()
+    return json.loads(raw)
+
+def configure_history_schema(config=None):
+    """
+    Describe the history tables for batched reads (None re-reads WORKFLOW_HISTORY_SCHEMA;
+    an empty mapping turns batched reads off)
+    """
+    global _history_batch_available
+    if config is None:
+        config = _load_history_schema_config()
+    schema = HistorySchema(config) if config else None
+    _history_schema.update(schema=schema, loaded=True)
+    _history_batch_available = True
+    return schema
+
+def get_history_schema():
+    if not _history_schema["loaded"]:
+        try:
+            configure_history_schema()
+        except Exception as e:
+            logger.error("❌ Invalid WORKFLOW_HISTORY_SCHEMA, loading pending changes per invoice: %s", e)
+            _history_schema.update(schema=None, loaded=True)
+    return _history_schema["schema"]
+
+_pending_changes_cache = _BoundedCache(int(os.getenv('WORKFLOW_PENDING_CHANGES_CACHE_SIZE', 2048)))
+_history_batch_available = True
+
+def _cached_pending_changes(invoice_number, version):
+    if version is None:
+        return False, None
+    entry = _pending_changes_cache.get(invoice_number)
+    if entry is None or entry[0] != version:
+        return False, None
+    return True, entry[1]
+
+def _has_pending_changes(pending_changes):
+    return bool(pending_changes and (pending_changes.get("header_changes") or pending_changes.get("line_changes")))
+
+def _format_history_change(old_value, new_value):
+    return f"{'' if old_value is None else old_value} → {'' if new_value is None else new_value}"
+
+def _fetch_pending_changes_batch(schema, invoice_numbers):
+    """
+    Pending header and line changes for many invoices in two queries, shaped like
+    unifycode's get_pending_changes_from_history: {invoice_number: {"header_changes":
+    {field: "old → new"}, "line_changes": {line_number: {field: "old → new"}}}}
+    """
+    fetched = {invoice_number: {"header_changes": {}, "line_changes": {}} for invoice_number in invoice_numbers}
+    params = (list(invoice_numbers),) + schema.params
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(schema.header_sql, params)
+        for invoice_number, field, old_value, new_value in cur.fetchall():
+            if old_value != new_value:
+                fetched[invoice_number]["header_changes"][field] = _format_history_change(old_value, new_value)
+        cur.execute(schema.line_sql, params)
+        for invoice_number, line_number, field, old_value, new_value in cur.fetchall():
+            if old_value != new_value:
+                line = fetched[invoice_number]["line_changes"].setdefault(line_number, {})
+                line[field] = _format_history_change(old_value, new_value)
+        cur.close()
+    return fetched
+
+def _load_pending_changes(invoice_numbers):
+    global _history_batch_available
+    schema = get_history_schema() if len(invoice_numbers) > 1 else None
+    if schema is not None and _history_batch_available:
+        try:
+            return _fetch_pending_changes_batch(schema, invoice_numbers)
+        except Exception as e:
+            if getattr(e, 'pgcode', None) not in ('42P01', '42703'):
+                raise
+            # undefined_table / undefined_column: WORKFLOW_HISTORY_SCHEMA does not match the database
+            _history_batch_available = False
+            logger.error("❌ WORKFLOW_HISTORY_SCHEMA does not match the database, loading pending changes per invoice: %s", e)
+    single_loader = _unifycode_attr("get_pending_changes_from_history")
+    return {invoice_number: single_loader(invoice_number) for invoice_number in invoice_numbers}
+
+def get_pending_changes_for_emails(invoice_numbers, versions=None):
+    """
+    Get pending changes for many invoices at once, fetching only cache misses.
+    `versions` optionally maps invoice_number -> history version/timestamp; only
+    invoices with a version are cached, and an entry is reused while it matches.
+    Returns {invoice_number: changes or None}.
+    """
+    versions = versions or {}
+    results = {}
+    missing = []
+    for invoice_number in dict.fromkeys(invoice_numbers):
+        hit, changes = _cached_pending_changes(invoice_number, versions.get(invoice_number))
+        if hit:
+            results[invoice_number] = changes
+        else:
+            missing.append(invoice_number)
+    
+    if not missing:
+        return results
+    
+    try:
+        with _timed_stage("get_pending_changes_for_emails"):
+            fetched = _load_pending_changes(missing)
+    except Exception as e:
+        logger.error("❌ Error getting pending changes for emails: %s", e)
+        for invoice_number in missing:
+            results[invoice_number] = None
+        return results
+    
+    for invoice_number in missing:
+        pending_changes = fetched.get(invoice_number)
+        changes = pending_changes if _has_pending_changes(pending_changes) else None
+        if versions.get(invoice_number) is not None:
+            _pending_changes_cache.set(invoice_number, (versions[invoice_number], changes))
+        results[invoice_number] = changes
+    
+    logger.info("📊 Pending changes prefetched for %s invoices (%s from cache)", len(missing), len(results) - len(missing))
+    return results
+
+def invalidate_pending_changes(invoice_number=None):
+    """
+    Drop cached pending changes for one invoice, or for all invoices
+    """
+    if invoice_number is None:
+        _pending_changes_cache.clear()
+    else:
+        _pending_changes_cache.pop(invoice_number)
+
+def get_pending_changes_for_email(invoice_number, version=None):
+    """
+    Get pending changes from history tables for email content
+    """
+    try:
+        with _timed_stage("get_pending_changes_for_email"):
+            hit, pending_changes = _cached_pending_changes(invoice_number, version)
+            if not hit:
+                pending_changes = _unifycode_attr("get_pending_changes_from_history")(invoice_number)
+                if not _has_pending_changes(pending_changes):
+                    pending_changes = None
+                if version is not None:
+                    _pending_changes_cache.set(invoice_number, (version, pending_changes))
+        
+        if pending_changes:
+            logger.info(f"📊 Found pending changes for email: {invoice_number}")
+            return pending_changes
+        else:
+            logger.info(f"ℹ️ No pending changes found for email: {invoice_number}")
+            return None
+            
+    except Exception as e:
+        logger.error(f"❌ Error getting pending changes for email: {e}")
+        return None
+
+def _normalize_email_changes(invoice_number, changes):
+    """
+    Turn the `changes` argument (dict, string or None) into the dict the renderers expect
+    """
+    # 🔥 FIX: Handle both string changes and structured changes
+    email_changes = changes
+    if not email_changes:
+        email_changes = get_pending_changes_for_email(invoice_number)
+        if email_changes:
+            _log_event(logging.DEBUG, "📧 Using pending changes from history for email content", invoice_number=invoice_number)
+        else:
+            _log_event(logging.DEBUG, "ℹ️ No pending changes found, using basic email", invoice_number=invoice_number)
+    elif isinstance(email_changes, str):
+        # 🔥 FIX: Convert string changes to proper structure
+        _log_event(logging.DEBUG, "📧 Converting string changes to structured format", invoice_number=invoice_number)
+        email_changes = {"notes": email_changes}
+    
+    # Ensure email_changes is always a dictionary
+    if not email_changes:
+        email_changes = dict(NO_PENDING_CHANGES)
+    elif not isinstance(email_changes, dict):
+        _log_event(logging.WARNING, "⚠️ Unexpected changes type, converting to dict",
+                   invoice_number=invoice_number, changes_type=type(email_changes).__name__)
+        email_changes = {"notes": str(email_changes)}
+    
+    return email_changes
+
+def _workflow_base_url():
+    return os.getenv('WORKFLOW_BASE_URL', "http://127.0.0.1:8000").rstrip("/")
+
+def _invoice_view_url(invoice_number):
+    return f"{_workflow_base_url()}/invoice-view/{invoice_number}"
+
+def _workflow_action_urls(audit_id):
+    base_url = _workflow_base_url()
+    return (
+        f"{base_url}/api/workflow/action?audit_id={audit_id}&action=approve",
+        f"{base_url}/api/workflow/action?audit_id={audit_id}&action=reject",
+        f"{base_url}/api/workflow/action?audit_id={audit_id}&action=request_edit",
+    )
+
+# 🔥 NEW: Invoice document attachments. Approvers outside the network cannot open the
+# invoice-view link, so the scan can ride along with the approval email. The file is
+# read from disk (or any binary stream) and base64-encoded in line-aligned chunks.
+# The encoded payload is one string because the MIME part and the cache need it whole,
+# so the cap (WORKFLOW_MAX_ATTACHMENT_MB, on the encoded size) is checked before
+# encoding whenever the size is known: files and seekable streams over it are never
+# read. Memory bound per encode: the chunk list plus the joined string, so at most
+# twice the cap, briefly, plus one 57 KiB raw chunk; a stream of unknown size is
+# abandoned as soon as its encoding passes the cap. The encoded part is cached so
+# reminders and fan-out recipients of the same invoice reuse it.
+
+INVOICE_DOCUMENT_EXTENSIONS = (".pdf", ".png", ".jpg", ".jpeg", ".tif", ".tiff")
+
+# 57 raw bytes -> one 76-character base64 line, so chunk boundaries never split a line
+_ATTACHMENT_CHUNK_BYTES = 57 * 1024
+
+class InvoiceDocument:
+    """
+    A resolved invoice scan: `source` is a file path or a readable binary stream.
+    `version` keys the encoded-part cache (path documents use size and mtime).
+    """
+
+    def __init__(self, source, filename=None, content_type=None, version=None):
+        self.source = source
+        is_path = isinstance(source, (str, os.PathLike))
+        self.filename = filename or (os.path.basename(source) if is_path else "invoice")
+        self.content_type = content_type or mimetypes.guess_type(self.filename)[0] or "application/octet-stream"
+        if version is None and is_path:
+            stat = os.stat(source)
+            version = (stat.st_size, stat.st_mtime_ns)
+        self.version = version
+        self.size = os.path.getsize(source) if is_path else None
+
+class _EncodedAttachment:
+    __slots__ = ("filename", "content_type", "payload", "size")
+
+    def __init__(self, filename, content_type, payload):
+        self.filename = filename
+        self.content_type = content_type
+        self.payload = payload
+        self.size = len(payload)
+
+class _AttachmentCache:
+    """
+    LRU of encoded attachments bounded by total encoded size
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def set(self, key, entry):
+        if entry.size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._data.pop(key, None)
+            if previous is not None:
+                self.bytes -= previous.size
+            self._data[key] = entry
+            self.bytes += entry.size
+            while self.bytes > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self.bytes -= evicted.size
+
+    def discard(self, invoice_number=None):
+        with self._lock:
+            for key in [key for key in self._data if invoice_number is None or key[0] == invoice_number]:
+                self.bytes -= self._data.pop(key).size
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._data), "bytes": self.bytes, "max_bytes": self.max_bytes,
+                    "hits": self.hits, "misses": self.misses}
+
+_attachment_cache = _AttachmentCache(int(float(os.getenv('WORKFLOW_ATTACHMENT_CACHE_MB', 64)) * 1024 * 1024))
+_invoice_document_resolver = None
+
+def _attach_invoice_document_setting():
+    return os.getenv('WORKFLOW_ATTACH_INVOICE_DOCUMENT', '0') == '1'
+
+def _max_attachment_bytes():
+    """
+    Cap on the encoded attachment; a message stays under it plus its text parts
+    """
+    return int(float(os.getenv('WORKFLOW_MAX_ATTACHMENT_MB', 10)) * 1024 * 1024)
+
+def _encoded_size(raw_size):
+    return (raw_size + 56) // 57 * 77
+
+def configure_invoice_document_resolver(resolver=None):
+    """
+    Install `resolver(invoice_number)` returning an InvoiceDocument, a file path or None.
+    Without one, unifycode.get_invoice_document_path is used when it exists, then
+    WORKFLOW_INVOICE_DOCUMENT_DIR/<invoice_number>.<pdf|png|jpg|...>.
+    """
+    global _invoice_document_resolver
+    _invoice_document_resolver = resolver
+    _attachment_cache.discard()
+
+def _default_invoice_document(invoice_number):
+    lookup = _unifycode_attr("get_invoice_document_path")
+    if lookup is not None:
+        return lookup(invoice_number)
+    directory = os.getenv('WORKFLOW_INVOICE_DOCUMENT_DIR')
+    if not directory:
+        return None
+    for extension in INVOICE_DOCUMENT_EXTENSIONS:
+        path = os.path.join(directory, f"{invoice_number}{extension}")
+        if os.path.isfile(path):
+            return path
+    return None
+
+def resolve_invoice_document(invoice_number):
+    resolver = _invoice_document_resolver or _default_invoice_document
+    document = resolver(invoice_number)
+    if document is None or isinstance(document, InvoiceDocument):
+        return document
+    return InvoiceDocument(document)
+
+def _encode_base64_stream(stream, limit):
+    """
+    Base64 text of `stream` as one string, encoded one raw chunk at a time; None as soon
+    as it would exceed `limit`, without reading the rest of the stream
+    """
+    parts = []
+    encoded = 0
+    while True:
+        chunk = stream.read(_ATTACHMENT_CHUNK_BYTES)
+        if not chunk:
+            break
+        text = base64.encodebytes(chunk).decode("ascii")
+        encoded += len(text)
+        if encoded > limit:
+            return None
+        parts.append(text)
+    return "".join(parts)
+
+def _remaining_stream_size(stream):
+    """
+    Bytes left in a seekable stream, or None when the stream cannot tell
+    """
+    try:
+        if not stream.seekable():
+            return None
+        position = stream.tell()
+        end = stream.seek(0, os.SEEK_END)
+        stream.seek(position)
+        return end - position
+    except (AttributeError, OSError, ValueError):
+        return None
+
+def _encode_invoice_document(document, limit):
+    if isinstance(document.source, (str, os.PathLike)):
+        if _encoded_size(document.size) > limit:
+            return None
+        with open(document.source, "rb") as stream:
+            return _encode_base64_stream(stream, limit)
+    size = document.size if document.size is not None else _remaining_stream_size(document.source)
+    if size is not None and _encoded_size(size) > limit:
+        return None
+    return _encode_base64_stream(document.source, limit)
+
+def get_invoice_document_attachment(invoice_number, limit=None):
+    """
+    Encoded attachment for an invoice's scan, or None when there is no document or it
+    is over the size cap. Cached per invoice and document version.
+    """
+    limit = _max_attachment_bytes() if limit is None else limit
+    document = resolve_invoice_document(invoice_number)
+    if document is None:
+        return None
+    key = (invoice_number, document.version)
+    cacheable = document.version is not None
+    entry = _attachment_cache.get(key) if cacheable else None
+    if entry is None:
+        with _timed_stage("encode_attachment"):
+            payload = _encode_invoice_document(document, limit)
+        if payload is None:
+            return None
+        entry = _EncodedAttachment(document.filename, document.content_type, payload)
+        if cacheable:
+            _attachment_cache.set(key, entry)
+    return entry if entry.size <= limit else None
+
+def _attachment_part(entry):
+    maintype, _, subtype = entry.content_type.partition("/")
+    part = _mime_base(maintype, subtype or "octet-stream")
+    # Already base64 text: the shared string goes in as-is, no re-encoding per message
+    part.set_payload(entry.payload)
+    part['Content-Transfer-Encoding'] = 'base64'
+    part.add_header('Content-Disposition', 'attachment', filename=entry.filename)
+    return part
+
+def _invoice_document_entry(invoice_number, limit):
+    try:
+        return get_invoice_document_attachment(invoice_number, limit)
+    except Exception as e:
+        _record_stage_failure("encode_attachment", e)
+        _log_event(logging.WARNING, "⚠️ Could not read invoice document, sending link only",
+                   invoice_number=invoice_number, error=e)
+        return None
+
+def attach_invoice_document(msg, invoice_number, body_bytes=0, entry=None):
+    """
+    Attach the invoice scan to `msg` if it fits next to `body_bytes` of text parts.
+    Pass `entry` to reuse an already resolved attachment (fan-out).
+    Returns True when attached; otherwise the message keeps just the link.
+    """
+    limit = _max_attachment_bytes() - body_bytes
+    if entry is None:
+        entry = _invoice_document_entry(invoice_number, limit)
+    if entry is None or entry.size > limit:
+        _log_event(logging.INFO, "📎 No invoice document within the attachment cap, sending link only",
+                   invoice_number=invoice_number, limit=limit)
+        _workflow_metrics.increment("attachments", outcome="link_only")
+        return False
+    msg.attach(_attachment_part(entry))
+    _workflow_metrics.increment("attachments", outcome="attached")
+    return True
+
+def invalidate_invoice_document(invoice_number=None):
+    """
+    Drop cached encodings, e.g. after a stream-backed document was re-scanned
+    """
+    _attachment_cache.discard(invoice_number)
+
+def get_attachment_cache_stats():
+    return _attachment_cache.stats()
+
+def build_approval_email_message(invoice_number, invoice_amount, approver_email, approver_name, audit_id, changes=None, sender_email=None,
+                                 attach_document=None):
+    """
+    Build the approval request MIME message (HTML + plain text) without sending it.
+    `attach_document` (default WORKFLOW_ATTACH_INVOICE_DOCUMENT) also attaches the invoice scan.
+    """
+    if sender_email is None:
+        sender_email = _get_smtp_config()["user"]
+
+    email_changes = _normalize_email_changes(invoice_number, changes)
+
+    # Create message
+    msg = _mime_multipart()
+    msg['From'] = sender_email
+    msg['To'] = approver_email
+    
+    # Format amount with commas
+    formatted_amount = f"{invoice_amount:,.2f}"
+    msg['Subject'] = f'APPROVAL REQUIRED: Invoice #{invoice_number} - Amount: ₹{formatted_amount}'
+    
+    # Generate action URLs
+    approve_url, reject_url, request_edit_url = _workflow_action_urls(audit_id)
+    
+    # Very large diffs: show the first N line changes and attach the full diff as CSV
+    max_line_changes = _max_line_changes_setting()
+    line_count = len(email_changes.get("line_changes") or {})
+    attach_full_diff = line_count > max_line_changes and _attach_full_diff_setting()
+    
+    # 🔥 ENHANCED: Create HTML email body with change diffs section
+    with _timed_stage("render_html"):
+        html_content = generate_approval_email_html(
+            invoice_number=invoice_number,
+            formatted_amount=formatted_amount,
+            audit_id=audit_id,
+            approver_name=approver_name,
+            approver_email=approver_email,
+            approver_level="",  # Will be filled from approver info
+            changes=email_changes,
+            approve_url=approve_url,
+            reject_url=reject_url,
+            request_edit_url=request_edit_url,
+            max_line_changes=max_line_changes,
+            full_diff_attached=attach_full_diff
+        )
+    
+    # Create both HTML and plain text versions
+    msg.attach(_mime_text(html_content, 'html'))
+    
+    # Also include plain text version for email clients that don't support HTML
+    with _timed_stage("render_plain"):
+        plain_text = generate_approval_email_plain_text(
+            invoice_number=invoice_number,
+            formatted_amount=formatted_amount,
+            audit_id=audit_id,
+            approver_name=approver_name,
+            changes=email_changes,
+            approve_url=approve_url,
+            reject_url=reject_url,
+            request_edit_url=request_edit_url,
+            max_line_changes=max_line_changes,
+            full_diff_attached=attach_full_diff
+        )
+    msg.attach(_mime_text(plain_text, 'plain'))
+    
+    if attach_full_diff:
+        diff_part = _mime_text(build_changes_csv(email_changes), 'csv', 'utf-8')
+        diff_part.add_header('Content-Disposition', 'attachment', filename=f"invoice_{invoice_number}_changes.csv")
+        msg.attach(diff_part)
+    
+    if attach_document is None:
+        attach_document = _attach_invoice_document_setting()
+    if attach_document:
+        attach_invoice_document(msg, invoice_number, len(html_content) + len(plain_text))
+    
+    return msg
+
+def _approval_email_credentials_ok(sender_email, sender_password):
+    # Validate that we have email credentials
+    if not sender_email or not sender_password:
+        logger.error("❌ Email credentials not configured")
+        return False
+    
+    if 'example.com' in sender_email or 'your-email' in sender_email:
+        logger.error("❌ Please update SMTP_USER with your actual email address")
+        return False
+    return True
+
+@traced()
+def send_approval_email(invoice_number, invoice_amount, approver_email, approver_name, audit_id, changes=None, approver_level=None,
+                        attach_document=None):
+    """
+    🔥 ENHANCED: Send approval request email with change diffs from pending changes.
+    In outbox mode the rendered message is queued and delivered by the outbox workers.
+    In digest mode non-urgent requests are collected into one email per approver.
+    Repeat calls for the same audit_id and approver return the earlier result without sending.
+    `attach_document=True` attaches the invoice scan when it is under the size cap.
+    """
+    send_key = email_send_key(audit_id, "approval_request", approver_email) if audit_id is not None else None
+    if send_key is not None:
+        prior = claim_email_send(send_key, audit_id, "approval_request", approver_email)
+        if prior is not None:
+            logger.info("🔁 Approval email for audit %s to %s already sent, skipping duplicate", audit_id, approver_email)
+            return prior
+    
+    in_digest = _approval_goes_to_digest(approver_level)
+    on_done = functools.partial(finish_email_send, send_key) if send_key is not None else None
+    ok = False
+    try:
+        ok = _send_approval_email(invoice_number, invoice_amount, approver_email, approver_name, audit_id, changes,
+                                  attach_document, in_digest=in_digest, send_key=send_key, on_done=on_done)
+    finally:
+        # A digest entry keeps its key claimed until the digest itself is delivered, and a
+        # deferred send until the deferred queue reports the outcome
+        if send_key is not None and not (in_digest and ok) and ok != EMAIL_QUEUED:
+            finish_email_send(send_key, ok)
+    return ok
+
+def _send_approval_email(invoice_number, invoice_amount, approver_email, approver_name, audit_id, changes=None,
+                         attach_document=None, in_digest=False, send_key=None, on_done=None):
+    try:
+        # Email configuration
+        smtp_config = _get_smtp_config()
+        smtp_server = smtp_config["server"]
+        smtp_port = smtp_config["port"]
+        sender_email = smtp_config["user"]
+        sender_password = smtp_config["password"]
+        
+        _log_event(logging.DEBUG, "🔧 SMTP configuration",
+                   server=f"{smtp_server}:{smtp_port}", sender=sender_email, recipient=approver_email,
+                   password="set" if sender_password else "not set")
+        
+        if not _approval_email_credentials_ok(sender_email, sender_password):
+            return False
+
+        if in_digest:
+            get_approval_digest().add(invoice_number, invoice_amount, approver_email, approver_name, audit_id, changes,
+                                      send_key=send_key)
+            _log_event(logging.INFO, "🗂️ Approval request added to digest",
+                       invoice_number=invoice_number, audit_id=audit_id, recipient=approver_email)
+            return True
+
+        msg = build_approval_email_message(
+            invoice_number, invoice_amount, approver_email, approver_name, audit_id,
+            changes=changes, sender_email=sender_email, attach_document=attach_document
+        )
+        
+        if email_outbox_enabled():
+            outbox_id = enqueue_email(msg, "approval_request", audit_id=audit_id)
+            _log_event(logging.INFO, "📬 Approval email queued in outbox",
+                       invoice_number=invoice_number, audit_id=audit_id, outbox_id=outbox_id)
+            return outbox_id is not None
+        
+        # Send email over a pooled, already-authenticated SMTP session
+        try:
+            get_smtp_pool().send(smtp_config, msg)
+            _log_event(logging.INFO, "✅ Approval email sent",
+                       invoice_number=invoice_number, audit_id=audit_id, recipient=approver_email)
+            return True
+        except SMTPThrottled as e:
+            return requeue_throttled_email(msg, e, "approval_request", audit_id=audit_id, smtp_config=smtp_config,
+                                           on_done=on_done)
+        except smtplib.SMTPAuthenticationError as e:
+            _log_event(logging.ERROR, "❌ SMTP authentication failed (Gmail needs 2FA and a 16-character App Password)",
+                       server=f"{smtp_server}:{smtp_port}", sender=sender_email, error=e)
+            return False
+        except smtplib.SMTPRecipientsRefused as e:
+            _log_event(logging.ERROR, "❌ Recipient refused",
+                       invoice_number=invoice_number, audit_id=audit_id, recipient=approver_email, error=e)
+            return False
+        except smtplib.SMTPException as e:
+            _log_event(logging.ERROR, "❌ SMTP error while sending",
+                       invoice_number=invoice_number, audit_id=audit_id, error_class=type(e).__name__, error=e)
+            return False
+        except OSError as e:
+            _log_event(logging.ERROR, "❌ Failed to connect to SMTP server",
+                       server=f"{smtp_server}:{smtp_port}", error_class=type(e).__name__, error=e)
+            return False
+        except Exception as e:
+            _log_event(logging.ERROR, "❌ Failed to send email",
+                       invoice_number=invoice_number, audit_id=audit_id, error_class=type(e).__name__, error=e)
+            return False
+        
+    except Exception as e:
+        _record_stage_failure("send_approval_email", e)
+        logger.error(f"❌ Unexpected error in send_approval_email: {e}")
+        return False
+
+# 🔥 NEW: Precompiled email templates. The templates live in templates/ next to this
+# module (str.format syntax: {slot}, literal braces doubled) and are read and compiled
+# once: the static shell and stylesheet are split into pre-joined literal chunks and
+# each email only fills in the dynamic slots. Slot values are HTML-escaped unless the
+# slot carries already-rendered HTML.
+
+class EmailTemplate:
+    """
+    A str.format-style template compiled once into pre-joined literal chunks with
+    slot positions between them; each render only fills in the slots.
+    `minify` ("html" or "text") compacts the literal chunks at compile time.
+    """
+
+    def __init__(self, source, escape=True, raw_slots=(), minify=None):
+        self.source = source
+        self.escape = escape
+        self.raw_slots = frozenset(raw_slots)
+        parts = []
+        slots = []
+        for literal, field, format_spec, conversion in string.Formatter().parse(source):
+            if literal:
+                parts.append(literal)
+            if field is None:
+                continue
+            if format_spec or conversion or not field.isidentifier():
+                raise ValueError(f"Unsupported template slot: {{{field}}}")
+            slots.append((len(parts), field, not escape or field in self.raw_slots))
+            parts.append(None)
+        if minify:
+            parts, slots = _minify_template_parts(parts, slots, minify)
+        self._parts = parts
+        self._slots = tuple(slots)
+        self.slots = frozenset(field for _, field, _ in slots)
+
+    def render(self, values):
+        escape = html.escape
+        parts = self._parts[:]
+        for index, field, raw in self._slots:
+            value = str(values[field])
+            parts[index] = value if raw else escape(value)
+        return "".join(parts)
+
+    def partial(self, values):
+        """
+        Fill the slots present in `values` now and return a template with only the
+        remaining slots; adjacent literal chunks are merged so later renders stay cheap
+        """
+        escape = html.escape
+        filled = self._parts[:]
+        remaining = {}
+        for index, field, raw in self._slots:
+            if field in values:
+                value = str(values[field])
+                filled[index] = value if raw else escape(value)
+            else:
+                remaining[index] = (field, raw)
+        
+        parts = []
+        slots = []
+        for index, part in enumerate(filled):
+            if index in remaining:
+                field, raw = remaining[index]
+                slots.append((len(parts), field, raw))
+                parts.append(None)
+            elif parts and parts[-1] is not None:
+                parts[-1] += part
+            else:
+                parts.append(part)
+        
+        bound = EmailTemplate.__new__(EmailTemplate)
+        bound.source = self.source
+        bound.escape = self.escape
+        bound.raw_slots = self.raw_slots
+        bound._parts = parts
+        bound._slots = tuple(slots)
+        bound.slots = frozenset(field for _, field, _ in slots)
+        return bound
+
+EMAIL_TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
+
+# Template name -> (file in EMAIL_TEMPLATE_DIR, EmailTemplate options)
+_EMAIL_TEMPLATE_SOURCES = {
+    "approval_html": ("approval_email.html", {"escape": True, "raw_slots": ("changes_html",)}),
+    "approval_plain": ("approval_email.txt", {"escape": False}),
+    "notification_html": ("notification_email.html", {"escape": True}),
+    "notification_plain": ("notification_email.txt", {"escape": False}),
+}
+_compiled_templates = {}
+
+def get_email_template(name):
+    """
+    Return the compiled template `name` for the current WORKFLOW_EMAIL_MINIFY setting,
+    compiling it on first use
+    """
+    minify = _email_minify_enabled()
+    template = _compiled_templates.get((name, minify))
+    if template is None:
+        source = read_email_template_source(name)
+        options = _EMAIL_TEMPLATE_SOURCES[name][1]
+        if minify:
+            options = dict(options, minify="html" if name.endswith("_html") else "text")
+        template = _compiled_templates[(name, minify)] = EmailTemplate(source, **options)
+    return template
+
+def read_email_template_source(name):
+    """
+    Uncompiled source of template `name`, exactly as stored in its file
+    """
+    filename = _EMAIL_TEMPLATE_SOURCES[name][0]
+    with open(os.path.join(EMAIL_TEMPLATE_DIR, filename), encoding="utf-8", newline="") as f:
+        return f.read()
+
+def precompile_email_templates():
+    for name in _EMAIL_TEMPLATE_SOURCES:
+        get_email_template(name)
+
+# 🔥 NEW: Compact email payloads (WORKFLOW_EMAIL_MINIFY=1; off by default so rendered
+# emails stay byte-for-byte what they were). Templates are minified once at compile time
+# (stylesheet rules on one line each, indentation and HTML comments gone; line breaks
+# are kept so no line nears SMTP's 998-octet limit) and change-summary rows are emitted
+# without indentation. Transfer encoding and wire-size accounting live in workflow_mime.
+
+_SLOT_MARK = "\x00"
+_STYLE_BLOCK_RE = re.compile(r"(<style[^>]*>)(.*?)(</style>)", re.S | re.I)
+_HTML_COMMENT_RE = re.compile(r"<!--(?!\[if).*?-->", re.S)
+_CSS_COMMENT_RE = re.compile(r"/\*.*?\*/", re.S)
+_CSS_PUNCT_RE = re.compile(r"\s*([{};:,>])\s*")
+_LINE_BREAK_RUN_RE = re.compile(r"[ \t]*\n\s*")
+_SPACE_RUN_RE = re.compile(r"[ \t]{2,}")
+
+def _email_minify_enabled():
+    return os.getenv('WORKFLOW_EMAIL_MINIFY', '0') == '1'
+
+def _minify_css(css):
+    css = _CSS_COMMENT_RE.sub("", css)
+    css = _CSS_PUNCT_RE.sub(r"\1", " ".join(css.split()))
+    return "\n" + css.replace(";}", "}").replace("}", "}\n")
+
+def _minify_html(text):
+    """
+    Whitespace-only HTML compaction: indentation collapses to a single newline, which
+    renders the same. There is no <pre> or white-space:pre in the email templates.
+    """
+    text = _HTML_COMMENT_RE.sub("", text)
+    pieces = []
+    position = 0
+    for match in _STYLE_BLOCK_RE.finditer(text):
+        pieces.append(_SPACE_RUN_RE.sub(" ", _LINE_BREAK_RUN_RE.sub("\n", text[position:match.start()])))
+        pieces.append(match.group(1) + _minify_css(match.group(2)) + match.group(3))
+        position = match.end()
+    pieces.append(_SPACE_RUN_RE.sub(" ", _LINE_BREAK_RUN_RE.sub("\n", text[position:])))
+    return "".join(pieces)
+
+def _minify_text(text):
+    lines = [line.rstrip() for line in textwrap.dedent(text).split("\n")]
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(lines))
+
+def _minify_template_parts(parts, slots, kind):
+    """
+    Minify a compiled template's literal chunks as one document (slots stand in as a
+    marker character) and rebuild the chunk/slot lists
+    """
+    document = "".join(_SLOT_MARK if part is None else part for part in parts)
+    document = _minify_html(document) if kind == "html" else _minify_text(document)
+    literals = document.split(_SLOT_MARK)
+    new_parts = []
+    new_slots = []
+    for index, (_, field, raw) in enumerate(slots):
+        if literals[index]:
+            new_parts.append(literals[index])
+        new_slots.append((len(new_parts), field, raw))
+        new_parts.append(None)
+    if literals[-1]:
+        new_parts.append(literals[-1])
+    return new_parts, new_slots
+
+# 🔥 NEW: Function to generate HTML email with change diffs
+def generate_approval_email_html(invoice_number, formatted_amount, audit_id, approver_name, 
+                               approver_email, approver_level, changes, approve_url, 
+                               reject_url, request_edit_url, max_line_changes=None,
+                               full_diff_attached=False):
+    """
+    Generate HTML email content with change diffs section + Check Invoice button
+    """
+    
+    # Generate the invoice viewing URL
+    invoice_view_url = _invoice_view_url(invoice_number)
+    
+    # 🔥 ENHANCED: Generate changes summary HTML if changes exist
+    changes_html = ""
+    if changes and (changes.get("header_changes") or changes.get("line_changes")):
+        changes_html = generate_changes_summary_html(changes, max_line_changes, full_diff_attached)
+    
+    html_content = get_email_template("approval_html").render({
+        "invoice_number": invoice_number,
+        "formatted_amount": formatted_amount,
+        "audit_id": audit_id,
+        "submission_date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "approver_name": approver_name,
+        "changes_html": changes_html,
+        "invoice_view_url": invoice_view_url,
+        "approve_url": approve_url,
+        "reject_url": reject_url,
+        "request_edit_url": request_edit_url,
+    })
+    
+    return html_content
+
+# 🔥 NEW: Function to generate changes summary HTML
+# Large freight invoices carry thousands of line changes, so the summary is built as a
+# list of parts joined once, field labels are memoized, and only the first
+# `max_line_changes` lines are rendered into the email body.
+
+@functools.lru_cache(maxsize=4096)
+def _format_field_label(field):
+    return str(field).replace('_', ' ').title()
+
+def _max_line_changes_setting():
+    return int(os.getenv('WORKFLOW_EMAIL_MAX_LINE_CHANGES', 200))
+
+def _attach_full_diff_setting():
+    return os.getenv('WORKFLOW_EMAIL_ATTACH_FULL_DIFF', '1') == '1'
+
+def _limit_line_changes(changes, max_line_changes):
+    """
+    Return (first N line-change items, number of lines left out)
+    """
+    line_changes = changes.get("line_changes") or {}
+    total = len(line_changes)
+    if max_line_changes is None or total <= max_line_changes:
+        return line_changes.items(), 0
+    return itertools.islice(line_changes.items(), max_line_changes), total - max_line_changes
+
+_CHANGE_ROW_HTML = '''
+            <tr>
+                <td class="change-field">{}</td>
+                <td class="change-arrow">→</td>
+                <td class="change-new">{}</td>
+            </tr>
+            '''
+_LINE_CHANGE_ROW_HTML = '''
+                <tr>
+                    <td class="change-field">{}</td>
+                    <td class="change-arrow">→</td>
+                    <td class="change-new">{}</td>
+                </tr>
+                '''
+_COMPACT_CHANGE_ROW_HTML = '<tr><td class="change-field">{}</td><td class="change-arrow">→</td><td class="change-new">{}</td></tr>\n'
+
+def generate_changes_summary_html(changes, max_line_changes=None, full_diff_attached=False):
+    """
+    Generate HTML for the changes summary section
+    """
+    escape = html.escape
+    label = _format_field_label
+    if _email_minify_enabled():
+        header_row = line_row = _COMPACT_CHANGE_ROW_HTML
+    else:
+        header_row, line_row = _CHANGE_ROW_HTML, _LINE_CHANGE_ROW_HTML
+    parts = ['<div class="changes-section">\n', '<h3>📊 CHANGES SUMMARY</h3>\n']
+    append = parts.append
+    
+    # Header changes
+    if changes.get("header_changes"):
+        append('<div class="changes-group">\n')
+        append('<h4>📋 Header Changes</h4>\n')
+        append('<table class="changes-table">\n')
+        
+        for field, change_desc in changes["header_changes"].items():
+            append(header_row.format(escape(label(field)), escape(str(change_desc))))
+        
+        append('</table>\n')
+        append('</div>\n')
+    
+    # Line changes
+    if changes.get("line_changes"):
+        line_items, remaining = _limit_line_changes(changes, max_line_changes)
+        append('<div class="changes-group">\n')
+        append('<h4>📝 Line Item Changes</h4>\n')
+        
+        for line_num, line_changes in line_items:
+            append('<div class="line-change">\n')
+            append(f'<strong>Line {escape(str(line_num))}:</strong>\n')
+            append('<table class="changes-table">\n')
+            
+            for field, change_desc in line_changes.items():
+                append(line_row.format(escape(label(field)), escape(str(change_desc))))
+            
+            append('</table>\n')
+            append('</div>\n')
+        
+        if remaining:
+            note = " (full diff attached as CSV)" if full_diff_attached else ""
+            append(f'<p class="changes-more"><em>… and {remaining} more line item changes{note}</em></p>\n')
+        
+        append('</div>\n')
+    
+    append('</div>\n')
+    return "".join(parts)
+
+def build_changes_csv(changes):
+    """
+    Full header + line diff as CSV text (scope, line, field, change)
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(["scope", "line", "field", "change"])
+    for field, change_desc in (changes.get("header_changes") or {}).items():
+        writer.writerow(["header", "", _format_field_label(field), change_desc])
+    for line_num, line_changes in (changes.get("line_changes") or {}).items():
+        writer.writerows(
+            ["line", line_num, _format_field_label(field), change_desc]
+            for field, change_desc in line_changes.items()
+        )
+    return buffer.getvalue()
+
+# 🔥 NEW: Function to generate plain text email with change diffs
+def generate_approval_email_plain_text(invoice_number, formatted_amount, audit_id, approver_name, 
+                                     changes, approve_url, reject_url, request_edit_url,
+                                     max_line_changes=None, full_diff_attached=False):
+    """
+    Generate plain text email content with change diffs
+    """
+    
+    # 🔥 ENHANCED: Generate changes summary for plain text
+    changes_text = ""
+    if changes and (changes.get("header_changes") or changes.get("line_changes")):
+        changes_text = generate_changes_summary_plain_text(changes, max_line_changes, full_diff_attached)
+    
+    plain_text = get_email_template("approval_plain").render({
+        "approver_name": approver_name,
+        "invoice_number": invoice_number,
+        "formatted_amount": formatted_amount,
+        "audit_id": audit_id,
+        "submission_date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "changes_text": changes_text if changes_text else "No specific changes mentioned.",
+        "approve_url": approve_url,
+        "reject_url": reject_url,
+        "request_edit_url": request_edit_url,
+    })
+    return plain_text
+
+# 🔥 NEW: Function to generate plain text changes summary
+def generate_changes_summary_plain_text(changes, max_line_changes=None, full_diff_attached=False):
+    """
+    Generate plain text for the changes summary section
+    """
+    label = _format_field_label
+    parts = ["CHANGES SUMMARY:\n\n"]
+    append = parts.append
+    
+    # Header changes
+    if changes.get("header_changes"):
+        append("Header Changes:\n")
+        append("-" * 40 + "\n")
+        
+        for field, change_desc in changes["header_changes"].items():
+            append(f"  {label(field)}: {change_desc}\n")
+        
+        append("\n")
+    
+    # Line changes
+    if changes.get("line_changes"):
+        line_items, remaining = _limit_line_changes(changes, max_line_changes)
+        append("Line Item Changes:\n")
+        append("-" * 40 + "\n")
+        
+        for line_num, line_changes in line_items:
+            append(f"Line {line_num}:\n")
+            
+            for field, change_desc in line_changes.items():
+                append(f"  {label(field)}: {change_desc}\n")
+            
+            append("\n")
+        
+        if remaining:
+            note = " (full diff attached as CSV)" if full_diff_attached else ""
+            append(f"... and {remaining} more line item changes{note}\n\n")
+    
+    return "".join(parts)
+
+WORKFLOW_ACTION_DISPLAY = {
+    'approve': {'text': '✅ APPROVED', 'color': '#28a745'},
+    'reject': {'text': '❌ REJECTED', 'color': '#dc3545'},
+    'request_edit': {'text': '✏️ EDIT REQUESTED', 'color': '#ffc107'}
+}
+
+def build_action_notification_message(invoice_number, action, notes, recipient_email, sender_email=None):
+    """
+    Status-update email for one invoice, without sending it
+    """
+    if sender_email is None:
+        sender_email = _get_smtp_config()["user"]
+    
+    msg = _mime_multipart()
+    msg['From'] = sender_email
+    msg['To'] = recipient_email
+    
+    action_info = WORKFLOW_ACTION_DISPLAY.get(action, {'text': action.upper(), 'color': '#6c757d'})
+    
+    msg['Subject'] = f'Update: Invoice #{invoice_number} - {action_info["text"]}'
+    
+    notes_display = notes if notes else 'No additional notes provided.'
+    with _timed_stage("render_html"):
+        html_content = get_email_template("notification_html").render({
+            "action_color": action_info['color'],
+            "action_text": action_info['text'],
+            "invoice_number": invoice_number,
+            "notes": notes_display,
+        })
+    
+    msg.attach(_mime_text(html_content, 'html'))
+    
+    # Plain text fallback
+    with _timed_stage("render_plain"):
+        plain_text = get_email_template("notification_plain").render({
+            "invoice_number": invoice_number,
+            "action_text": action_info['text'],
+            "notes": notes_display,
+        })
+    msg.attach(_mime_text(plain_text, 'plain'))
+    
+    return msg
+
+@traced()
+def send_action_notification_email(invoice_number, action, notes, recipient_email):
+    """
+    Send notification email back to the requester with HTML formatting.
+    With WORKFLOW_NOTIFICATION_COALESCE=1 the update is buffered and merged with
+    the recipient's other updates in the coalescing window.
+    """
+    if notification_coalescing_enabled():
+        buffered = get_notification_coalescer().add(invoice_number, action, notes, recipient_email)
+        if buffered:
+            return buffered
+        # The coalescer is shutting down: send this one on its own
+    try:
+        smtp_config = _get_smtp_config()
+        msg = build_action_notification_message(invoice_number, action, notes, recipient_email, smtp_config["user"])
+        
+        if email_outbox_enabled():
+            return enqueue_email(msg, "action_notification") is not None
+        
+        try:
+            get_smtp_pool().send(smtp_config, msg)
+        except SMTPThrottled as e:
+            return requeue_throttled_email(msg, e, "action_notification", smtp_config=smtp_config)
+        
+        logger.info(f"📧 HTML notification email sent to {recipient_email}")
+        return True
         
     except Exception as e:
         logger.error(f"❌ Failed to send notification email: {e}")
-        return False
\ No newline at end of file
+        return False
+
+@traced()
+def start_approval_workflow(invoice_number, original_amount, changed_amount, supplier_name=None, user_id=1, changes=None):
+    """
+    Route, audit and notify in one call.
+    In outbox mode the audit row and the queued approval email commit together, except
+    for requests that go into an approval digest (the digest itself is queued when sent).
+    Immaterial changes (see should_trigger_workflow) create no audit row and send nothing.
+    Returns {"audit_id", "approver_level", "approver_email", "email_ok", "triggered"} or None on failure.
+    """
+    if not should_trigger_workflow(changed_amount, invoice_number, original_amount, supplier_name, changes):
+        return {"audit_id": None, "approver_level": None, "approver_email": None, "email_ok": False, "triggered": False}
+    
+    approver = check_approval_workflow(changed_amount, invoice_number, supplier_name, user_id)
+    if approver:
+        level, name, email_address = approver['level_name'], approver['approver_name'], approver['approver_email']
+    else:
+        fallback = get_temporary_approver(changed_amount)
+        if fallback is None:
+            logger.error("❌ No approver for invoice %s (amount %s): no hierarchy or fallback rule matches", invoice_number, changed_amount)
+            return None
+        level, name, email_address = fallback
+    
+    if not email_outbox_enabled() or _approval_goes_to_digest(level):
+        audit_id = create_workflow_audit(invoice_number, original_amount, changed_amount, level, email_address, name, user_id)
+        if audit_id is None:
+            return None
+        tag_trace(audit_id=audit_id)
+        email_ok = send_approval_email(invoice_number, changed_amount, email_address, name, audit_id, changes, approver_level=level)
+        return {"audit_id": audit_id, "approver_level": level, "approver_email": email_address, "email_ok": email_ok, "triggered": True}
+    
+    try:
+        with db_connection() as conn:
+            cur = conn.cursor()
+            audit_id = _insert_workflow_audits(
+                cur, [(invoice_number, original_amount, changed_amount, level, email_address, f"user_{user_id}")]
+            )[0]
+            cur.close()
+            tag_trace(audit_id=audit_id)
+            send_key = email_send_key(audit_id, "approval_request", email_address)
+            if claim_email_send(send_key, audit_id, "approval_request", email_address) is not None:
+                # Already queued or sent for this audit row: keep the audit row, skip the duplicate email
+                conn.commit()
+                logger.info("🔁 Approval email for audit %s to %s already sent, skipping duplicate", audit_id, email_address)
+                return {"audit_id": audit_id, "approver_level": level, "approver_email": email_address, "email_ok": True, "triggered": True}
+            try:
+                msg = build_approval_email_message(invoice_number, changed_amount, email_address, name, audit_id, changes)
+                enqueue_email(msg, "approval_request", audit_id=audit_id, conn=conn)
+                conn.commit()
+            except Exception:
+                finish_email_send(send_key, False)
+                raise
+        finish_email_send(send_key, True)
+        
+        logger.info("📝 Workflow audit %s created and approval email queued for %s", audit_id, invoice_number)
+        return {"audit_id": audit_id, "approver_level": level, "approver_email": email_address, "email_ok": True, "triggered": True}
+        
+    except Exception as e:
+        logger.error("❌ Failed to start approval workflow for %s: %s", invoice_number, e)
+        return None
+
+# 🔥 NEW: Per-approver digest mode. Pending approval requests are held per approver
+# for a window (or until a count threshold) and sent as one email listing every
+# invoice with its own approve/reject/edit links. Urgent tiers skip the window.
+
+_EMAIL_TEMPLATE_SOURCES.update({
+    "digest_html": ("approval_digest.html", {"escape": True, "raw_slots": ("items_html",)}),
+    "digest_item_html": ("approval_digest_item.html", {"escape": True, "raw_slots": ("changes_html",)}),
+    "digest_plain": ("approval_digest.txt", {"escape": False}),
+    "digest_item_plain": ("approval_digest_item.txt", {"escape": False}),
+})
+
+def approval_digest_enabled():
+    return os.getenv('WORKFLOW_APPROVAL_DIGEST', '0') == '1'
+
+def _is_urgent_approval_level(approver_level):
+    urgent = os.getenv('WORKFLOW_DIGEST_URGENT_LEVELS', 'L3')
+    return approver_level is not None and approver_level in {level.strip() for level in urgent.split(',')}
+
+def _approval_goes_to_digest(approver_level):
+    return approval_digest_enabled() and not _is_urgent_approval_level(approver_level)
+
+def build_approval_digest_message(approver_email, approver_name, entries, sender_email=None):
+    """
+    One email covering several pending approvals for the same approver.
+    `entries` are dicts with invoice_number, invoice_amount, audit_id, changes and submitted_at.
+    """
+    if sender_email is None:
+        sender_email = _get_smtp_config()["user"]
+    max_line_changes = _max_line_changes_setting()
+    item_html = get_email_template("digest_item_html")
+    item_plain = get_email_template("digest_item_plain")
+    
+    items_html = []
+    items_text = []
+    for entry in entries:
+        changes = _normalize_email_changes(entry["invoice_number"], entry.get("changes"))
+        has_diff = changes.get("header_changes") or changes.get("line_changes")
+        approve_url, reject_url, request_edit_url = _workflow_action_urls(entry["audit_id"])
+        values = {
+            "invoice_number": entry["invoice_number"],
+            "formatted_amount": f"{entry['invoice_amount']:,.2f}",
+            "audit_id": entry["audit_id"],
+            "submitted_at": entry["submitted_at"],
+            "approve_url": approve_url,
+            "reject_url": reject_url,
+            "request_edit_url": request_edit_url,
+            "changes_html": generate_changes_summary_html(changes, max_line_changes) if has_diff else "",
+            "changes_text": generate_changes_summary_plain_text(changes, max_line_changes) if has_diff else "No specific changes mentioned.\n",
+        }
+        items_html.append(item_html.render(values))
+        items_text.append(item_plain.render(values))
+    
+    msg = _mime_multipart()
+    msg['From'] = sender_email
+    msg['To'] = approver_email
+    msg['Subject'] = f'APPROVAL REQUIRED: {len(entries)} invoices awaiting your approval'
+    
+    summary = {"count": len(entries), "approver_name": approver_name}
+    msg.attach(_mime_text(get_email_template("digest_html").render(dict(summary, items_html="".join(items_html))), 'html'))
+    msg.attach(_mime_text(get_email_template("digest_plain").render(dict(summary, items_text="".join(items_text))), 'plain'))
+    return msg
+
+class ApprovalDigestCollector:
+    """
+    Buffers approval requests per approver_email and flushes each approver's batch
+    when its window elapses or it reaches `max_items`
+    """
+
+    def __init__(self, window_seconds=900.0, max_items=25, max_retries=3):
+        self.window_seconds = window_seconds
+        self.max_items = max_items
+        self.max_retries = max_retries
+        self._buckets = {}  # approver_email -> {"approver_name", "due_at", "entries"}
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="approval-digest", daemon=True)
+        self._thread.start()
+
+    def add(self, invoice_number, invoice_amount, approver_email, approver_name, audit_id, changes=None, send_key=None):
+        """
+        Buffer one request; a claimed `send_key` is marked sent once the digest is delivered,
+        or released if the entry is dropped
+        """
+        entry = {
+            "invoice_number": invoice_number,
+            "invoice_amount": invoice_amount,
+            "audit_id": audit_id,
+            "changes": changes,
+            "submitted_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "attempts": 0,
+            "send_key": send_key,
+        }
+        with self._cond:
+            bucket = self._buckets.get(approver_email)
+            if bucket is None:
+                bucket = self._buckets[approver_email] = {
+                    "approver_name": approver_name,
+                    "due_at": time.monotonic() + self.window_seconds,
+                    "entries": [],
+                }
+            bucket["entries"].append(entry)
+            if len(bucket["entries"]) >= self.max_items:
+                bucket["due_at"] = time.monotonic()
+            self._cond.notify()
+
+    def pending(self):
+        with self._cond:
+            return {email_address: len(bucket["entries"]) for email_address, bucket in self._buckets.items()}
+
+    def _take_due(self, force=False):
+        now = time.monotonic()
+        due = []
+        for email_address in list(self._buckets):
+            bucket = self._buckets[email_address]
+            if force or bucket["due_at"] <= now:
+                due.append((email_address, self._buckets.pop(email_address)))
+        return due
+
+    def _send(self, due):
+        messages = [
+            build_approval_digest_message(email_address, bucket["approver_name"], bucket["entries"])
+            for email_address, bucket in due
+        ]
+        if email_outbox_enabled():
+            results = [
+                enqueue_email(msg, "approval_digest") is not None
+                for msg in messages
+            ]
+        else:
+            results = send_email_messages_batch(
+                messages, on_done=[functools.partial(self._finish, bucket["entries"]) for _, bucket in due]
+            )
+        
+        for (email_address, bucket), ok in zip(due, results):
+            if ok == EMAIL_QUEUED:
+                # The deferred queue finishes the entries' keys once the digest goes out
+                logger.info("⏳ Approval digest with %s invoices to %s deferred by throttling", len(bucket['entries']), email_address)
+                continue
+            if ok:
+                logger.info("📧 Approval digest with %s invoices sent to %s", len(bucket['entries']), email_address)
+                self._finish(bucket["entries"], True)
+                continue
+            retry = [entry for entry in bucket["entries"] if entry["attempts"] < self.max_retries]
+            dropped = [entry for entry in bucket["entries"] if entry["attempts"] >= self.max_retries]
+            for entry in retry:
+                entry["attempts"] += 1
+            if dropped:
+                logger.error("❌ Dropping %s digest entries for %s after %s failed sends", len(dropped), email_address, self.max_retries)
+                self._finish(dropped, False)
+            if retry and self._stopped:
+                self._finish(retry, False)
+            elif retry:
+                with self._cond:
+                    current = self._buckets.setdefault(email_address, {
+                        "approver_name": bucket["approver_name"],
+                        "due_at": time.monotonic() + self.window_seconds,
+                        "entries": [],
+                    })
+                    current["entries"][:0] = retry
+
+    @staticmethod
+    def _finish(entries, ok):
+        for entry in entries:
+            if entry["send_key"] is not None:
+                finish_email_send(entry["send_key"], ok)
+
+    def flush(self):
+        """
+        Send every buffered digest now
+        """
+        with self._cond:
+            due = self._take_due(force=True)
+        if due:
+            self._send(due)
+
+    def close(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join()
+        self.flush()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    due = self._take_due()
+                    if due:
+                        break
+                    next_due = min((bucket["due_at"] for bucket in self._buckets.values()), default=None)
+                    self._cond.wait(None if next_due is None else max(next_due - time.monotonic(), 0.0))
+                if self._stopped:
+                    return
+            try:
+                self._send(due)
+            except Exception as e:
+                logger.error("❌ Approval digest flush failed: %s", e)
+
+_approval_digest = None
+_approval_digest_lock = threading.Lock()
+
+def get_approval_digest():
+    global _approval_digest
+    if _approval_digest is None:
+        with _approval_digest_lock:
+            if _approval_digest is None:
+                _approval_digest = ApprovalDigestCollector(
+                    window_seconds=float(os.getenv('WORKFLOW_DIGEST_WINDOW_SECONDS', 900)),
+                    max_items=int(os.getenv('WORKFLOW_DIGEST_MAX_ITEMS', 25)),
+                )
+    return _approval_digest
+
+def flush_approval_digests():
+    """
+    Send all buffered digests immediately (also runs at interpreter exit)
+    """
+    global _approval_digest
+    with _approval_digest_lock:
+        collector, _approval_digest = _approval_digest, None
+    if collector is not None:
+        collector.close()
+
+# 🔥 NEW: Idempotent sends. Each (audit_id, message kind, recipient) gets a send key.
+# A bounded in-process cache of claimed and completed keys answers duplicates, so the
+# common first send costs no query; completed keys are written to "DocAI".email_send_log
+# in the background, in batches. WORKFLOW_EMAIL_IDEMPOTENCY=strict instead claims each
+# key in the table before sending, for deployments where retries land on another process.
+
+EMAIL_SEND_LOG_DDL = """
+    CREATE TABLE IF NOT EXISTS "DocAI".email_send_log (
+        send_key TEXT PRIMARY KEY,
+        audit_id BIGINT,
+        message_kind TEXT NOT NULL,
+        recipient TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'sending',
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        completed_at TIMESTAMPTZ
+    );
+"""
+
+def ensure_email_send_log_table():
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(EMAIL_SEND_LOG_DDL)
+        conn.commit()
+        cur.close()
+
+def email_send_key(audit_id, message_kind, recipient):
+    return f"{audit_id}:{message_kind}:{str(recipient).strip().lower()}"
+
+_sent_keys = _BoundedCache(int(os.getenv('WORKFLOW_SEND_KEY_CACHE_SIZE', 10000)))
+_send_log_available = True
+
+def _email_idempotency_mode():
+    return os.getenv('WORKFLOW_EMAIL_IDEMPOTENCY', '1').lower()
+
+def email_idempotency_enabled():
+    return _email_idempotency_mode() != '0'
+
+def _send_log_error(e, action):
+    global _send_log_available
+    if getattr(e, 'pgcode', None) == '42P01':
+        # undefined_table: run ensure_email_send_log_table() to record send keys
+        _send_log_available = False
+        logger.warning("⚠️ \"DocAI\".email_send_log is missing, send keys are only kept in memory")
+    else:
+        logger.warning("⚠️ Could not %s: %s", action, e)
+
+class _SendLogWriter:
+    """
+    Write-behind batcher for completed send keys: one multi-row upsert per window
+    """
+
+    def __init__(self, window_ms=200, max_batch=500):
+        self.window = window_ms / 1000.0
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="email-send-log", daemon=True)
+        self._thread.start()
+
+    def record(self, send_key, audit_id, message_kind, recipient):
+        self._queue.put((send_key, audit_id, message_kind, str(recipient)))
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = {item[0]: item}
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch[item[0]] = item
+            self._flush(list(batch.values()))
+
+        leftover = {}
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                leftover[item[0]] = item
+        if leftover:
+            self._flush(list(leftover.values()))
+
+    def _flush(self, rows):
+        if not _send_log_available:
+            return
+        try:
+            with db_connection() as conn:
+                cur = conn.cursor()
+                _psycopg2_extras.execute_values(cur, """
+                    INSERT INTO "DocAI".email_send_log (send_key, audit_id, message_kind, recipient, status, completed_at)
+                    VALUES %s
+                    ON CONFLICT (send_key) DO UPDATE SET status = 'sent', completed_at = now()
+                """, rows, template="(%s, %s, %s, %s, 'sent', now())", page_size=max(len(rows), 1))
+                conn.commit()
+                cur.close()
+        except Exception as e:
+            _send_log_error(e, f"record {len(rows)} send keys")
+
+_send_log_writer = None
+_send_log_writer_lock = threading.Lock()
+
+def _get_send_log_writer():
+    global _send_log_writer
+    if _send_log_writer is None:
+        with _send_log_writer_lock:
+            if _send_log_writer is None:
+                _send_log_writer = _SendLogWriter(
+                    window_ms=float(os.getenv('WORKFLOW_SEND_LOG_WINDOW_MS', 200)),
+                    max_batch=int(os.getenv('WORKFLOW_SEND_LOG_BATCH_MAX', 500)),
+                )
+    return _send_log_writer
+
+def flush_send_log():
+    """
+    Write every completed send key that is still buffered
+    """
+    global _send_log_writer
+    with _send_log_writer_lock:
+        writer, _send_log_writer = _send_log_writer, None
+    if writer is not None:
+        writer.close()
+
+def _claim_send_key_in_log(send_key, audit_id, message_kind, recipient):
+    try:
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                INSERT INTO "DocAI".email_send_log (send_key, audit_id, message_kind, recipient)
+                VALUES (%s, %s, %s, %s)
+                ON CONFLICT (send_key) DO NOTHING
+                RETURNING send_key
+            """, (send_key, audit_id, message_kind, recipient))
+            claimed = cur.fetchone() is not None
+            conn.commit()
+            cur.close()
+        return claimed
+    except Exception as e:
+        _send_log_error(e, f"claim send key {send_key}, sending without duplicate check")
+        return True
+
+def claim_email_send(send_key, audit_id, message_kind, recipient):
+    """
+    Claim `send_key`. Returns None when the caller owns the send, or the earlier result
+    (True) when the message was already sent or is being sent. Only strict mode asks
+    the send log; if it is unreachable the send goes ahead rather than being lost.
+    """
+    if not email_idempotency_enabled():
+        return None
+    if _sent_keys.get(send_key):
+        return True
+    if _email_idempotency_mode() == 'strict' and _send_log_available:
+        if not _claim_send_key_in_log(send_key, audit_id, message_kind, recipient):
+            _sent_keys.set(send_key, True)
+            return True
+    _sent_keys.set(send_key, (audit_id, message_kind, str(recipient)))
+    return None
+
+def finish_email_send(send_key, ok):
+    """
+    Mark a claimed key as sent, or release it after a failure so a retry can send
+    """
+    if not email_idempotency_enabled():
+        return
+    claim = _sent_keys.get(send_key)
+    if not ok:
+        _sent_keys.pop(send_key)
+    else:
+        _sent_keys.set(send_key, True)
+    if not _send_log_available:
+        return
+    if _email_idempotency_mode() != 'strict':
+        if ok and isinstance(claim, tuple):
+            _get_send_log_writer().record(send_key, *claim)
+        return
+    try:
+        with db_connection() as conn:
+            cur = conn.cursor()
+            if ok:
+                cur.execute("""
+                    UPDATE "DocAI".email_send_log
+                    SET status = 'sent', completed_at = now()
+                    WHERE send_key = %s
+                """, (send_key,))
+            else:
+                cur.execute("""
+                    DELETE FROM "DocAI".email_send_log
+                    WHERE send_key = %s AND status = 'sending'
+                """, (send_key,))
+            conn.commit()
+            cur.close()
+    except Exception as e:
+        _send_log_error(e, f"update send key {send_key}")
+
+# 🔥 NEW: Render-once fan-out for tiers that need parallel sign-off. The invoice body
+# (amount, change diffs, view link) is rendered once into a partially bound template;
+# per recipient only the name, audit id and action links are filled in. Every
+# approver gets their own audit row so responses are tracked separately, and all
+# messages go out over one SMTP session.
+
+def _fanout_recipient(approver):
+    if isinstance(approver, dict):
+        return approver['approver_name'], approver['approver_email']
+    name, email_address = approver[:2]
+    return name, email_address
+
+def _claim_fanout_sends(recipients, audit_ids):
+    """
+    Claim one send key per recipient. Returns the keys in recipient order, with None
+    for recipients whose email was already sent (those are skipped, not resent).
+    """
+    send_keys = []
+    for (_, email_address), audit_id in zip(recipients, audit_ids):
+        send_key = email_send_key(audit_id, "approval_request", email_address)
+        if claim_email_send(send_key, audit_id, "approval_request", email_address) is not None:
+            logger.info("🔁 Approval email for audit %s to %s already sent, skipping duplicate", audit_id, email_address)
+            send_key = None
+        send_keys.append(send_key)
+    return send_keys
+
+def build_approval_fanout_messages(invoice_number, invoice_amount, recipients, changes=None, sender_email=None,
+                                   attach_document=None):
+    """
+    Approval request messages for several approvers of the same invoice.
+    `recipients` are (approver_name, approver_email, audit_id) tuples; returns messages in the same order.
+    """
+    if sender_email is None:
+        sender_email = _get_smtp_config()["user"]
+    
+    email_changes = _normalize_email_changes(invoice_number, changes)
+    formatted_amount = f"{invoice_amount:,.2f}"
+    max_line_changes = _max_line_changes_setting()
+    line_count = len(email_changes.get("line_changes") or {})
+    attach_full_diff = line_count > max_line_changes and _attach_full_diff_setting()
+    has_diff = email_changes.get("header_changes") or email_changes.get("line_changes")
+    
+    shared = {
+        "invoice_number": invoice_number,
+        "formatted_amount": formatted_amount,
+        "submission_date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "invoice_view_url": _invoice_view_url(invoice_number),
+    }
+    with _timed_stage("render_html"):
+        html_template = get_email_template("approval_html").partial(dict(
+            shared,
+            changes_html=generate_changes_summary_html(email_changes, max_line_changes, attach_full_diff) if has_diff else "",
+        ))
+    with _timed_stage("render_plain"):
+        changes_text = generate_changes_summary_plain_text(email_changes, max_line_changes, attach_full_diff) if has_diff else ""
+        plain_template = get_email_template("approval_plain").partial(dict(
+            shared,
+            changes_text=changes_text if changes_text else "No specific changes mentioned.",
+        ))
+    full_diff_csv = build_changes_csv(email_changes) if attach_full_diff else None
+    subject = f'APPROVAL REQUIRED: Invoice #{invoice_number} - Amount: ₹{formatted_amount}'
+    if attach_document is None:
+        attach_document = _attach_invoice_document_setting()
+    # Encoded once; every recipient's message shares the same payload string
+    document = _invoice_document_entry(invoice_number, _max_attachment_bytes()) if attach_document else None
+    
+    messages = []
+    for approver_name, approver_email, audit_id in recipients:
+        approve_url, reject_url, request_edit_url = _workflow_action_urls(audit_id)
+        personal = {
+            "approver_name": approver_name,
+            "audit_id": audit_id,
+            "approve_url": approve_url,
+            "reject_url": reject_url,
+            "request_edit_url": request_edit_url,
+        }
+        msg = _mime_multipart()
+        msg['From'] = sender_email
+        msg['To'] = approver_email
+        msg['Subject'] = subject
+        html_content = html_template.render(personal)
+        plain_text = plain_template.render(personal)
+        msg.attach(_mime_text(html_content, 'html'))
+        msg.attach(_mime_text(plain_text, 'plain'))
+        if full_diff_csv is not None:
+            diff_part = _mime_text(full_diff_csv, 'csv', 'utf-8')
+            diff_part.add_header('Content-Disposition', 'attachment', filename=f"invoice_{invoice_number}_changes.csv")
+            msg.attach(diff_part)
+        if document is not None:
+            attach_invoice_document(msg, invoice_number, len(html_content) + len(plain_text), entry=document)
+        messages.append(msg)
+    return messages
+
+@traced()
+def send_approval_fanout(invoice_number, original_amount, changed_amount, approvers, approver_level=None, changes=None, user_id=1):
+    """
+    Request sign-off on one invoice from several approvers in parallel.
+    `approvers` are dicts with approver_name/approver_email or (name, email) tuples.
+    Returns [{"approver_email", "audit_id", "email_ok"}] in approver order, or None if
+    the audit rows could not be created.
+    """
+    recipients = [_fanout_recipient(approver) for approver in approvers]
+    if not recipients:
+        return []
+    entries = [
+        (invoice_number, original_amount, changed_amount, approver_level, email_address, name, user_id)
+        for name, email_address in recipients
+    ]
+    
+    if email_outbox_enabled():
+        # Audit rows and queued emails commit together, as in start_approval_workflow
+        send_keys = []
+        try:
+            with db_connection() as conn:
+                cur = conn.cursor()
+                audit_ids = _insert_workflow_audits(cur, [_audit_row(entry) for entry in entries])
+                cur.close()
+                send_keys = _claim_fanout_sends(recipients, audit_ids)
+                messages = build_approval_fanout_messages(
+                    invoice_number, changed_amount,
+                    [(name, email_address, audit_id) for (name, email_address), audit_id in zip(recipients, audit_ids)],
+                    changes,
+                )
+                for msg, audit_id, send_key in zip(messages, audit_ids, send_keys):
+                    if send_key is not None:
+                        enqueue_email(msg, "approval_request", audit_id=audit_id, conn=conn)
+                conn.commit()
+        except Exception as e:
+            for send_key in send_keys:
+                if send_key is not None:
+                    finish_email_send(send_key, False)
+            logger.error("❌ Fan-out for %s failed: %s", invoice_number, e)
+            return None
+        for send_key in send_keys:
+            if send_key is not None:
+                finish_email_send(send_key, True)
+        logger.info("📬 Approval fan-out for %s queued for %s approvers", invoice_number, len(audit_ids))
+        return [
+            {"approver_email": email_address, "audit_id": audit_id, "email_ok": True}
+            for (_, email_address), audit_id in zip(recipients, audit_ids)
+        ]
+    
+    audit_ids = create_workflow_audits_bulk(entries)
+    if audit_ids is None:
+        return None
+    send_keys = _claim_fanout_sends(recipients, audit_ids)
+    # Duplicates keep their earlier result; only claimed recipients are rendered and sent
+    sent = [True] * len(audit_ids)
+    owned = [index for index, send_key in enumerate(send_keys) if send_key is not None]
+    try:
+        messages = build_approval_fanout_messages(
+            invoice_number, changed_amount,
+            [(recipients[index][0], recipients[index][1], audit_ids[index]) for index in owned],
+            changes,
+        )
+        results = send_email_messages_batch(
+            messages, on_done=[functools.partial(finish_email_send, send_keys[index]) for index in owned]
+        )
+    except Exception as e:
+        logger.error("❌ Failed to render fan-out emails for %s: %s", invoice_number, e)
+        results = [False] * len(owned)
+    for index, ok in zip(owned, results):
+        sent[index] = ok
+        # Deferred sends are finished by the deferred queue once delivered
+        if ok != EMAIL_QUEUED:
+            finish_email_send(send_keys[index], ok)
+    
+    logger.info("📧 Approval fan-out for %s: %s/%s approvers notified", invoice_number, sum(map(bool, sent)), len(sent))
+    return [
+        {"approver_email": email_address, "audit_id": audit_id, "email_ok": ok}
+        for (_, email_address), audit_id, ok in zip(recipients, audit_ids, sent)
+    ]
+
+# 🔥 NEW: Bulk approver actions. All selected audit rows change status in one
+# statement and one transaction; requesters get one consolidated notification each,
+# sent over a single SMTP session after the commit.
+
+# Status written for each action; these are the values the status views already know
+# ('approved', 'rejected', 'request_edit')
+WORKFLOW_ACTION_STATUSES = {
+    'approve': 'approved',
+    'reject': 'rejected',
+    'request_edit': 'request_edit',
+}
+WORKFLOW_ACTIONS = tuple(WORKFLOW_ACTION_STATUSES)
+
+# Every requested row is locked first; under READ COMMITTED the locked row is the
+# latest committed version, so a row another approver changed while we waited is
+# reported with its new status instead of the statement snapshot's 'pending'.
+BULK_WORKFLOW_ACTION_SQL = """
+    WITH requested AS (
+        SELECT DISTINCT unnest(%s::bigint[]) AS id
+    ),
+    locked AS (
+        SELECT w.id, w.status, w.invoice_number, w.change_requested_by
+        FROM "DocAI".workflow_audit_log w
+        JOIN requested r ON r.id = w.id
+        FOR UPDATE OF w
+    ),
+    updated AS (
+        UPDATE "DocAI".workflow_audit_log w
+        SET status = %s
+        FROM locked l
+        WHERE w.id = l.id AND l.status = 'pending'
+        RETURNING w.id
+    )
+    SELECT r.id,
+           u.id IS NOT NULL AS applied,
+           l.invoice_number,
+           l.status AS current_status,
+           l.change_requested_by
+    FROM requested r
+    LEFT JOIN locked l ON l.id = r.id
+    LEFT JOIN updated u ON u.id = r.id
+"""
+
+_EMAIL_TEMPLATE_SOURCES.update({
+    "bulk_notification_html": ("bulk_notification.html", {"escape": True, "raw_slots": ("items_html",)}),
+    "bulk_notification_item_html": ("bulk_notification_item.html", {"escape": True}),
+    "bulk_notification_plain": ("bulk_notification.txt", {"escape": False}),
+})
+
+def _default_requester_email(change_requested_by):
+    """
+    Map a change_requested_by value to an email address: the value itself when it is an
+    address, else unifycode's get_user_email for "user_<id>", else
+    WORKFLOW_DEFAULT_REQUESTER_EMAIL. Returns None when none of these gives an address.
+    """
+    requested_by = str(change_requested_by or "").strip()
+    if "@" in requested_by:
+        return requested_by
+    if requested_by:
+        user_id = requested_by[5:] if requested_by.startswith("user_") else requested_by
+        try:
+            lookup = _unifycode_attr("get_user_email")
+            email_address = lookup(int(user_id) if user_id.isdigit() else user_id) if lookup is not None else None
+            if email_address:
+                return email_address
+        except Exception as e:
+            logger.warning("⚠️ Could not resolve requester email for %s: %s", requested_by, e)
+    return os.getenv('WORKFLOW_DEFAULT_REQUESTER_EMAIL') or None
+
+def build_bulk_action_notification_message(action, entries, notes, recipient_email, sender_email=None):
+    """
+    One status-update email listing every invoice in `entries` (dicts with invoice_number, audit_id)
+    """
+    if sender_email is None:
+        sender_email = _get_smtp_config()["user"]
+    action_info = WORKFLOW_ACTION_DISPLAY.get(action, {'text': action.upper(), 'color': '#6c757d'})
+    item_html = get_email_template("bulk_notification_item_html")
+    
+    msg = _mime_multipart()
+    msg['From'] = sender_email
+    msg['To'] = recipient_email
+    msg['Subject'] = f'Update: {len(entries)} invoices - {action_info["text"]}'
+    
+    values = {
+        "count": len(entries),
+        "action_color": action_info['color'],
+        "action_text": action_info['text'],
+        "notes": notes if notes else 'No additional notes provided.',
+        "items_html": "".join(item_html.render(entry) for entry in entries),
+        "items_text": "".join(f"        - Invoice {entry['invoice_number']} (Audit ID: {entry['audit_id']})\n" for entry in entries),
+    }
+    msg.attach(_mime_text(get_email_template("bulk_notification_html").render(values), 'html'))
+    msg.attach(_mime_text(get_email_template("bulk_notification_plain").render(values), 'plain'))
+    return msg
+
+@traced()
+def process_bulk_workflow_action(audit_ids, action, notes=None, recipient_resolver=None, notify=True):
+    """
+    Apply approve/reject/request_edit to many audit rows in one UPDATE.
+    Only rows still 'pending' change; the rest are reported, not touched.
+    The new status comes from WORKFLOW_ACTION_STATUSES ('approved', 'rejected', 'request_edit').
+    Returns {audit_id: {"ok", "status", "invoice_number", "error", "notified"}} or None if
+    the action is unknown or the update fails (in which case nothing was changed).
+    "notified" is False for an updated row whose requester could not be emailed.
+    """
+    if action not in WORKFLOW_ACTIONS:
+        logger.error("❌ Unknown workflow action: %s", action)
+        return None
+    new_status = WORKFLOW_ACTION_STATUSES[action]
+    
+    # Results follow the caller's order, one entry per distinct id; ids that are not
+    # integers are reported as invalid_id and never reach the database
+    order = []
+    for audit_id in audit_ids:
+        try:
+            order.append(int(audit_id))
+        except (TypeError, ValueError):
+            logger.warning("⚠️ Invalid audit id in bulk action: %r", audit_id)
+            order.append(audit_id if getattr(type(audit_id), "__hash__", None) else repr(audit_id))
+    order = list(dict.fromkeys(order))
+    ids = [audit_id for audit_id in order if isinstance(audit_id, int)]
+    
+    rows = []
+    if ids:
+        try:
+            with _timed_stage("bulk_workflow_action"), db_connection() as conn:
+                cur = conn.cursor()
+                cur.execute(BULK_WORKFLOW_ACTION_SQL, (ids, new_status))
+                rows = cur.fetchall()
+                conn.commit()
+                cur.close()
+        except Exception as e:
+            logger.error("❌ Bulk workflow action '%s' failed: %s", action, e)
+            return None
+    
+    rows_by_id = {row[0]: row for row in rows}
+    results = {}
+    by_requester = {}
+    for audit_id in order:
+        if not isinstance(audit_id, int):
+            results[audit_id] = {"ok": False, "status": None, "invoice_number": None, "error": "invalid_id", "notified": False}
+            continue
+        _, applied, invoice_number, current_status, requested_by = rows_by_id.get(audit_id, (audit_id, False, None, None, None))
+        if applied:
+            results[audit_id] = {"ok": True, "status": new_status, "invoice_number": invoice_number, "error": None,
+                                 "notified": False}
+            by_requester.setdefault(requested_by, []).append({"invoice_number": invoice_number, "audit_id": audit_id})
+        elif current_status is None:
+            results[audit_id] = {"ok": False, "status": None, "invoice_number": None, "error": "not_found", "notified": False}
+        else:
+            results[audit_id] = {
+                "ok": False,
+                "status": current_status,
+                "invoice_number": invoice_number,
+                "error": f"invalid_state: already {current_status}",
+                "notified": False,
+            }
+    
+    applied_count = sum(1 for r in results.values() if r["ok"])
+    logger.info("✅ Bulk %s: %s/%s audit rows updated", action, applied_count, len(results))
+    
+    if notify and by_requester:
+        # The status change is committed; a notification that cannot go out is reported, not raised
+        try:
+            notified = _send_bulk_action_notifications(action, notes, by_requester,
+                                                       recipient_resolver or _default_requester_email)
+        except Exception as e:
+            logger.error("❌ Bulk %s notifications failed: %s", action, e)
+            notified = set()
+        for audit_id in notified:
+            results[audit_id]["notified"] = True
+        missed = [results[entry["audit_id"]]["invoice_number"]
+                  for entries in by_requester.values() for entry in entries if entry["audit_id"] not in notified]
+        if missed:
+            logger.error("❌ Bulk %s: requesters of %s invoices were not notified: %s", action, len(missed), ', '.join(map(str, missed)))
+    return results
+
+def _send_bulk_action_notifications(action, notes, by_requester, recipient_resolver):
+    """
+    Email each requester once; returns the audit ids whose notification was sent or queued
+    """
+    # Several requester ids can share a mailbox; still one email per address
+    by_recipient = {}
+    for requested_by, entries in by_requester.items():
+        try:
+            recipient_email = recipient_resolver(requested_by)
+        except Exception as e:
+            logger.error("❌ Could not resolve requester %s: %s", requested_by, e)
+            recipient_email = None
+        if not recipient_email:
+            logger.error("❌ No email address for requester %s (set WORKFLOW_DEFAULT_REQUESTER_EMAIL or provide "
+                         "unifycode.get_user_email), %s invoices not notified", requested_by, len(entries))
+            continue
+        by_recipient.setdefault(recipient_email, []).extend(entries)
+    
+    notified = set()
+    if notification_coalescing_enabled():
+        coalescer = get_notification_coalescer()
+        rejected = {}
+        for recipient_email, entries in by_recipient.items():
+            for entry in entries:
+                if coalescer.add(entry["invoice_number"], action, notes, recipient_email, entry.get("audit_id")):
+                    notified.add(entry["audit_id"])
+                else:
+                    rejected.setdefault(recipient_email, []).append(entry)
+        # Whatever a closing coalescer turned away is sent directly below
+        by_recipient = rejected
+    
+    smtp_config = _get_smtp_config()
+    messages = [
+        build_bulk_action_notification_message(action, entries, notes, recipient_email, sender_email=smtp_config["user"])
+        for recipient_email, entries in by_recipient.items()
+    ]
+    if not messages:
+        return notified
+    
+    if email_outbox_enabled():
+        results = [enqueue_email(msg, "action_notification") is not None for msg in messages]
+    else:
+        results = send_email_messages_batch(messages, smtp_config)
+    for entries, ok in zip(by_recipient.values(), results):
+        if ok:
+            notified.update(entry["audit_id"] for entry in entries)
+    return notified
+
+# 🔥 NEW: Coalesced requester notifications. Status updates wait per recipient for a
+# short window; later updates to the same invoice replace earlier ones (the trail is
+# kept as one line), and the recipient gets one combined email when the window ends.
+# The buffer is bounded and flushed at interpreter exit.
+
+_EMAIL_TEMPLATE_SOURCES.update({
+    "coalesced_notification_html": ("coalesced_notification.html", {"escape": True, "raw_slots": ("items_html",)}),
+    "coalesced_notification_item_html": ("coalesced_notification_item.html", {"escape": True}),
+    "coalesced_notification_plain": ("coalesced_notification.txt", {"escape": False}),
+    "coalesced_notification_item_plain": ("coalesced_notification_item.txt", {"escape": False}),
+})
+
+def notification_coalescing_enabled():
+    return os.getenv('WORKFLOW_NOTIFICATION_COALESCE', '0') == '1'
+
+def _action_display(action):
+    return WORKFLOW_ACTION_DISPLAY.get(action, {'text': action.upper(), 'color': '#6c757d'})
+
+def build_coalesced_notification_message(recipient_email, updates, sender_email=None):
+    """
+    One email for a recipient's buffered updates. `updates` are dicts with
+    invoice_number, action, notes and superseded (earlier actions, oldest first).
+    A single update with nothing superseded renders as the usual single-invoice email.
+    """
+    if len(updates) == 1 and not updates[0]["superseded"]:
+        update = updates[0]
+        return build_action_notification_message(update["invoice_number"], update["action"], update["notes"],
+                                                 recipient_email, sender_email)
+    if sender_email is None:
+        sender_email = _get_smtp_config()["user"]
+    item_html = get_email_template("coalesced_notification_item_html")
+    item_plain = get_email_template("coalesced_notification_item_plain")
+    
+    items_html = []
+    items_text = []
+    for update in updates:
+        action_info = _action_display(update["action"])
+        trail = [_action_display(action)['text'] for action in update["superseded"]]
+        values = {
+            "invoice_number": update["invoice_number"],
+            "action_color": action_info['color'],
+            "action_text": action_info['text'],
+            "trail": f"Earlier: {' → '.join(trail)}" if trail else "",
+            "trail_text": f"\n        Earlier: {' → '.join(trail)}" if trail else "",
+            "notes": update["notes"] if update["notes"] else 'No additional notes provided.',
+        }
+        items_html.append(item_html.render(values))
+        items_text.append(item_plain.render(values))
+    
+    msg = _mime_multipart()
+    msg['From'] = sender_email
+    msg['To'] = recipient_email
+    if len(updates) == 1:
+        msg['Subject'] = f'Update: Invoice #{updates[0]["invoice_number"]} - {_action_display(updates[0]["action"])["text"]}'
+    else:
+        msg['Subject'] = f'Update: {len(updates)} invoices'
+    
+    with _timed_stage("render_html"):
+        html_content = get_email_template("coalesced_notification_html").render({
+            "count": len(updates), "items_html": "".join(items_html),
+        })
+    msg.attach(_mime_text(html_content, 'html'))
+    with _timed_stage("render_plain"):
+        plain_text = get_email_template("coalesced_notification_plain").render({
+            "count": len(updates), "items_text": "".join(items_text),
+        })
+    msg.attach(_mime_text(plain_text, 'plain'))
+    return msg
+
+# NotificationCoalescer.add result for an update that replaced a buffered one
+NOTIFICATION_MERGED = "merged"
+
+class NotificationCoalescer:
+    """
+    Buffers status updates per recipient and sends each recipient one combined email
+    `window_seconds` after their first buffered update. Holds at most `max_pending`
+    invoices; past that the oldest recipient's batch is sent straight away. A batch whose
+    last send attempt fails is moved to the outbox (when its table exists), not dropped.
+    """
+
+    def __init__(self, window_seconds=120.0, max_pending=5000, max_retries=3):
+        self.window_seconds = window_seconds
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+        self._buckets = {}  # recipient_email -> {"due_at", "attempts", "updates": {invoice_number: update}}
+        self._pending = 0
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._stats = {"updates": 0, "superseded": 0, "emails": 0, "forced": 0, "spilled": 0, "dropped": 0,
+                       "rejected": 0}
+        self._thread = threading.Thread(target=self._run, name="notification-coalescer", daemon=True)
+        self._thread.start()
+
+    def _bump(self, name, amount=1):
+        self._stats[name] += amount
+
+    def add(self, invoice_number, action, notes, recipient_email, audit_id=None):
+        """
+        Buffer one update. Returns EMAIL_QUEUED for a new update, NOTIFICATION_MERGED when
+        it replaced a buffered update for the same invoice, and False once the coalescer is
+        closed (the caller has to send it another way).
+        """
+        overflow = None
+        with self._cond:
+            if self._stopped:
+                self._bump("rejected")
+                return False
+            bucket = self._buckets.get(recipient_email)
+            if bucket is None:
+                bucket = self._buckets[recipient_email] = {
+                    "due_at": time.monotonic() + self.window_seconds,
+                    "attempts": 0,
+                    "updates": {},
+                }
+            self._bump("updates")
+            previous = bucket["updates"].pop(invoice_number, None)
+            if previous is not None:
+                # request_edit → resubmitted → approved within the window: only the last state is sent
+                superseded = previous["superseded"] + [previous["action"]]
+                self._bump("superseded")
+            else:
+                superseded = []
+                self._pending += 1
+            bucket["updates"][invoice_number] = {
+                "invoice_number": invoice_number,
+                "action": action,
+                "notes": notes,
+                "audit_id": audit_id,
+                "superseded": superseded,
+            }
+            if self._pending > self.max_pending:
+                oldest = min(self._buckets, key=lambda email_address: self._buckets[email_address]["due_at"])
+                overflow = [(oldest, self._pop(oldest))]
+                self._bump("forced")
+            self._cond.notify()
+        if previous is not None:
+            _workflow_metrics.increment("notifications_superseded")
+        if overflow:
+            self._send(overflow)
+        return NOTIFICATION_MERGED if previous is not None else EMAIL_QUEUED
+
+    def _pop(self, recipient_email):
+        bucket = self._buckets.pop(recipient_email)
+        self._pending -= len(bucket["updates"])
+        return bucket
+
+    def pending(self):
+        with self._cond:
+            return {email_address: len(bucket["updates"]) for email_address, bucket in self._buckets.items()}
+
+    def stats(self):
+        with self._cond:
+            return dict(self._stats, pending=self._pending, recipients=len(self._buckets))
+
+    def _take_due(self, force=False):
+        now = time.monotonic()
+        return [
+            (email_address, self._pop(email_address))
+            for email_address in list(self._buckets)
+            if force or self._buckets[email_address]["due_at"] <= now
+        ]
+
+    def _send(self, due):
+        smtp_config = _get_smtp_config()
+        messages = [
+            build_coalesced_notification_message(email_address, list(bucket["updates"].values()), smtp_config["user"])
+            for email_address, bucket in due
+        ]
+        if email_outbox_enabled():
+            results = [enqueue_email(msg, "action_notification") is not None for msg in messages]
+        else:
+            results = send_email_messages_batch(messages, smtp_config, "action_notification")
+        
+        for (email_address, bucket), msg, ok in zip(due, messages, results):
+            if ok:
+                with self._cond:
+                    self._bump("emails")
+                logger.info("📧 Coalesced status update for %s invoices sent to %s", len(bucket['updates']), email_address)
+                continue
+            if bucket["attempts"] >= self.max_retries or self._stopped:
+                self._give_up(email_address, bucket, msg)
+                continue
+            with self._cond:
+                current = self._buckets.get(email_address)
+                if current is None:
+                    bucket["attempts"] += 1
+                    bucket["due_at"] = time.monotonic() + self.window_seconds
+                    self._buckets[email_address] = bucket
+                    self._pending += len(bucket["updates"])
+                    continue
+                # Newer updates arrived meanwhile and win over the failed ones
+                for invoice_number, update in bucket["updates"].items():
+                    if invoice_number not in current["updates"]:
+                        current["updates"][invoice_number] = update
+                        self._pending += 1
+
+    def _give_up(self, email_address, bucket, msg):
+        # Last attempt failed (or we are shutting down): hand the email to the outbox workers
+        count = len(bucket["updates"])
+        if email_outbox_available() and enqueue_email(msg, "action_notification") is not None:
+            with self._cond:
+                self._bump("spilled", count)
+            logger.warning("⚠️ Coalesced status update for %s invoices to %s moved to the outbox after %s failed sends",
+                           count, email_address, bucket['attempts'] + 1)
+            return
+        with self._cond:
+            self._bump("dropped", count)
+        logger.error("❌ Dropping %s status updates for %s after %s failed sends (outbox unavailable): %s",
+                     count, email_address, bucket['attempts'] + 1, ', '.join(map(str, bucket['updates'])))
+
+    def flush(self):
+        """
+        Send every buffered update now
+        """
+        with self._cond:
+            due = self._take_due(force=True)
+        if due:
+            self._send(due)
+
+    def close(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join()
+        self.flush()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    due = self._take_due()
+                    if due:
+                        break
+                    next_due = min((bucket["due_at"] for bucket in self._buckets.values()), default=None)
+                    self._cond.wait(None if next_due is None else max(next_due - time.monotonic(), 0.0))
+                if self._stopped:
+                    return
+            try:
+                self._send(due)
+            except Exception as e:
+                logger.error("❌ Notification coalescer flush failed: %s", e)
+
+_notification_coalescer = None
+_notification_coalescer_lock = threading.Lock()
+
+def get_notification_coalescer():
+    global _notification_coalescer
+    if _notification_coalescer is None:
+        with _notification_coalescer_lock:
+            if _notification_coalescer is None:
+                _notification_coalescer = NotificationCoalescer(
+                    window_seconds=float(os.getenv('WORKFLOW_NOTIFICATION_WINDOW_SECONDS', 120)),
+                    max_pending=int(os.getenv('WORKFLOW_NOTIFICATION_MAX_PENDING', 5000)),
+                )
+    return _notification_coalescer
+
+def flush_notification_coalescer():
+    """
+    Send all buffered status updates immediately (also runs at interpreter exit)
+    """
+    global _notification_coalescer
+    with _notification_coalescer_lock:
+        coalescer, _notification_coalescer = _notification_coalescer, None
+    if coalescer is not None:
+        coalescer.close()
+
+# 🔥 NEW: Optional background pre-warm for serverless workers: import the heavy
+# dependencies, open the DB pool and an SMTP session, and load the hierarchy snapshot
+# and templates while the worker is otherwise idle.
+
+def prewarm(db=True, smtp=True, background=True):
+    """
+    Warm up connections and caches; returns the thread when run in the background
+    """
+    def _run():
+        started = time.perf_counter()
+        precompile_email_templates()
+        if db:
+            try:
+                get_db_pool()
+                get_approval_hierarchy().refresh_if_needed()
+            except Exception as e:
+                logger.warning("⚠️ DB pre-warm failed: %s", e)
+        if smtp:
+            smtp_config = _get_smtp_config()
+            if smtp_config["user"] and smtp_config["password"]:
+                try:
+                    with get_smtp_pool().session(smtp_config):
+                        pass
+                except Exception as e:
+                    logger.warning("⚠️ SMTP pre-warm failed: %s", e)
+        logger.info("🔥 Workflow pre-warm finished in %.0f ms", (time.perf_counter() - started) * 1000)
+    
+    if not background:
+        _run()
+        return None
+    thread = threading.Thread(target=_run, name="workflow-prewarm", daemon=True)
+    thread.start()
+    return thread
+
+def prewarm_from_env():
+    """
+    WORKFLOW_PREWARM=1 warms everything; "db" or "smtp" (comma separated) picks parts
+    """
+    setting = os.getenv('WORKFLOW_PREWARM', '').strip().lower()
+    if not setting or setting == '0':
+        return None
+    parts = {part.strip() for part in setting.split(',')}
+    everything = setting in ('1', 'true', 'all')
+    return prewarm(db=everything or 'db' in parts, smtp=everything or 'smtp' in parts)
+
+# 🔥 NEW: Setup and teardown for all of the subsystems in one place. Importing the
+# module creates no tables, starts no threads and reads no feature switches; the app
+# calls ensure_workflow_schema() from its migrations and configure_from_env() at startup.
+
+def start_sla_scheduler(**settings):
+    """
+    Start the SLA reminder/escalation scheduler, building its emails with this module's
+    approval email, pending-changes lookup and approval hierarchy
+    """
+    return workflow_sla.start_sla_scheduler(build_approval_email_message, get_pending_changes_for_emails,
+                                            get_approval_hierarchy, **settings)
+
+def ensure_workflow_schema():
+    """
+    Create the tables, columns and indexes the optional workflow features use.
+    Returns the names of the steps that failed.
+    """
+    steps = [
+        ("approval_rules", ensure_approval_rules_table),
+        ("email_send_log", ensure_email_send_log_table),
+        ("email_outbox", ensure_email_outbox_table),
+        ("workflow_sla", ensure_workflow_sla_schema),
+        ("audit_history_indexes", ensure_audit_history_indexes),
+    ]
+    failed = []
+    for name, step in steps:
+        try:
+            step()
+        except Exception as e:
+            logger.error("❌ Workflow schema step %s failed: %s", name, e)
+            failed.append(name)
+    if not failed:
+        logger.info("✅ Workflow schema is up to date")
+    return failed
+
+def configure_from_env():
+    """
+    Apply the WORKFLOW_TRACE* / WORKFLOW_PROFILE* and WORKFLOW_PREWARM switches, and start
+    the outbox delivery workers in outbox mode (or anywhere with WORKFLOW_OUTBOX_WORKER=1,
+    e.g. to drain deferred sends spilled to the outbox; WORKFLOW_OUTBOX_WORKER=0 leaves
+    delivery to another process)
+    """
+    configure_tracing_from_env()
+    outbox_worker = os.getenv('WORKFLOW_OUTBOX_WORKER', '1' if email_outbox_enabled() else '0')
+    if outbox_worker == '1':
+        start_email_outbox_worker()
+    return prewarm_from_env()
+
+def shutdown_workflow():
+    """
+    Flush buffered emails and audit rows, stop background threads and close the pools.
+    Registered with atexit; safe to call more than once.
+    """
+    steps = [
+        flush_notification_coalescer,
+        flush_approval_digests,
+        flush_send_log,
+        disable_audit_group_commit,
+        stop_sla_scheduler,
+        stop_email_outbox_worker,
+        get_deferred_sends().stop,
+        stop_approval_hierarchy_listener,
+        close_smtp_pool,
+        lambda: configure_tracing(False),
+        close_db_pool,
+    ]
+    for step in steps:
+        try:
+            step()
+        except Exception as e:
+            logger.warning("⚠️ Workflow shutdown step failed: %s", e)
+
+atexit.register(shutdown_workflow)
@@ -0,0 +1,118 @@
+"""
+Shared plumbing for the workflow modules: lazily imported dependencies, the logger,
+unifycode lookups and small helpers.
+"""
+
+import logging
+import importlib
+import threading
+from collections import OrderedDict
+
+__all__ = [
+    "NO_PENDING_CHANGES",
+    "logger",
+]
+
+class _LazyModule:
+    """
+    Stand-in for a module that is only imported on first attribute access
+    """
+
+    def __init__(self, name):
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+
+    def _load(self):
+        module = self.__dict__["_module"]
+        if module is None:
+            module = self.__dict__["_module"] = importlib.import_module(self.__dict__["_name"])
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+# Heavy dependencies (libpq, smtplib -> ssl/socket, the email.mime tree) load on first
+# use so importing this module stays cheap in short-lived serverless workers
+psycopg2 = _LazyModule("psycopg2")
+_psycopg2_extras = _LazyModule("psycopg2.extras")
+smtplib = _LazyModule("smtplib")
+_email_mime_text = _LazyModule("email.mime.text")
+_email_mime_multipart = _LazyModule("email.mime.multipart")
+_email_mime_base = _LazyModule("email.mime.base")
+_email_mime_nonmultipart = _LazyModule("email.mime.nonmultipart")
+
+# Import logger from unifycode
+try:
+    from unifycode import logger
+except ImportError:
+    # Create a fallback logger if import fails
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    logger = logging.getLogger("workflow")
+
+# Email body for an invoice without pending changes (approval emails, SLA reminders)
+NO_PENDING_CHANGES = {"notes": "No changes specified"}
+
+_unifycode_attrs = {}
+
+def _unifycode_attr(name):
+    """
+    Look up a helper from unifycode once and cache the binding (None if it does not exist)
+    """
+    try:
+        return _unifycode_attrs[name]
+    except KeyError:
+        pass
+    import unifycode
+    value = _unifycode_attrs[name] = getattr(unifycode, name, None)
+    return value
+
+# Use the same DB connection function from unifycode.py
+def _create_raw_db_connection():
+    return _unifycode_attr("get_db_connection")()
+
+def _log_event(level, message, **fields):
+    """
+    Levelled log line with key=value fields appended; the fields are also attached to
+    the record as `workflow` for JSON formatters
+    """
+    if not logger.isEnabledFor(level):
+        return
+    if fields:
+        message = f"{message} " + " ".join(f"{key}={value}" for key, value in fields.items())
+    logger.log(level, message, extra={"workflow": fields})
+
+class _BoundedCache:
+    """
+    Thread-safe LRU mapping with a fixed number of entries
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return default
+            return self._data[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,367 @@
+"""
+Process-wide, health-checked Postgres connection pool.
+"""
+
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from workflow_core import _create_raw_db_connection, logger, psycopg2
+from workflow_tracing import _current_span, trace_span
+
+__all__ = [
+    "DBConnectionPool",
+    "DBPoolTimeout",
+    "close_db_pool",
+    "configure_db_pool",
+    "db_connection",
+    "get_db_connection",
+    "get_db_pool",
+    "get_db_pool_stats",
+]
+
+# 🔥 NEW: Process-wide connection pool so each workflow call stops paying for a new
+# TCP + auth handshake to Postgres
+
+class DBPoolTimeout(Exception):
+    """
+    Raised when no pooled connection becomes available within the checkout timeout
+    """
+
+class _PooledConnection:
+    """
+    Thin wrapper around a psycopg2 connection borrowed from a DBConnectionPool.
+    close() hands the connection back to the pool instead of closing the socket,
+    so existing `conn.close()` call sites keep working unchanged.
+    """
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+        self._broken = False
+
+    def __getattr__(self, name):
+        if self._conn is None:
+            raise psycopg2.InterfaceError("connection already returned to pool")
+        return getattr(self._conn, name)
+
+    def __enter__(self):
+        # `with conn:` is a transaction block, as on a psycopg2 connection, but the
+        # block must see this wrapper so cursors stay traced and close() still returns it
+        self.__getattr__("__enter__")()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return self.__getattr__("__exit__")(exc_type, exc, tb)
+
+    def cursor(self, *args, **kwargs):
+        cur = self.__getattr__("cursor")(*args, **kwargs)
+        return _TracedCursor(cur) if _current_span.get() is not None else cur
+
+    def mark_broken(self):
+        self._broken = True
+
+    def close(self):
+        if self._conn is None:
+            return
+        conn, self._conn = self._conn, None
+        self._pool.release(conn, broken=self._broken)
+
+class _TracedCursor:
+    """
+    Cursor proxy used inside a trace: every execute/executemany becomes a db_execute span
+    """
+
+    __slots__ = ("_cursor",)
+
+    def __init__(self, cursor):
+        object.__setattr__(self, "_cursor", cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._cursor, name, value)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        self._cursor.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return self._cursor.__exit__(exc_type, exc, tb)
+
+    def execute(self, query, params=None):
+        with trace_span("db_execute", sql=_sql_label(query)):
+            return self._cursor.execute(query, params)
+
+    def executemany(self, query, params_seq):
+        with trace_span("db_executemany", sql=_sql_label(query)):
+            return self._cursor.executemany(query, params_seq)
+
+def _sql_label(query, limit=120):
+    if isinstance(query, bytes):
+        query = query[:limit * 4].decode("utf-8", "replace")
+    elif not isinstance(query, str):
+        query = str(query)
+    return " ".join(query[:limit * 4].split())[:limit]
+
+class DBConnectionPool:
+    """
+    Thread-safe pool of database connections with checkout timeouts and
+    liveness checks on borrow
+    """
+
+    def __init__(self, factory, minconn=1, maxconn=10, timeout=5.0):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError(f"Invalid pool size: min={minconn}, max={maxconn}")
+        self.factory = factory
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self._idle = deque()
+        self._size = 0
+        self._in_use = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._stats = {
+            "checkouts": 0,
+            "waits": 0,
+            "wait_time_total": 0.0,
+            "timeouts": 0,
+            "created": 0,
+            "discarded": 0,
+            "health_check_failures": 0,
+        }
+
+        for _ in range(minconn):
+            with self._cond:
+                self._size += 1
+            try:
+                conn = self._open()
+            except Exception as e:
+                logger.warning("⚠️ Could not pre-open pooled DB connection: %s", e)
+                break
+            with self._cond:
+                self._idle.append(conn)
+
+    def _open(self):
+        # Caller has already reserved a slot by bumping self._size
+        try:
+            conn = self.factory()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._stats["created"] += 1
+        return conn
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._size -= 1
+            self._stats["discarded"] += 1
+            self._cond.notify()
+
+    def _is_alive(self, conn):
+        # Pinged on every checkout: a server-side disconnect is not visible in conn.closed
+        # until the socket is used, however recently the connection came back
+        if getattr(conn, "closed", 0):
+            return False
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.fetchone()
+            cur.close()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def acquire(self, timeout=None):
+        """
+        Borrow a live connection, waiting up to `timeout` seconds for one to free up
+        """
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        waited_from = None
+
+        while True:
+            conn = None
+            create = False
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise psycopg2.InterfaceError("connection pool is closed")
+                    if self._idle:
+                        conn = self._idle.pop()
+                        break
+                    if self._size < self.maxconn:
+                        self._size += 1
+                        create = True
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats["timeouts"] += 1
+                        raise DBPoolTimeout(
+                            f"No database connection available within {timeout}s "
+                            f"(pool size {self.maxconn})"
+                        )
+                    if waited_from is None:
+                        waited_from = time.monotonic()
+                        self._stats["waits"] += 1
+                    self._cond.wait(remaining)
+
+            if create:
+                conn = self._open()
+            elif not self._is_alive(conn):
+                with self._cond:
+                    self._stats["health_check_failures"] += 1
+                self._discard(conn)
+                continue
+
+            with self._cond:
+                self._in_use += 1
+                self._stats["checkouts"] += 1
+                if waited_from is not None:
+                    self._stats["wait_time_total"] += time.monotonic() - waited_from
+            return _PooledConnection(self, conn)
+
+    def release(self, conn, broken=False):
+        """
+        Return a connection to the pool, discarding it if it is no longer usable
+        """
+        with self._cond:
+            self._in_use -= 1
+
+        if not broken and not getattr(conn, "closed", 0):
+            try:
+                # Never hand the next borrower a half-finished transaction
+                conn.rollback()
+            except Exception:
+                broken = True
+        else:
+            broken = True
+
+        if broken or self._closed:
+            self._discard(conn)
+            return
+
+        with self._cond:
+            self._idle.append(conn)
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """
+        Context-manager checkout: the connection is returned to the pool on exit
+        and discarded if the block failed with a connection-level error
+        """
+        with trace_span("db_acquire"):
+            conn = self.acquire(timeout)
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            conn.mark_broken()
+            raise
+        finally:
+            conn.close()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = list(self._idle), deque()
+            self._cond.notify_all()
+        for conn in idle:
+            self._discard(conn)
+
+    def stats(self):
+        with self._cond:
+            return dict(
+                self._stats,
+                size=self._size,
+                idle=len(self._idle),
+                in_use=self._in_use,
+                minconn=self.minconn,
+                maxconn=self.maxconn,
+            )
+
+_db_pool = None
+_db_pool_pid = None
+_db_pool_lock = threading.Lock()
+
+def _db_pool_settings():
+    return {
+        "minconn": int(os.getenv('WORKFLOW_DB_POOL_MIN', 1)),
+        "maxconn": int(os.getenv('WORKFLOW_DB_POOL_MAX', 10)),
+        "timeout": float(os.getenv('WORKFLOW_DB_POOL_TIMEOUT', 5)),
+    }
+
+def get_db_pool():
+    """
+    Return the process-wide connection pool, creating it on first use.
+    A forked child gets its own pool rather than sharing the parent's sockets.
+    """
+    global _db_pool, _db_pool_pid
+    pool = _db_pool
+    if pool is not None and _db_pool_pid == os.getpid():
+        return pool
+    with _db_pool_lock:
+        if _db_pool is None or _db_pool_pid != os.getpid():
+            _db_pool = DBConnectionPool(_create_raw_db_connection, **_db_pool_settings())
+            _db_pool_pid = os.getpid()
+            logger.info("🔌 Workflow DB pool ready (min=%s, max=%s)", _db_pool.minconn, _db_pool.maxconn)
+        return _db_pool
+
+def configure_db_pool(factory=None, **settings):
+    """
+    Replace the process-wide pool, e.g. to resize it or plug in another connection factory.
+    Accepts minconn, maxconn and timeout.
+    """
+    global _db_pool, _db_pool_pid
+    merged = _db_pool_settings()
+    merged.update(settings)
+    with _db_pool_lock:
+        old = _db_pool
+        _db_pool = DBConnectionPool(factory or _create_raw_db_connection, **merged)
+        _db_pool_pid = os.getpid()
+    if old is not None:
+        old.close()
+    return _db_pool
+
+def close_db_pool():
+    global _db_pool
+    with _db_pool_lock:
+        old, _db_pool = _db_pool, None
+    if old is not None:
+        old.close()
+
+def get_db_pool_stats():
+    """
+    Checkout/wait/timeout counters for sizing the pool
+    """
+    pool = _db_pool
+    if pool is None:
+        return dict(_db_pool_settings(), size=0, idle=0, in_use=0)
+    return pool.stats()
+
+def get_db_connection():
+    """
+    Borrow a pooled connection. Calling close() on it returns it to the pool.
+    """
+    return get_db_pool().acquire()
+
+def db_connection(timeout=None):
+    """
+    Context manager that borrows a pooled connection and always gives it back
+    """
+    return get_db_pool().connection(timeout)
@@ -0,0 +1,192 @@
+"""
+Per-stage latency histograms and counters for the approval pipeline.
+"""
+
+import os
+import threading
+import time
+import bisect
+from contextlib import contextmanager
+
+from workflow_tracing import trace_span
+
+__all__ = [
+    "WORKFLOW_LATENCY_BUCKETS",
+    "WorkflowMetrics",
+    "get_workflow_metrics",
+    "reset_workflow_metrics",
+]
+
+# 🔥 NEW: Per-stage latency metrics. Every pipeline stage (routing, audit insert,
+# pending-change lookup, rendering, SMTP connect/starttls/login/send) records into a
+# histogram; failures are counted per stage and exception class. Exposed as
+# Prometheus text by render_prometheus_metrics().
+
+WORKFLOW_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class WorkflowMetrics:
+    """
+    Thread-safe per-stage latency histograms and failure counters
+    """
+
+    def __init__(self, buckets=WORKFLOW_LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._failures = {}
+        self._counters = {}
+
+    def observe(self, stage, seconds):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                # one slot per bucket plus +Inf, then count and sum
+                histogram = self._histograms[stage] = [[0] * (len(self.buckets) + 1), 0, 0.0]
+            histogram[0][index] += 1
+            histogram[1] += 1
+            histogram[2] += seconds
+
+    def failure(self, stage, exc):
+        key = (stage, type(exc).__name__)
+        with self._lock:
+            self._failures[key] = self._failures.get(key, 0) + 1
+
+    def increment(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def reset(self, buckets=None):
+        with self._lock:
+            if buckets is not None:
+                self.buckets = tuple(sorted(buckets))
+            self._histograms.clear()
+            self._failures.clear()
+            self._counters.clear()
+
+    def quantile(self, stage, q):
+        """
+        Estimate a latency quantile (seconds) from the histogram buckets, interpolating
+        linearly inside the bucket the same way Prometheus' histogram_quantile does
+        """
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None or histogram[1] == 0:
+                return None
+            counts, total = list(histogram[0]), histogram[1]
+        rank = q * total
+        seen = 0
+        lower = 0.0
+        for index, count in enumerate(counts):
+            if index == len(self.buckets):
+                return self.buckets[-1]
+            upper = self.buckets[index]
+            if count and seen + count >= rank:
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+            lower = upper
+        return self.buckets[-1]
+
+    def snapshot(self):
+        """
+        Plain-dict view: {"stages": {stage: {count, sum, p50, p99}}, "failures": {...}, "counters": {...}}
+        """
+        with self._lock:
+            stages = {stage: (h[1], h[2]) for stage, h in self._histograms.items()}
+            failures = {f"{stage}:{exc}": n for (stage, exc), n in self._failures.items()}
+            counters = {
+                name + "".join(f"{{{k}={v}}}" for k, v in labels): n
+                for (name, labels), n in self._counters.items()
+            }
+        return {
+            "stages": {
+                stage: {
+                    "count": count,
+                    "sum": total,
+                    "p50": self.quantile(stage, 0.5),
+                    "p99": self.quantile(stage, 0.99),
+                }
+                for stage, (count, total) in sorted(stages.items())
+            },
+            "failures": failures,
+            "counters": counters,
+        }
+
+    def render_prometheus(self, prefix="workflow"):
+        with self._lock:
+            histograms = {stage: (list(h[0]), h[1], h[2]) for stage, h in self._histograms.items()}
+            failures = dict(self._failures)
+            counters = dict(self._counters)
+
+        lines = [
+            f"# HELP {prefix}_stage_duration_seconds Latency of approval pipeline stages.",
+            f"# TYPE {prefix}_stage_duration_seconds histogram",
+        ]
+        for stage in sorted(histograms):
+            counts, count, total = histograms[stage]
+            label = _prometheus_label_value(stage)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{prefix}_stage_duration_seconds_bucket{{stage="{label}",le="{bound:g}"}} {cumulative}')
+            lines.append(f'{prefix}_stage_duration_seconds_bucket{{stage="{label}",le="+Inf"}} {count}')
+            lines.append(f'{prefix}_stage_duration_seconds_sum{{stage="{label}"}} {total:.6f}')
+            lines.append(f'{prefix}_stage_duration_seconds_count{{stage="{label}"}} {count}')
+
+        lines.append(f"# HELP {prefix}_stage_failures_total Failed approval pipeline stages by exception class.")
+        lines.append(f"# TYPE {prefix}_stage_failures_total counter")
+        for (stage, exc), n in sorted(failures.items()):
+            lines.append(
+                f'{prefix}_stage_failures_total{{stage="{_prometheus_label_value(stage)}",'
+                f'exception="{_prometheus_label_value(exc)}"}} {n}'
+            )
+
+        for name in sorted({name for name, _ in counters}):
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            for (counter, labels), n in sorted(counters.items()):
+                if counter != name:
+                    continue
+                label_text = ",".join(f'{k}="{_prometheus_label_value(v)}"' for k, v in labels)
+                lines.append(f"{prefix}_{name}_total{{{label_text}}} {n}" if label_text else f"{prefix}_{name}_total {n}")
+        return "\n".join(lines) + "\n"
+
+def _prometheus_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+_workflow_metrics = WorkflowMetrics()
+_metrics_enabled = os.getenv('WORKFLOW_METRICS', '1') != '0'
+
+@contextmanager
+def _timed_stage(stage):
+    """
+    Record the wall time of the block under `stage`; exceptions are counted and re-raised
+    """
+    with trace_span(stage):
+        if not _metrics_enabled:
+            yield
+            return
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            _workflow_metrics.failure(stage, e)
+            raise
+        finally:
+            _workflow_metrics.observe(stage, time.perf_counter() - started)
+
+def _record_stage_failure(stage, exc):
+    """
+    Count a failure that the caller handles without raising (e.g. a refused recipient)
+    """
+    if _metrics_enabled:
+        _workflow_metrics.failure(stage, exc)
+
+def get_workflow_metrics():
+    return _workflow_metrics.snapshot()
+
+def reset_workflow_metrics(buckets=None):
+    """
+    Clear all recorded metrics, optionally switching to different histogram buckets
+    """
+    _workflow_metrics.reset(buckets)
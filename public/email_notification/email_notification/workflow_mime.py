@@ -0,0 +1,110 @@
+"""
+MIME part construction, transfer-encoding choice and wire-size accounting.
+"""
+
+import os
+import base64
+import binascii
+import logging
+
+from workflow_core import _email_mime_base, _email_mime_multipart, _email_mime_nonmultipart, _email_mime_text, _log_event
+from workflow_metrics import _metrics_enabled, _workflow_metrics
+
+__all__ = [
+    "email_payload_report",
+]
+
+# The email.mime classes load lazily (see workflow_core), so parts are built through
+# these factories rather than under the stdlib class names; non-ASCII text parts are
+# built in the smallest transfer encoding instead of always base64, and bytes-on-wire
+# are counted per delivery path.
+
+def _mime_text(text, subtype='plain', charset=None):
+    """
+    email.mime.text.MIMEText, except non-ASCII UTF-8 text gets the smallest transfer encoding
+    """
+    if isinstance(text, str) and charset in (None, 'utf-8') and not text.isascii():
+        return _utf8_text_part(text, subtype)
+    return _email_mime_text.MIMEText(text, subtype, charset)
+
+def _mime_multipart(*args, **kwargs):
+    return _email_mime_multipart.MIMEMultipart(*args, **kwargs)
+
+def _mime_base(*args, **kwargs):
+    return _email_mime_base.MIMEBase(*args, **kwargs)
+
+# Bytes that quoted-printable carries as-is (everything else becomes =XX)
+_QP_LITERAL_BYTES = bytes(range(32, 127)).replace(b"=", b"") + b"\r\n\t"
+
+def _choose_transfer_encoding(data):
+    """
+    Smallest allowed encoding for a non-ASCII UTF-8 body, by size estimate.
+    WORKFLOW_EMAIL_TRANSFER_ENCODING: auto (default), base64, quoted-printable or 8bit;
+    8bit is only considered with WORKFLOW_EMAIL_8BIT=1 (relay supports 8BITMIME).
+    """
+    mode = os.getenv('WORKFLOW_EMAIL_TRANSFER_ENCODING', 'auto').lower()
+    allow_8bit = mode == '8bit' or (mode == 'auto' and os.getenv('WORKFLOW_EMAIL_8BIT', '0') == '1')
+    if allow_8bit and max(map(len, data.split(b"\n"))) <= 998:
+        return "8bit"
+    if mode in ('base64', 'quoted-printable'):
+        return mode
+    escaped = len(data.translate(None, _QP_LITERAL_BYTES))
+    qp_size = len(data) + 2 * escaped
+    qp_size += qp_size // 75 * 3  # soft line breaks
+    base64_size = (len(data) + 56) // 57 * 78
+    return "quoted-printable" if qp_size < base64_size else "base64"
+
+def _utf8_text_part(text, subtype):
+    """
+    text/<subtype>; charset="utf-8" part in the chosen transfer encoding. Quoted-printable
+    goes through binascii (C) rather than the much slower email.quoprimime.
+    """
+    data = text.encode('utf-8')
+    encoding = _choose_transfer_encoding(data)
+    part = _email_mime_nonmultipart.MIMENonMultipart('text', subtype, charset='utf-8')
+    if encoding == "quoted-printable":
+        payload = binascii.b2a_qp(data, istext=True).decode('ascii')
+    elif encoding == "8bit":
+        payload = data.decode('ascii', 'surrogateescape')
+    else:
+        payload = base64.encodebytes(data).decode('ascii')
+    part['Content-Transfer-Encoding'] = encoding
+    part.set_payload(payload)
+    return part
+
+def email_payload_report(msg):
+    """
+    Bytes-on-wire of a message and of each leaf part (content type, transfer encoding, bytes)
+    """
+    parts = [
+        {
+            "content_type": part.get_content_type(),
+            "transfer_encoding": part.get('Content-Transfer-Encoding', '7bit'),
+            "bytes": len(part.get_payload()),
+        }
+        for part in msg.walk() if not part.is_multipart()
+    ]
+    return {"bytes": len(msg.as_bytes()), "parts": parts}
+
+def _estimated_wire_size(msg):
+    """
+    Serialized size from headers and encoded payloads without flattening the message
+    again (within a few dozen bytes per part: boundaries are not generated yet)
+    """
+    size = 0
+    for part in msg.walk():
+        size += sum(len(name) + len(str(value)) + 4 for name, value in part.items()) + 2
+        if part.is_multipart():
+            size += (len(part.get_payload()) + 1) * 36
+        else:
+            payload = part.get_payload()
+            size += len(payload) + payload.count("\n")
+    return size
+
+def _record_wire_size(msg, path, payload=None):
+    if not _metrics_enabled:
+        return
+    size = len(payload) if payload is not None else _estimated_wire_size(msg)
+    _workflow_metrics.increment("email_wire_bytes", size, path=path)
+    _workflow_metrics.increment("email_messages_measured", path=path)
+    _log_event(logging.DEBUG, "📏 Email size on the wire", recipient=msg['To'], bytes=size, path=path)
@@ -0,0 +1,562 @@
+"""
+Durable email outbox, its delivery workers and the in-process deferred-send queue.
+"""
+
+import os
+import logging
+import itertools
+import threading
+import time
+import heapq
+from email import message_from_bytes
+
+from workflow_core import _log_event, logger
+from workflow_tracing import trace_span
+from workflow_metrics import _workflow_metrics
+from workflow_db import db_connection
+from workflow_mime import _record_wire_size
+from workflow_smtp import SMTPThrottled, _get_smtp_config, get_send_rate_limiter, get_smtp_pool
+
+__all__ = [
+    "DeferredSendQueue",
+    "EMAIL_OUTBOX_DDL",
+    "EMAIL_QUEUED",
+    "EmailOutboxWorker",
+    "email_outbox_available",
+    "email_outbox_enabled",
+    "enqueue_email",
+    "ensure_email_outbox_table",
+    "get_deferred_sends",
+    "get_email_outbox_metrics",
+    "requeue_throttled_email",
+    "send_email_messages_batch",
+    "start_email_outbox_worker",
+    "stop_email_outbox_worker",
+]
+
+# 🔥 NEW: Durable email outbox. In outbox mode the workflow stores the rendered message
+# in Postgres (in the same transaction as the audit row when started through
+# start_approval_workflow) and returns right away; background workers deliver it.
+
+EMAIL_OUTBOX_DDL = """
+    CREATE TABLE IF NOT EXISTS "DocAI".email_outbox (
+        id BIGSERIAL PRIMARY KEY,
+        audit_id BIGINT,
+        message_kind TEXT NOT NULL,
+        recipient TEXT NOT NULL,
+        payload BYTEA NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        locked_until TIMESTAMPTZ,
+        last_error TEXT,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        sent_at TIMESTAMPTZ
+    );
+    CREATE INDEX IF NOT EXISTS email_outbox_due_idx
+        ON "DocAI".email_outbox (next_attempt_at, id)
+        WHERE status IN ('pending', 'sending');
+"""
+
+# Result of a send that was parked in the in-process deferred queue: accepted but not
+# delivered yet. Callers that track delivery pass `on_done` and wait for its callback.
+EMAIL_QUEUED = "queued"
+
+def email_outbox_enabled():
+    return os.getenv('WORKFLOW_EMAIL_MODE', 'direct').lower() == 'outbox'
+
+_outbox_table_exists = False
+
+def ensure_email_outbox_table():
+    global _outbox_table_exists
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(EMAIL_OUTBOX_DDL)
+        conn.commit()
+        cur.close()
+    _outbox_table_exists = True
+
+def email_outbox_available():
+    """
+    Whether "DocAI".email_outbox exists. Direct mode only writes to the outbox (to save
+    deferred messages) after this check; a positive answer is cached for the process.
+    """
+    global _outbox_table_exists
+    if _outbox_table_exists:
+        return True
+    try:
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""SELECT to_regclass('"DocAI".email_outbox') IS NOT NULL""")
+            row = cur.fetchone()
+            cur.close()
+        _outbox_table_exists = bool(row and row[0])
+    except Exception as e:
+        _log_event(logging.ERROR, "❌ Could not check for the email outbox table", error=e)
+        return False
+    return _outbox_table_exists
+
+def enqueue_email(msg, message_kind, audit_id=None, conn=None, status='pending', last_error=None):
+    """
+    Store a rendered message in the outbox. Pass `conn` to enqueue inside the caller's
+    transaction (the caller commits); otherwise the row is committed here. Messages that
+    already failed for good are stored with status='dead' and their `last_error`.
+    Returns the outbox id, or None on failure.
+    """
+    sql = """
+        INSERT INTO "DocAI".email_outbox (audit_id, message_kind, recipient, payload, status, last_error)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        RETURNING id
+    """
+    payload = msg.as_bytes()
+    _record_wire_size(msg, "outbox", payload)
+    params = (audit_id, message_kind, msg['To'], payload, status,
+              str(last_error)[:1000] if last_error is not None else None)
+    try:
+        if conn is not None:
+            cur = conn.cursor()
+            cur.execute(sql, params)
+            outbox_id = cur.fetchone()[0]
+            cur.close()
+            return outbox_id
+        
+        with db_connection() as own_conn:
+            cur = own_conn.cursor()
+            cur.execute(sql, params)
+            outbox_id = cur.fetchone()[0]
+            own_conn.commit()
+            cur.close()
+        return outbox_id
+        
+    except Exception as e:
+        if conn is not None:
+            raise
+        logger.error("❌ Failed to enqueue %s email to %s: %s", message_kind, msg['To'], e)
+        return None
+
+class EmailOutboxWorker:
+    """
+    Pool of delivery threads draining "DocAI".email_outbox with retries, exponential
+    backoff and a dead-letter state. Run one per process to scale across processes.
+    """
+
+    def __init__(self, num_workers=2, batch_size=20, poll_interval=1.0, max_attempts=8,
+                 base_backoff=30.0, max_backoff=3600.0, lease_seconds=300):
+        self.num_workers = num_workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.lease_seconds = lease_seconds
+        self._stop_event = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._counters = {"sent": 0, "retried": 0, "dead": 0, "deferred": 0}
+
+    def start(self):
+        for i in range(self.num_workers):
+            thread = threading.Thread(target=self._run, name=f"email-outbox-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info("📬 Email outbox worker started (%s threads)", self.num_workers)
+        return self
+
+    def stop(self, timeout=10.0):
+        self._stop_event.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def counters(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def _bump(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+
+    def _claim(self):
+        with db_connection() as conn:
+            cur = conn.cursor()
+            # A 'sending' row whose lease ran out belongs to a worker that died mid-send
+            cur.execute("""
+                UPDATE "DocAI".email_outbox
+                SET status = 'sending',
+                    locked_until = now() + %s * interval '1 second'
+                WHERE id IN (
+                    SELECT id FROM "DocAI".email_outbox
+                    WHERE (status = 'pending' AND next_attempt_at <= now())
+                       OR (status = 'sending' AND locked_until < now())
+                    ORDER BY next_attempt_at, id
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, payload
+            """, (self.lease_seconds, self.batch_size))
+            rows = cur.fetchall()
+            conn.commit()
+            cur.close()
+        return rows
+
+    def _record(self, sent_ids, failures, deferred=()):
+        with db_connection() as conn:
+            cur = conn.cursor()
+            # Provider throttling is not the message's fault: retry later without using an attempt
+            for outbox_id, error in deferred:
+                cur.execute("""
+                    UPDATE "DocAI".email_outbox
+                    SET status = 'pending',
+                        next_attempt_at = now() + %s * interval '1 second',
+                        locked_until = NULL,
+                        last_error = %s
+                    WHERE id = %s
+                """, (error.retry_after, str(error)[:1000], outbox_id))
+            if sent_ids:
+                cur.execute("""
+                    UPDATE "DocAI".email_outbox
+                    SET status = 'sent', sent_at = now(), locked_until = NULL, last_error = NULL
+                    WHERE id = ANY(%s)
+                """, (sent_ids,))
+            for outbox_id, error in failures:
+                cur.execute("""
+                    UPDATE "DocAI".email_outbox
+                    SET attempts = attempts + 1,
+                        status = CASE WHEN attempts + 1 >= %s THEN 'dead' ELSE 'pending' END,
+                        next_attempt_at = now() + LEAST(%s * power(2, attempts), %s) * interval '1 second',
+                        locked_until = NULL,
+                        last_error = %s
+                    WHERE id = %s
+                    RETURNING status
+                """, (self.max_attempts, self.base_backoff, self.max_backoff, str(error)[:1000], outbox_id))
+                status = cur.fetchone()[0]
+                if status == 'dead':
+                    self._bump("dead")
+                    logger.error("☠️ Outbox email %s moved to dead-letter: %s", outbox_id, error)
+                else:
+                    self._bump("retried")
+            conn.commit()
+            cur.close()
+        self._bump("sent", len(sent_ids))
+        self._bump("deferred", len(deferred))
+
+    def run_once(self):
+        """
+        Claim and deliver one batch; returns the number of messages attempted
+        """
+        smtp_config = _get_smtp_config()
+        limiter = get_send_rate_limiter()
+        # While the provider backoff runs, leave the rows unclaimed
+        if limiter is not None and limiter.delay(smtp_config) > 0:
+            return 0
+        rows = self._claim()
+        if not rows:
+            return 0
+        
+        ids = [row[0] for row in rows]
+        with trace_span("outbox_delivery", root=True, batch=len(rows)):
+            messages = [message_from_bytes(bytes(row[1])) for row in rows]
+            try:
+                results = get_smtp_pool().send_batch(smtp_config, messages, background=True)
+            except Exception as e:
+                results = [(False, e)] * len(messages)
+            
+            sent_ids = [outbox_id for outbox_id, (ok, _) in zip(ids, results) if ok]
+            deferred = [(outbox_id, error) for outbox_id, (ok, error) in zip(ids, results)
+                        if not ok and isinstance(error, SMTPThrottled)]
+            failures = [(outbox_id, error) for outbox_id, (ok, error) in zip(ids, results)
+                        if not ok and not isinstance(error, SMTPThrottled)]
+            self._record(sent_ids, failures, deferred)
+        return len(rows)
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                if self.run_once():
+                    continue
+            except Exception as e:
+                logger.error("❌ Email outbox worker error: %s", e)
+            self._stop_event.wait(self.poll_interval)
+
+_outbox_worker = None
+
+def start_email_outbox_worker(**settings):
+    """
+    Start the background delivery pool (settings override WORKFLOW_OUTBOX_* env vars)
+    """
+    global _outbox_worker
+    if _outbox_worker is not None:
+        return _outbox_worker
+    config = {
+        "num_workers": int(os.getenv('WORKFLOW_OUTBOX_WORKERS', 2)),
+        "batch_size": int(os.getenv('WORKFLOW_OUTBOX_BATCH', 20)),
+        "poll_interval": float(os.getenv('WORKFLOW_OUTBOX_POLL_INTERVAL', 1)),
+        "max_attempts": int(os.getenv('WORKFLOW_OUTBOX_MAX_ATTEMPTS', 8)),
+        "base_backoff": float(os.getenv('WORKFLOW_OUTBOX_BACKOFF', 30)),
+    }
+    config.update(settings)
+    _outbox_worker = EmailOutboxWorker(**config).start()
+    return _outbox_worker
+
+def stop_email_outbox_worker():
+    global _outbox_worker
+    worker, _outbox_worker = _outbox_worker, None
+    if worker is not None:
+        worker.stop()
+
+def get_email_outbox_metrics():
+    """
+    Queue depth per status and age of the oldest undelivered message, in seconds
+    """
+    try:
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT status,
+                       count(*),
+                       EXTRACT(EPOCH FROM now() - min(created_at))
+                FROM "DocAI".email_outbox
+                WHERE status <> 'sent'
+                GROUP BY status
+            """)
+            rows = cur.fetchall()
+            cur.close()
+        
+        depth = {status: count for status, count, _ in rows}
+        ages = [float(age) for status, _, age in rows if status in ('pending', 'sending') and age is not None]
+        metrics = {
+            "depth": depth,
+            "pending": depth.get('pending', 0) + depth.get('sending', 0),
+            "dead": depth.get('dead', 0),
+            "oldest_pending_age_seconds": max(ages) if ages else 0.0,
+        }
+        if _outbox_worker is not None:
+            metrics["worker"] = _outbox_worker.counters()
+        return metrics
+        
+    except Exception as e:
+        logger.error("❌ Failed to read email outbox metrics: %s", e)
+        return None
+
+def send_email_messages_batch(messages, smtp_config=None, message_kind="batch", on_done=None):
+    """
+    Send many prepared messages over a single authenticated SMTP session.
+    Returns a list in the same order as `messages`: True or False, or EMAIL_QUEUED for
+    messages the provider throttled that now wait in the deferred queue. `on_done` is an
+    optional list of callbacks, one per message, called with the final outcome of each
+    EMAIL_QUEUED message.
+    """
+    messages = list(messages)
+    if not messages:
+        return []
+    try:
+        results = get_smtp_pool().send_batch(smtp_config or _get_smtp_config(), messages)
+    except SMTPThrottled as e:
+        results = [(False, e)] * len(messages)
+    except Exception as e:
+        logger.error("❌ Batch email send failed: %s", e)
+        return [False] * len(messages)
+    
+    callbacks = on_done or [None] * len(messages)
+    accepted = []
+    deferred = 0
+    for msg, (ok, error), callback in zip(messages, results, callbacks):
+        if not ok and isinstance(error, SMTPThrottled):
+            ok = requeue_throttled_email(msg, error, message_kind, smtp_config=smtp_config, on_done=callback)
+            deferred += bool(ok)
+        elif not ok:
+            logger.error("❌ Failed to send email to %s: %s", msg['To'], error)
+        accepted.append(ok)
+    sent = sum(1 for ok, _ in results if ok)
+    logger.info("📧 Batch send complete: %s/%s emails sent over one SMTP session%s", sent, len(messages),
+                f", {deferred} deferred by provider throttling" if deferred else "")
+    return accepted
+
+# 🔥 NEW: Deferred sends. In direct mode a throttled message waits here (or in the
+# outbox with WORKFLOW_THROTTLE_REQUEUE=outbox) until the provider's backoff has passed,
+# and is retried by one background thread. Nothing is dropped silently: when the queue
+# is full, when a message is still throttled after its last attempt, and for whatever is
+# still waiting at exit, messages are moved into the outbox (if its table exists) for the
+# outbox workers; a message that failed for another reason is stored there as 'dead'.
+# If the outbox cannot take a message the caller (or on_done) gets False.
+
+class DeferredSendQueue:
+    """
+    Time-ordered in-process queue of throttled messages
+    """
+
+    def __init__(self, max_size=10000, max_attempts=20):
+        self.max_size = max_size
+        self.max_attempts = max_attempts
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopping = False
+        self._stats = {"deferred": 0, "sent": 0, "failed": 0, "spilled": 0, "dead_lettered": 0, "refused": 0, "lost": 0}
+
+    def _bump(self, name, amount=1):
+        self._stats[name] += amount
+
+    def add(self, msg, retry_after, smtp_config=None, message_kind="deferred", audit_id=None, attempts=0,
+            on_done=None):
+        """
+        Queue `msg` for a retry after `retry_after` seconds. Returns EMAIL_QUEUED when the
+        message waits here, in which case `on_done(delivered)` is called once its fate is
+        known; True when the queue was full and the outbox took it; False otherwise.
+        """
+        with self._cond:
+            full = len(self._heap) >= self.max_size
+        if full:
+            return self._spill(msg, message_kind, audit_id)
+        with self._cond:
+            heapq.heappush(self._heap, (time.monotonic() + retry_after, next(self._seq),
+                                        msg, smtp_config, message_kind, audit_id, attempts, on_done))
+            self._bump("deferred")
+            if self._thread is None or not self._thread.is_alive():
+                self._stopping = False
+                self._thread = threading.Thread(target=self._run, name="email-deferred", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        _workflow_metrics.increment("smtp_deferred")
+        return EMAIL_QUEUED
+
+    def _persist(self, msg, message_kind, audit_id, status='pending', last_error=None):
+        if not email_outbox_available():
+            return False
+        if enqueue_email(msg, message_kind, audit_id=audit_id, status=status, last_error=last_error) is None:
+            return False
+        with self._cond:
+            self._bump("spilled" if status == 'pending' else "dead_lettered")
+        return True
+
+    def _spill(self, msg, message_kind, audit_id):
+        if self._persist(msg, message_kind, audit_id):
+            _log_event(logging.WARNING, "⚠️ Deferred send queue full, email moved to the outbox",
+                       recipient=msg['To'], message_kind=message_kind, audit_id=audit_id)
+            return True
+        with self._cond:
+            self._bump("refused")
+        _log_event(logging.ERROR, "❌ Deferred send queue full and outbox unavailable, email not queued",
+                   recipient=msg['To'], message_kind=message_kind, audit_id=audit_id)
+        return False
+
+    def _take_due(self):
+        with self._cond:
+            while not self._stopping:
+                now = time.monotonic()
+                if self._heap and self._heap[0][0] <= now:
+                    due = []
+                    while self._heap and self._heap[0][0] <= now:
+                        due.append(heapq.heappop(self._heap))
+                    return due
+                self._cond.wait(self._heap[0][0] - now if self._heap else None)
+            return None
+
+    def _run(self):
+        while True:
+            due = self._take_due()
+            if due is None:
+                return
+            groups = {}
+            for item in due:
+                config = item[3] or _get_smtp_config()
+                groups.setdefault((config["server"], config["port"], config["user"]), (config, []))[1].append(item)
+            for config, items in groups.values():
+                self._send(config, items)
+
+    def _send(self, config, items):
+        try:
+            results = get_smtp_pool().send_batch(config, [item[2] for item in items], background=True)
+        except Exception as e:
+            results = [(False, e)] * len(items)
+        for item, (ok, error) in zip(items, results):
+            _, _, msg, smtp_config, message_kind, audit_id, attempts, on_done = item
+            if ok:
+                with self._cond:
+                    self._bump("sent")
+                _report(on_done, True)
+                continue
+            if isinstance(error, SMTPThrottled) and attempts + 1 < self.max_attempts:
+                queued = self.add(msg, error.retry_after, smtp_config, message_kind, audit_id, attempts + 1, on_done)
+                if queued == EMAIL_QUEUED:
+                    continue
+                if queued:
+                    _report(on_done, True)
+                    continue
+            with self._cond:
+                self._bump("failed")
+            # Still throttled after the last attempt: the outbox workers keep retrying it.
+            # Any other failure is kept as dead-lettered so it can be inspected and requeued.
+            throttled = isinstance(error, SMTPThrottled)
+            saved = self._persist(msg, message_kind, audit_id, 'pending' if throttled else 'dead', error)
+            if not saved:
+                with self._cond:
+                    self._bump("lost")
+            _log_event(logging.ERROR, "❌ Deferred email failed",
+                       recipient=msg['To'], message_kind=message_kind, audit_id=audit_id, attempts=attempts + 1,
+                       error=error, outbox=("pending" if throttled else "dead") if saved else "unavailable")
+            _report(on_done, saved and throttled)
+
+    def stop(self, spill=True):
+        """
+        Stop the retry thread; with `spill`, move waiting messages into the outbox when
+        its table exists. Returns the number of messages saved.
+        """
+        with self._cond:
+            self._stopping = True
+            pending, self._heap = self._heap, []
+            self._cond.notify_all()
+        if not pending:
+            return 0
+        spill = spill and email_outbox_available()
+        spilled = 0
+        for _, _, msg, _, message_kind, audit_id, _, on_done in pending:
+            saved = spill and self._persist(msg, message_kind, audit_id)
+            spilled += saved
+            _report(on_done, saved)
+        if spilled < len(pending):
+            with self._cond:
+                self._bump("lost", len(pending) - spilled)
+            _log_event(logging.ERROR, "❌ Deferred emails could not be saved to the outbox at shutdown",
+                       lost=len(pending) - spilled, outbox="available" if spill else "unavailable",
+                       recipients=",".join(str(item[2]['To']) for item in pending[:20]))
+        return spilled
+
+    def __len__(self):
+        with self._cond:
+            return len(self._heap)
+
+    def stats(self):
+        with self._cond:
+            return dict(self._stats, waiting=len(self._heap))
+
+_deferred_sends = DeferredSendQueue(
+    max_size=int(os.getenv('WORKFLOW_DEFERRED_QUEUE_SIZE', 10000)),
+    max_attempts=int(os.getenv('WORKFLOW_DEFERRED_MAX_ATTEMPTS', 20)),
+)
+
+def get_deferred_sends():
+    return _deferred_sends
+
+def _report(on_done, delivered):
+    if on_done is None:
+        return
+    try:
+        on_done(delivered)
+    except Exception as e:
+        logger.error("❌ Deferred send callback failed: %s", e)
+
+def requeue_throttled_email(msg, error, message_kind="deferred", audit_id=None, smtp_config=None, on_done=None):
+    """
+    Park a throttled message for a later retry instead of dropping it. Returns True if it
+    went to the outbox, EMAIL_QUEUED if it waits in memory (`on_done` then receives the
+    outcome), False if it could not be queued.
+    """
+    if os.getenv('WORKFLOW_THROTTLE_REQUEUE', 'memory').lower() == 'outbox':
+        if enqueue_email(msg, message_kind, audit_id=audit_id) is not None:
+            return True
+    _log_event(logging.INFO, "⏳ Email throttled, deferred for retry",
+               recipient=msg['To'], message_kind=message_kind, audit_id=audit_id,
+               retry_after=round(error.retry_after, 1), code=error.code)
+    return _deferred_sends.add(msg, error.retry_after, smtp_config, message_kind, audit_id, on_done=on_done)
@@ -0,0 +1,277 @@
+"""
+Monthly partitions, retention and keyset-paginated reads for workflow_audit_log.
+"""
+
+import os
+import re
+import base64
+from datetime import datetime, timezone
+
+from workflow_core import _psycopg2_extras, logger
+from workflow_db import db_connection
+
+__all__ = [
+    "AUDIT_ARCHIVE_SCHEMA",
+    "AUDIT_HISTORY_INDEXES_DDL",
+    "AUDIT_LOG_TABLE",
+    "AUDIT_PARTITION_MIGRATION_SQL",
+    "apply_audit_retention",
+    "ensure_audit_history_indexes",
+    "ensure_audit_partitions",
+    "get_invoice_audit_history",
+    "is_workflow_audit_log_partitioned",
+    "list_workflow_audits",
+    "partition_workflow_audit_log",
+    "run_audit_partition_maintenance",
+]
+
+# 🔥 NEW: Time-partitioned audit log. workflow_audit_log becomes a table partitioned
+# by month on created_at: partitions are created ahead of time, old ones are detached
+# into an archive schema (or dropped) on a retention policy, and history reads page
+# by (created_at, id) keyset instead of OFFSET so they stay fast at any depth.
+
+AUDIT_LOG_TABLE = '"DocAI".workflow_audit_log'
+AUDIT_ARCHIVE_SCHEMA = "DocAI_archive"
+_PARTITION_BOUND_RE = re.compile(r"TO \('([^']+)'\)")
+
+AUDIT_HISTORY_INDEXES_DDL = """
+CREATE INDEX IF NOT EXISTS workflow_audit_log_created_idx
+    ON "DocAI".workflow_audit_log (created_at, id);
+CREATE INDEX IF NOT EXISTS workflow_audit_log_status_created_idx
+    ON "DocAI".workflow_audit_log (status, created_at, id);
+CREATE INDEX IF NOT EXISTS workflow_audit_log_invoice_created_idx
+    ON "DocAI".workflow_audit_log (invoice_number, created_at, id);
+"""
+
+# One transaction: the existing table is kept as-is and attached as the partition for
+# everything before next month, so no rows are copied. Rows must have created_at set.
+AUDIT_PARTITION_MIGRATION_SQL = """
+LOCK TABLE "DocAI".workflow_audit_log IN ACCESS EXCLUSIVE MODE;
+ALTER TABLE "DocAI".workflow_audit_log RENAME TO workflow_audit_log_legacy;
+ALTER TABLE "DocAI".workflow_audit_log_legacy ALTER COLUMN created_at SET NOT NULL;
+CREATE TABLE "DocAI".workflow_audit_log
+    (LIKE "DocAI".workflow_audit_log_legacy INCLUDING DEFAULTS INCLUDING CONSTRAINTS)
+    PARTITION BY RANGE (created_at);
+ALTER TABLE "DocAI".workflow_audit_log ADD PRIMARY KEY (id, created_at);
+ALTER TABLE "DocAI".workflow_audit_log
+    ATTACH PARTITION "DocAI".workflow_audit_log_legacy
+    FOR VALUES FROM (MINVALUE) TO (%(first_bound)s);
+CREATE TABLE "DocAI".workflow_audit_log_default
+    PARTITION OF "DocAI".workflow_audit_log DEFAULT;
+DO $$
+DECLARE seq text := pg_get_serial_sequence('"DocAI".workflow_audit_log_legacy', 'id');
+BEGIN
+    IF seq IS NOT NULL THEN
+        EXECUTE format('ALTER SEQUENCE %%s OWNED BY "DocAI".workflow_audit_log.id', seq);
+    END IF;
+END $$;
+"""
+
+def _month_start(day, offset=0):
+    month_index = day.year * 12 + day.month - 1 + offset
+    return day.replace(year=month_index // 12, month=month_index % 12 + 1, day=1)
+
+def _audit_partition_name(month):
+    return f"workflow_audit_log_y{month.year:04d}m{month.month:02d}"
+
+def is_workflow_audit_log_partitioned():
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", (AUDIT_LOG_TABLE,))
+        row = cur.fetchone()
+        cur.close()
+    return bool(row) and row[0] == 'p'
+
+def partition_workflow_audit_log(months_ahead=None):
+    """
+    One-off migration of an existing workflow_audit_log to monthly range partitions.
+    Returns False if it is already partitioned.
+    """
+    if is_workflow_audit_log_partitioned():
+        logger.info("ℹ️ %s is already partitioned", AUDIT_LOG_TABLE)
+        return False
+    first_bound = _month_start(datetime.now(timezone.utc).date(), 1)
+    with db_connection() as conn:
+        cur = conn.cursor()
+        try:
+            cur.execute(AUDIT_PARTITION_MIGRATION_SQL, {"first_bound": first_bound.isoformat()})
+            cur.execute(AUDIT_HISTORY_INDEXES_DDL)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+    logger.info("🗂️ %s converted to monthly partitions (legacy rows before %s)", AUDIT_LOG_TABLE, first_bound)
+    ensure_audit_partitions(months_ahead)
+    return True
+
+def _audit_partitions(cur):
+    """
+    [(name, upper_bound_date or None, is_default)] for every attached partition
+    """
+    cur.execute("""
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(%s)
+    """, (AUDIT_LOG_TABLE,))
+    partitions = []
+    for name, bound in cur.fetchall():
+        match = _PARTITION_BOUND_RE.search(bound or "")
+        upper = datetime.fromisoformat(match.group(1)[:10]).date() if match else None
+        partitions.append((name, upper, bound == "DEFAULT"))
+    return partitions
+
+def ensure_audit_partitions(months_ahead=None):
+    """
+    Create monthly partitions from the newest existing bound through `months_ahead`
+    months from now (WORKFLOW_AUDIT_PARTITIONS_AHEAD, default 3). Returns the names created.
+    """
+    if months_ahead is None:
+        months_ahead = int(os.getenv('WORKFLOW_AUDIT_PARTITIONS_AHEAD', 3))
+    horizon = _month_start(datetime.now(timezone.utc).date(), months_ahead + 1)
+    created = []
+    with db_connection() as conn:
+        cur = conn.cursor()
+        bounds = [upper for _, upper, is_default in _audit_partitions(cur) if upper and not is_default]
+        month = max(bounds) if bounds else _month_start(datetime.now(timezone.utc).date())
+        while month < horizon:
+            following = _month_start(month, 1)
+            name = _audit_partition_name(month)
+            try:
+                cur.execute(
+                    f'CREATE TABLE IF NOT EXISTS "DocAI".{name} PARTITION OF {AUDIT_LOG_TABLE} '
+                    f"FOR VALUES FROM (%s) TO (%s)",
+                    (month.isoformat(), following.isoformat()),
+                )
+                conn.commit()
+                created.append(name)
+            except Exception as e:
+                # Usually rows for this month already sit in the default partition
+                conn.rollback()
+                logger.error("❌ Could not create audit partition %s: %s", name, e)
+                break
+            month = following
+        cur.close()
+    if created:
+        logger.info("🗂️ Created audit partitions: %s", ', '.join(created))
+    return created
+
+def apply_audit_retention(retain_months=None, action=None):
+    """
+    Detach partitions that ended more than `retain_months` months ago
+    (WORKFLOW_AUDIT_RETENTION_MONTHS, default 24). `action` (WORKFLOW_AUDIT_RETENTION_ACTION)
+    is "archive" to move them into the DocAI_archive schema or "drop".
+    Partitions that still hold pending audits are kept. Returns the names handled.
+    """
+    if retain_months is None:
+        retain_months = int(os.getenv('WORKFLOW_AUDIT_RETENTION_MONTHS', 24))
+    action = action or os.getenv('WORKFLOW_AUDIT_RETENTION_ACTION', 'archive')
+    if action not in ('archive', 'drop'):
+        raise ValueError(f"Unknown retention action: {action}")
+    cutoff = _month_start(datetime.now(timezone.utc).date(), -retain_months)
+    
+    handled = []
+    with db_connection() as conn:
+        cur = conn.cursor()
+        for name, upper, is_default in sorted(_audit_partitions(cur), key=lambda p: p[1] or datetime.max.date()):
+            if is_default or upper is None or upper > cutoff:
+                continue
+            cur.execute(f"SELECT EXISTS (SELECT 1 FROM \"DocAI\".{name} WHERE status = 'pending')")
+            if cur.fetchone()[0]:
+                logger.warning("⚠️ Keeping audit partition %s: it still has pending audits", name)
+                continue
+            try:
+                cur.execute(f'ALTER TABLE {AUDIT_LOG_TABLE} DETACH PARTITION "DocAI".{name}')
+                if action == 'drop':
+                    cur.execute(f'DROP TABLE "DocAI".{name}')
+                else:
+                    cur.execute(f'CREATE SCHEMA IF NOT EXISTS "{AUDIT_ARCHIVE_SCHEMA}"')
+                    cur.execute(f'ALTER TABLE "DocAI".{name} SET SCHEMA "{AUDIT_ARCHIVE_SCHEMA}"')
+                conn.commit()
+                handled.append(name)
+            except Exception as e:
+                conn.rollback()
+                logger.error("❌ Retention failed for audit partition %s: %s", name, e)
+        cur.close()
+    if handled:
+        logger.info("🗄️ Audit retention (%s): %s", action, ', '.join(handled))
+    return handled
+
+def run_audit_partition_maintenance():
+    """
+    Create upcoming partitions and apply retention; run daily from cron or a scheduler
+    """
+    created = ensure_audit_partitions()
+    retired = apply_audit_retention()
+    return {"created": created, "retired": retired}
+
+def ensure_audit_history_indexes():
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(AUDIT_HISTORY_INDEXES_DDL)
+        conn.commit()
+        cur.close()
+
+def _encode_audit_cursor(created_at, audit_id):
+    raw = f"{created_at.isoformat()}|{audit_id}".encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+def _decode_audit_cursor(cursor):
+    created_at, _, audit_id = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8").rpartition("|")
+    return datetime.fromisoformat(created_at), int(audit_id)
+
+def list_workflow_audits(status=None, invoice_number=None, approver_email=None, since=None, until=None,
+                         limit=50, cursor=None, newest_first=True):
+    """
+    One page of audit rows ordered by (created_at, id), newest first by default.
+    Pass the returned next_cursor back as `cursor` for the following page.
+    Returns {"rows": [...], "next_cursor": str or None}, or None on error.
+    """
+    limit = max(1, min(int(limit), 1000))
+    conditions = []
+    params = []
+    for column, value in (("status", status), ("invoice_number", invoice_number), ("current_approver_email", approver_email)):
+        if value is not None:
+            conditions.append(f"{column} = %s")
+            params.append(value)
+    # since/until bound created_at, which also lets the planner prune partitions
+    if since is not None:
+        conditions.append("created_at >= %s")
+        params.append(since)
+    if until is not None:
+        conditions.append("created_at < %s")
+        params.append(until)
+    if cursor:
+        conditions.append(f"(created_at, id) {'<' if newest_first else '>'} (%s, %s)")
+        params.extend(_decode_audit_cursor(cursor))
+    
+    direction = "DESC" if newest_first else "ASC"
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    try:
+        with db_connection() as conn:
+            cur = conn.cursor(cursor_factory=_psycopg2_extras.RealDictCursor)
+            cur.execute(f"""
+                SELECT * FROM {AUDIT_LOG_TABLE}
+                {where}
+                ORDER BY created_at {direction}, id {direction}
+                LIMIT %s
+            """, params + [limit + 1])
+            rows = cur.fetchall()
+            cur.close()
+    except Exception as e:
+        logger.error("❌ Failed to list workflow audits: %s", e)
+        return None
+    
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = _encode_audit_cursor(rows[-1]['created_at'], rows[-1]['id'])
+    return {"rows": [dict(row) for row in rows], "next_cursor": next_cursor}
+
+def get_invoice_audit_history(invoice_number, limit=50, cursor=None):
+    """
+    Audit trail for one invoice, newest first, keyset paginated
+    """
+    return list_workflow_audits(invoice_number=invoice_number, limit=limit, cursor=cursor)
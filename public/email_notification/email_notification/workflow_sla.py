@@ -0,0 +1,395 @@
+"""
+SLA reminders and escalation for pending approval audits.
+"""
+
+import os
+import threading
+import time
+import heapq
+from datetime import timedelta
+
+from workflow_core import NO_PENDING_CHANGES, logger
+from workflow_metrics import _timed_stage, _workflow_metrics
+from workflow_db import db_connection
+from workflow_outbox import email_outbox_enabled, enqueue_email, send_email_messages_batch
+
+__all__ = [
+    "SLAScheduler",
+    "SLA_CLAIM_ESCALATIONS_SQL",
+    "SLA_CLAIM_REMINDERS_SQL",
+    "SLA_PENDING_PAGE_SQL",
+    "SLA_REFRESH_SQL",
+    "WORKFLOW_SLA_DDL",
+    "ensure_workflow_sla_schema",
+    "stop_sla_scheduler",
+]
+
+# 🔥 NEW: SLA reminders and escalation for pending audits. Due times live in a
+# min-heap in memory; pending rows are read with keyset pages over a partial index
+# on (created_at, id) and afterwards only from a watermark, so the table is never
+# rescanned. Due items are claimed with conditional UPDATEs, so several schedulers
+# can run without sending twice.
+
+WORKFLOW_SLA_DDL = """
+ALTER TABLE "DocAI".workflow_audit_log
+    ADD COLUMN IF NOT EXISTS sla_anchor_at timestamptz,
+    ADD COLUMN IF NOT EXISTS reminders_sent integer NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS escalated_at timestamptz;
+
+CREATE INDEX IF NOT EXISTS workflow_audit_log_pending_sla_idx
+    ON "DocAI".workflow_audit_log (created_at, id)
+    WHERE status = 'pending';
+"""
+
+SLA_PENDING_PAGE_SQL = """
+    SELECT id, created_at, extract(epoch FROM COALESCE(sla_anchor_at, created_at)),
+           reminders_sent, current_approver_level
+    FROM "DocAI".workflow_audit_log
+    WHERE status = 'pending' AND (created_at, id) > (%s::timestamptz, %s)
+    ORDER BY created_at, id
+    LIMIT %s
+"""
+
+SLA_CLAIM_REMINDERS_SQL = """
+    UPDATE "DocAI".workflow_audit_log
+    -- Reminders missed while no scheduler was running collapse into this one
+    SET reminders_sent = LEAST(%s, GREATEST(
+            reminders_sent + 1,
+            floor(extract(epoch FROM now() - COALESCE(sla_anchor_at, created_at)) / %s)::int
+        ))
+    WHERE id = ANY(%s)
+      AND status = 'pending'
+      AND reminders_sent < %s
+      AND COALESCE(sla_anchor_at, created_at) + (reminders_sent + 1) * %s * interval '1 second' <= now()
+    RETURNING id, invoice_number, changed_amount, current_approver_level, current_approver_email,
+              reminders_sent, extract(epoch FROM COALESCE(sla_anchor_at, created_at))
+"""
+
+SLA_CLAIM_ESCALATIONS_SQL = """
+    UPDATE "DocAI".workflow_audit_log w
+    SET current_approver_level = v.to_level,
+        current_approver_email = v.to_email,
+        sla_anchor_at = now(),
+        reminders_sent = 0,
+        escalated_at = now()
+    FROM unnest(%s::bigint[], %s::text[], %s::text[], %s::text[]) AS v(id, from_level, to_level, to_email)
+    WHERE w.id = v.id
+      AND w.status = 'pending'
+      AND w.current_approver_level = v.from_level
+      AND COALESCE(w.sla_anchor_at, w.created_at) + %s * interval '1 second' <= now()
+    RETURNING w.id, w.invoice_number, w.changed_amount, v.to_level, v.to_email,
+              extract(epoch FROM w.sla_anchor_at)
+"""
+
+SLA_REFRESH_SQL = """
+    SELECT id, extract(epoch FROM COALESCE(sla_anchor_at, created_at)), reminders_sent, current_approver_level
+    FROM "DocAI".workflow_audit_log
+    WHERE id = ANY(%s) AND status = 'pending'
+"""
+
+def ensure_workflow_sla_schema():
+    """
+    Add the SLA tracking columns and the partial index the scheduler pages over
+    """
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(WORKFLOW_SLA_DDL)
+        conn.commit()
+        cur.close()
+
+class SLAScheduler:
+    """
+    Sends reminder emails to the current approver of a pending audit and escalates it
+    to the next tier of the approval hierarchy once its deadline passes.
+    Each pending audit has exactly one live heap item: its next reminder or its escalation.
+    The emails come from the injected `build_message` (as build_approval_email_message),
+    `pending_changes` ({invoice_number: changes} for a list of invoices) and `hierarchy`
+    (returns the current approval hierarchy).
+    """
+
+    def __init__(self, build_message, pending_changes, hierarchy, remind_after=86400.0, escalate_after=259200.0,
+                 max_reminders=2, poll_interval=60.0, page_size=5000, batch_size=200, overlap=300.0, retry_delay=30.0):
+        self.build_message = build_message
+        self.pending_changes = pending_changes
+        self.hierarchy = hierarchy
+        self.remind_after = remind_after
+        self.escalate_after = escalate_after
+        self.max_reminders = max_reminders
+        self.poll_interval = poll_interval
+        self.page_size = page_size
+        self.batch_size = batch_size
+        # New rows are re-read this far behind the watermark to catch transactions
+        # that committed after a later created_at was already seen
+        self.overlap = overlap
+        self.retry_delay = retry_delay
+        self._heap = []
+        self._entries = {}
+        self._watermark = None
+        self._next_poll = 0.0
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._counters = {"loaded": 0, "reminders": 0, "escalations": 0, "dropped": 0, "top_tier": 0}
+
+    def _bump(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+        _workflow_metrics.increment(f"sla_{name}", amount)
+
+    def _schedule(self, audit_id, anchor, reminders_sent, level, now=None):
+        state = (anchor, reminders_sent, level)
+        self._entries[audit_id] = state
+        due = anchor + self.escalate_after
+        kind = "escalate"
+        if reminders_sent < self.max_reminders:
+            remind_at = anchor + self.remind_after * (reminders_sent + 1)
+            if remind_at < due:
+                due, kind = remind_at, "remind"
+        if now is not None and due <= now:
+            # The claim did not apply (DB clock behind ours, or the row changed); look again shortly
+            due = now + self.retry_delay
+        heapq.heappush(self._heap, (due, audit_id, kind) + state)
+
+    def load_pending(self):
+        """
+        Read pending audits past the watermark in keyset pages; returns how many were new
+        """
+        if self._watermark is None:
+            after = ("-infinity", 0)
+        else:
+            after = (self._watermark[0] - timedelta(seconds=self.overlap), 0)
+        
+        added = 0
+        with _timed_stage("sla_load"), db_connection() as conn:
+            cur = conn.cursor()
+            while True:
+                cur.execute(SLA_PENDING_PAGE_SQL, (after[0], after[1], self.page_size))
+                rows = cur.fetchall()
+                for audit_id, created_at, anchor, reminders_sent, level in rows:
+                    if audit_id not in self._entries:
+                        self._schedule(audit_id, float(anchor), reminders_sent, level)
+                        added += 1
+                    after = (created_at, audit_id)
+                if rows and (self._watermark is None or after[0] > self._watermark[0]):
+                    self._watermark = after
+                if len(rows) < self.page_size:
+                    break
+            conn.rollback()
+            cur.close()
+        
+        if added:
+            self._bump("loaded", added)
+            logger.info("⏰ SLA scheduler tracking %s new pending audits (%s total)", added, len(self._entries))
+        return added
+
+    def _pop_due(self, now):
+        due = []
+        heap = self._heap
+        while heap and heap[0][0] <= now and len(due) < self.batch_size:
+            item = heapq.heappop(heap)
+            # Superseded by a later reschedule of the same audit
+            if self._entries.get(item[1]) == item[3:]:
+                due.append(item)
+        return due
+
+    def _deliver(self, messages, message_kind, audit_ids):
+        if not messages:
+            return
+        if email_outbox_enabled():
+            for msg, audit_id in zip(messages, audit_ids):
+                enqueue_email(msg, message_kind, audit_id=audit_id)
+            return
+        send_email_messages_batch(messages)
+
+    def _remind(self, items):
+        ids = [item[1] for item in items]
+        with _timed_stage("sla_claim"), db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(SLA_CLAIM_REMINDERS_SQL, (
+                self.max_reminders, self.remind_after, ids, self.max_reminders, self.remind_after
+            ))
+            rows = cur.fetchall()
+            conn.commit()
+            cur.close()
+        
+        pending = self.pending_changes([row[1] for row in rows]) if rows else {}
+        hierarchy = self.hierarchy()
+        messages, audit_ids = [], []
+        for audit_id, invoice_number, amount, level, email_address, reminders_sent, anchor in rows:
+            self._schedule(audit_id, float(anchor), reminders_sent, level)
+            try:
+                tier = hierarchy.tier_for_level(level)
+                msg = self.build_message(
+                    invoice_number, amount or 0, email_address,
+                    tier['approver_name'] if tier else email_address, audit_id,
+                    changes=pending.get(invoice_number) or dict(NO_PENDING_CHANGES)
+                )
+                msg.replace_header('Subject', f"REMINDER: {msg['Subject']}")
+                messages.append(msg)
+                audit_ids.append(audit_id)
+            except Exception as e:
+                logger.error("❌ Could not build SLA reminder for audit %s: %s", audit_id, e)
+        
+        self._deliver(messages, "approval_reminder", audit_ids)
+        self._bump("reminders", len(rows))
+        return {row[0] for row in rows}
+
+    def _escalate(self, items):
+        hierarchy = self.hierarchy()
+        handled = set()
+        targets = {}
+        for _, audit_id, _, anchor, reminders_sent, level in items:
+            tier = hierarchy.next_tier(level)
+            if tier is None:
+                # Already at the top: nothing to escalate to, stop tracking timers for it
+                logger.warning("⚠️ Audit %s is overdue at %s and has no higher tier to escalate to", audit_id, level)
+                self._bump("top_tier")
+                handled.add(audit_id)
+                continue
+            targets[audit_id] = (level, tier)
+        if not targets:
+            return handled
+        
+        ids = list(targets)
+        with _timed_stage("sla_claim"), db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(SLA_CLAIM_ESCALATIONS_SQL, (
+                ids,
+                [targets[i][0] for i in ids],
+                [targets[i][1]['level_name'] for i in ids],
+                [targets[i][1]['approver_email'] for i in ids],
+                self.escalate_after,
+            ))
+            rows = cur.fetchall()
+            conn.commit()
+            cur.close()
+        
+        pending = self.pending_changes([row[1] for row in rows]) if rows else {}
+        messages, audit_ids = [], []
+        for audit_id, invoice_number, amount, level, email_address, anchor in rows:
+            handled.add(audit_id)
+            self._schedule(audit_id, float(anchor), 0, level)
+            from_level, tier = targets[audit_id]
+            logger.info("⏫ Audit %s (%s) escalated from %s to %s", audit_id, invoice_number, from_level, level)
+            try:
+                msg = self.build_message(
+                    invoice_number, amount or 0, email_address, tier['approver_name'], audit_id,
+                    changes=pending.get(invoice_number) or dict(NO_PENDING_CHANGES)
+                )
+                msg.replace_header('Subject', f"ESCALATED: {msg['Subject']}")
+                messages.append(msg)
+                audit_ids.append(audit_id)
+            except Exception as e:
+                logger.error("❌ Could not build escalation email for audit %s: %s", audit_id, e)
+        
+        self._deliver(messages, "approval_escalation", audit_ids)
+        self._bump("escalations", len(rows))
+        return handled
+
+    def _refresh(self, ids, now):
+        """
+        Re-read audits whose claim did not apply: gone from 'pending' means drop,
+        otherwise reschedule from the current row (another scheduler may have acted)
+        """
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(SLA_REFRESH_SQL, (ids,))
+            rows = cur.fetchall()
+            conn.rollback()
+            cur.close()
+        still_pending = set()
+        for audit_id, anchor, reminders_sent, level in rows:
+            still_pending.add(audit_id)
+            self._schedule(audit_id, float(anchor), reminders_sent, level, now)
+        dropped = [audit_id for audit_id in ids if audit_id not in still_pending]
+        for audit_id in dropped:
+            self._entries.pop(audit_id, None)
+        if dropped:
+            self._bump("dropped", len(dropped))
+
+    def run_once(self, now=None):
+        """
+        Pick up new pending audits when the poll interval has passed, then handle one
+        batch of due timers. Returns the number of due items processed.
+        """
+        if time.monotonic() >= self._next_poll:
+            self.load_pending()
+            self._next_poll = time.monotonic() + self.poll_interval
+        
+        now = time.time() if now is None else now
+        due = self._pop_due(now)
+        if not due:
+            return 0
+        
+        # A reminder that is only being reached after the escalation deadline escalates instead
+        handled = set()
+        escalations = [item for item in due if item[2] == "escalate" or item[3] + self.escalate_after <= now]
+        reminders = [item for item in due if item[2] == "remind" and item[3] + self.escalate_after > now]
+        if escalations:
+            handled |= self._escalate(escalations)
+        if reminders:
+            handled |= self._remind(reminders)
+        unclaimed = [item[1] for item in due if item[1] not in handled]
+        if unclaimed:
+            self._refresh(unclaimed, now)
+        return len(due)
+
+    def _seconds_until_next(self):
+        wait = self._next_poll - time.monotonic()
+        if self._heap:
+            wait = min(wait, self._heap[0][0] - time.time())
+        return min(max(wait, 0.05), self.poll_interval)
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                if self.run_once() >= self.batch_size:
+                    continue
+            except Exception as e:
+                logger.error("❌ SLA scheduler error: %s", e)
+                self._next_poll = time.monotonic() + self.poll_interval
+            self._stop_event.wait(self._seconds_until_next())
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="workflow-sla", daemon=True)
+        self._thread.start()
+        logger.info("⏰ SLA scheduler started (remind every %.0fs, escalate after %.0fs)", self.remind_after, self.escalate_after)
+        return self
+
+    def stop(self, timeout=10.0):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+        return dict(counters, tracked=len(self._entries), scheduled=len(self._heap),
+                    next_due_in=(self._heap[0][0] - time.time()) if self._heap else None)
+
+_sla_scheduler = None
+
+def start_sla_scheduler(build_message, pending_changes, hierarchy, **settings):
+    """
+    Start the reminder/escalation scheduler with its email dependencies (see SLAScheduler);
+    settings override WORKFLOW_SLA_* env vars. workflow.start_sla_scheduler wires them in.
+    """
+    global _sla_scheduler
+    if _sla_scheduler is not None:
+        return _sla_scheduler
+    config = {
+        "remind_after": float(os.getenv('WORKFLOW_SLA_REMIND_AFTER_HOURS', 24)) * 3600,
+        "escalate_after": float(os.getenv('WORKFLOW_SLA_ESCALATE_AFTER_HOURS', 72)) * 3600,
+        "max_reminders": int(os.getenv('WORKFLOW_SLA_MAX_REMINDERS', 2)),
+        "poll_interval": float(os.getenv('WORKFLOW_SLA_POLL_INTERVAL', 60)),
+    }
+    config.update(settings)
+    _sla_scheduler = SLAScheduler(build_message, pending_changes, hierarchy, **config).start()
+    return _sla_scheduler
+
+def stop_sla_scheduler():
+    global _sla_scheduler
+    scheduler, _sla_scheduler = _sla_scheduler, None
+    if scheduler is not None:
+        scheduler.stop()
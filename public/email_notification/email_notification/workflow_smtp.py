@@ -0,0 +1,514 @@
+"""
+Pooled SMTP sessions and provider-aware send rate limiting.
+"""
+
+import os
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from workflow_core import _log_event, smtplib
+from workflow_tracing import trace_span
+from workflow_metrics import _timed_stage, _workflow_metrics
+from workflow_mime import _record_wire_size
+
+__all__ = [
+    "SMTPSessionPool",
+    "SMTPThrottled",
+    "SMTP_PROVIDER_LIMITS",
+    "SMTP_THROTTLE_CODES",
+    "SendRateLimiter",
+    "close_smtp_pool",
+    "configure_send_rate_limiter",
+    "get_send_rate_limiter",
+    "get_smtp_pool",
+]
+
+# 🔥 NEW: Persistent SMTP sessions. Connect + STARTTLS + login is paid once per
+# session and reused across messages instead of once per email.
+
+def _get_smtp_config():
+    return {
+        "server": os.getenv('SMTP_SERVER', 'smtp.gmail.com'),
+        "port": int(os.getenv('SMTP_PORT', 587)),
+        "user": os.getenv('SMTP_USER', ''),
+        "password": os.getenv('SMTP_PASSWORD', ''),
+        "timeout": float(os.getenv('SMTP_TIMEOUT', 15)),
+        # Local relays and test sinks often speak plain SMTP on 25/1025
+        "starttls": os.getenv('SMTP_STARTTLS', '1') != '0',
+    }
+
+def _is_reconnectable_smtp_error(exc):
+    """
+    True for failures that mean "this session is gone", where a fresh login may succeed
+    """
+    if isinstance(exc, (smtplib.SMTPServerDisconnected, ConnectionError)):
+        return True
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, _ in exc.recipients.values()]
+        return bool(codes) and all(code == 421 for code in codes)
+    if isinstance(exc, smtplib.SMTPResponseException):
+        return exc.smtp_code == 421
+    return False
+
+# 🔥 NEW: Provider-aware send rate limiting. Every send takes a token from its sender
+# account's buckets and its provider's buckets (per minute and per day). Temporary
+# failures (421/450/451/452/454) halve the account's rate and back off; each success
+# wins a little of it back, so a month-end batch settles at the fastest rate the
+# provider accepts. Only background senders (outbox worker, deferred queue) sleep for
+# a token; a send on a request thread that would have to wait raises SMTPThrottled and
+# the message is requeued, unless WORKFLOW_SMTP_INLINE_RATE_WAIT allows a short wait.
+
+SMTP_THROTTLE_CODES = frozenset({421, 450, 451, 452, 454})
+
+# Per-account defaults by SMTP host: (per minute, per day)
+SMTP_PROVIDER_LIMITS = {
+    "smtp.gmail.com": (60, 2000),
+    "smtp.office365.com": (30, 10000),
+    "smtp-mail.outlook.com": (30, 300),
+}
+
+class SMTPThrottled(Exception):
+    """
+    The provider or the local limiter wants us to hold off for `retry_after` seconds.
+    `code` is the SMTP reply code, or None when the local limiter refused the send.
+    """
+
+    def __init__(self, message, retry_after, code=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.code = code
+
+def _smtp_throttle_code(exc):
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        codes = {code for code, _ in exc.recipients.values()}
+        return min(codes) if codes and codes <= SMTP_THROTTLE_CODES else None
+    if isinstance(exc, smtplib.SMTPResponseException) and exc.smtp_code in SMTP_THROTTLE_CODES:
+        return exc.smtp_code
+    return None
+
+class _TokenBucket:
+    def __init__(self, capacity, per_second, adaptive=False):
+        self.capacity = capacity
+        self.per_second = per_second
+        self.adaptive = adaptive
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def wait_time(self, now, scale=1.0):
+        rate = self.per_second * (scale if self.adaptive else 1.0)
+        # A bucket created after `now` was read must not lose a fraction of a token
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * rate)
+            self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / rate
+
+def _rate_buckets(per_minute, per_day):
+    buckets = []
+    if per_minute:
+        # Only the short-term rate adapts; the daily quota is a hard provider limit
+        buckets.append(_TokenBucket(per_minute, per_minute / 60.0, adaptive=True))
+    if per_day:
+        buckets.append(_TokenBucket(per_day, per_day / 86400.0))
+    return buckets
+
+class _AccountRate:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.scale = 1.0
+        self.strikes = 0
+        self.blocked_until = 0.0
+
+class SendRateLimiter:
+    """
+    Token buckets per (server, sender account) and per server, with AIMD backoff on
+    temporary SMTP failures. Explicit per_minute/per_day override SMTP_PROVIDER_LIMITS.
+    `max_wait` bounds the sleep of background senders, `inline_wait` that of sends made
+    on a caller's thread (0 = never sleep there).
+    """
+
+    def __init__(self, per_minute=None, per_day=None, provider_per_minute=None, provider_per_day=None,
+                 max_wait=30.0, inline_wait=0.0, base_backoff=30.0, max_backoff=900.0, min_scale=0.05,
+                 recovery=0.02):
+        self.per_minute = per_minute
+        self.per_day = per_day
+        self.provider_per_minute = provider_per_minute
+        self.provider_per_day = provider_per_day
+        self.max_wait = max_wait
+        self.inline_wait = inline_wait
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.min_scale = min_scale
+        self.recovery = recovery
+        self._accounts = {}
+        self._providers = {}
+        self._lock = threading.Lock()
+        self._stats = {"sends": 0, "waits": 0, "waited_seconds": 0.0, "throttled": 0, "refused": 0}
+
+    def _bump(self, name, amount=1):
+        self._stats[name] += amount
+
+    def _state(self, config):
+        server = config["server"].lower()
+        account = self._accounts.get((server, config["user"]))
+        if account is None:
+            default_minute, default_day = SMTP_PROVIDER_LIMITS.get(server, (None, None))
+            account = self._accounts[(server, config["user"])] = _AccountRate(_rate_buckets(
+                self.per_minute or default_minute, self.per_day or default_day
+            ))
+        provider = self._providers.get(server)
+        if provider is None:
+            provider = self._providers[server] = _rate_buckets(self.provider_per_minute, self.provider_per_day)
+        return account, provider
+
+    def reserve(self, config, now=None):
+        """
+        Take a token from every bucket and return 0, or return the seconds to wait
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            account, provider = self._state(config)
+            buckets = account.buckets + provider
+            wait = max(account.blocked_until - now, 0.0)
+            for bucket in buckets:
+                wait = max(wait, bucket.wait_time(now, account.scale))
+            if wait > 0:
+                return wait
+            for bucket in buckets:
+                bucket.tokens -= 1
+            self._bump("sends")
+            return 0.0
+
+    def delay(self, config, now=None):
+        """
+        Seconds until the account may send again after a provider throttle
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            account, _ = self._state(config)
+            return max(account.blocked_until - now, 0.0)
+
+    def acquire(self, config, max_wait=None):
+        """
+        Block until a send is allowed; raise SMTPThrottled if that is more than
+        `max_wait` (default self.max_wait) seconds away
+        """
+        max_wait = self.max_wait if max_wait is None else max_wait
+        waited = 0.0
+        while True:
+            wait = self.reserve(config)
+            if wait <= 0:
+                if waited:
+                    with self._lock:
+                        self._bump("waits")
+                        self._bump("waited_seconds", waited)
+                return
+            if waited + wait > max_wait:
+                with self._lock:
+                    self._bump("refused")
+                raise SMTPThrottled(f"Send rate limit for {config['user']}@{config['server']}", wait)
+            time.sleep(wait)
+            waited += wait
+
+    def throttled(self, config, code):
+        """
+        Record a temporary failure from the provider; returns the backoff in seconds
+        """
+        with self._lock:
+            account, _ = self._state(config)
+            account.strikes += 1
+            account.scale = max(self.min_scale, account.scale / 2)
+            backoff = min(self.max_backoff, self.base_backoff * 2 ** (account.strikes - 1))
+            account.blocked_until = max(account.blocked_until, time.monotonic() + backoff)
+            for bucket in account.buckets:
+                if bucket.adaptive:
+                    bucket.tokens = min(bucket.tokens, 0.0)
+            self._bump("throttled")
+        _workflow_metrics.increment("smtp_throttled", code=code)
+        _log_event(logging.WARNING, "🐢 SMTP provider throttled sends, backing off",
+                   server=config["server"], sender=config["user"], code=code,
+                   backoff_seconds=round(backoff, 1), rate_scale=round(account.scale, 3))
+        return backoff
+
+    def success(self, config):
+        with self._lock:
+            account, _ = self._state(config)
+            account.strikes = 0
+            account.scale = min(1.0, account.scale + self.recovery)
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return dict(self._stats, accounts={
+                f"{user}@{server}": {"rate_scale": round(account.scale, 3),
+                                     "blocked_seconds": round(max(account.blocked_until - now, 0.0), 1)}
+                for (server, user), account in self._accounts.items()
+            })
+
+def _env_rate(name):
+    value = os.getenv(name)
+    return float(value) if value else None
+
+_send_rate_limiter = None
+_send_rate_limiter_lock = threading.Lock()
+
+def get_send_rate_limiter():
+    """
+    Process-wide limiter from WORKFLOW_SMTP_RATE_* settings; None unless WORKFLOW_SMTP_RATE_LIMIT=1.
+    Off by default: with it on, request-thread sends over the rate wait in the in-process
+    deferred queue, which only survives a clean shutdown (see workflow_outbox).
+    """
+    global _send_rate_limiter
+    if _send_rate_limiter is None and os.getenv('WORKFLOW_SMTP_RATE_LIMIT', '0') != '0':
+        with _send_rate_limiter_lock:
+            if _send_rate_limiter is None:
+                _send_rate_limiter = SendRateLimiter(
+                    per_minute=_env_rate('WORKFLOW_SMTP_RATE_PER_MINUTE'),
+                    per_day=_env_rate('WORKFLOW_SMTP_RATE_PER_DAY'),
+                    provider_per_minute=_env_rate('WORKFLOW_SMTP_PROVIDER_RATE_PER_MINUTE'),
+                    provider_per_day=_env_rate('WORKFLOW_SMTP_PROVIDER_RATE_PER_DAY'),
+                    max_wait=float(os.getenv('WORKFLOW_SMTP_MAX_RATE_WAIT', 30)),
+                    inline_wait=float(os.getenv('WORKFLOW_SMTP_INLINE_RATE_WAIT', 0)),
+                    base_backoff=float(os.getenv('WORKFLOW_SMTP_THROTTLE_BACKOFF', 30)),
+                )
+    return _send_rate_limiter
+
+def configure_send_rate_limiter(**settings):
+    """
+    Replace the process-wide limiter (settings as for SendRateLimiter)
+    """
+    global _send_rate_limiter
+    with _send_rate_limiter_lock:
+        _send_rate_limiter = SendRateLimiter(**settings)
+    return _send_rate_limiter
+
+def _throttle_error(config, exc):
+    """
+    SMTPThrottled for a provider's temporary failure (after recording the backoff), else None
+    """
+    code = _smtp_throttle_code(exc)
+    if code is None:
+        return None
+    limiter = get_send_rate_limiter()
+    retry_after = limiter.throttled(config, code) if limiter is not None else float(os.getenv('WORKFLOW_SMTP_THROTTLE_BACKOFF', 30))
+    return SMTPThrottled(f"SMTP {code}: {exc}", retry_after, code)
+
+class _SMTPSession:
+    def __init__(self, key, smtp):
+        self.key = key
+        self.smtp = smtp
+        self.messages_sent = 0
+        self.last_used = time.monotonic()
+        self.broken = False
+
+class SMTPSessionPool:
+    """
+    Authenticated SMTP sessions kept alive per (server, port, user).
+    Idle sessions are probed with NOOP before reuse and replaced when the server
+    has dropped them (421 / disconnect).
+    """
+
+    def __init__(self, max_idle_per_key=4, idle_timeout=240.0, max_messages_per_session=100):
+        self.max_idle_per_key = max_idle_per_key
+        self.idle_timeout = idle_timeout
+        self.max_messages_per_session = max_messages_per_session
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._stats = {"connects": 0, "reuses": 0, "probe_failures": 0, "reconnects": 0, "messages": 0}
+
+    def _bump(self, name, amount=1):
+        with self._lock:
+            self._stats[name] += amount
+
+    def _connect(self, config):
+        key = (config["server"], config["port"], config["user"])
+        try:
+            with _timed_stage("smtp_connect"):
+                smtp = smtplib.SMTP(config["server"], config["port"], timeout=config.get("timeout", 15))
+        except Exception as e:
+            throttled = _throttle_error(config, e)
+            if throttled is not None:
+                raise throttled from e
+            raise
+        try:
+            if config.get("starttls", True):
+                with _timed_stage("smtp_starttls"):
+                    smtp.starttls()
+            with _timed_stage("smtp_login"):
+                smtp.login(config["user"], config["password"])
+        except Exception as e:
+            self._quit(smtp)
+            # e.g. Gmail's "454 4.7.0 Too many login attempts"
+            throttled = _throttle_error(config, e)
+            if throttled is not None:
+                raise throttled from e
+            raise
+        self._bump("connects")
+        return _SMTPSession(key, smtp)
+
+    @staticmethod
+    def _quit(smtp):
+        try:
+            smtp.quit()
+        except Exception:
+            try:
+                smtp.close()
+            except Exception:
+                pass
+
+    def _probe(self, session):
+        if time.monotonic() - session.last_used > self.idle_timeout:
+            return False
+        try:
+            code, _ = session.smtp.noop()
+            return code == 250
+        except Exception:
+            return False
+
+    def acquire(self, config):
+        key = (config["server"], config["port"], config["user"])
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                session = idle.pop() if idle else None
+            if session is None:
+                return self._connect(config)
+            if self._probe(session):
+                self._bump("reuses")
+                return session
+            self._bump("probe_failures")
+            self._quit(session.smtp)
+
+    def release(self, session):
+        session.last_used = time.monotonic()
+        if session.broken or session.smtp.sock is None or session.messages_sent >= self.max_messages_per_session:
+            self._quit(session.smtp)
+            return
+        with self._lock:
+            idle = self._idle.setdefault(session.key, deque())
+            if len(idle) < self.max_idle_per_key:
+                idle.append(session)
+                return
+        self._quit(session.smtp)
+
+    @contextmanager
+    def session(self, config=None):
+        """
+        Borrow an authenticated session; it goes back to the pool on exit
+        """
+        with trace_span("smtp_acquire"):
+            session = self.acquire(config or _get_smtp_config())
+        try:
+            yield session
+        except SMTPThrottled as e:
+            # A refusal by our own limiter never touched the connection
+            if e.code == 421:
+                session.broken = True
+            raise
+        except Exception as e:
+            if not isinstance(e, (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError)) \
+                    or _is_reconnectable_smtp_error(e):
+                session.broken = True
+            raise
+        finally:
+            self.release(session)
+
+    def _send_on(self, session, config, msg, background=False):
+        """
+        Send one message on `session`, reconnecting once if the server dropped it.
+        Takes a send rate limiter token first, sleeping for it only in `background`
+        senders (or up to the limiter's inline_wait); provider throttling and an
+        unavailable token raise SMTPThrottled. Returns the session that is live afterwards.
+        """
+        limiter = get_send_rate_limiter()
+        if limiter is not None:
+            with trace_span("smtp_rate_wait"):
+                limiter.acquire(config, None if background else limiter.inline_wait)
+        try:
+            with _timed_stage("smtp_send"):
+                session.smtp.send_message(msg)
+        except Exception as e:
+            throttled = _throttle_error(config, e)
+            if throttled is not None:
+                if throttled.code == 421:
+                    session.broken = True
+                raise throttled from e
+            if not _is_reconnectable_smtp_error(e):
+                raise
+            self._bump("reconnects")
+            _workflow_metrics.increment("smtp_reconnects")
+            self._quit(session.smtp)
+            fresh = self._connect(config)
+            session.smtp = fresh.smtp
+            session.messages_sent = 0
+            with _timed_stage("smtp_send"):
+                session.smtp.send_message(msg)
+        session.messages_sent += 1
+        self._bump("messages")
+        if limiter is not None:
+            limiter.success(config)
+        _record_wire_size(msg, "smtp")
+        return session
+
+    def send(self, config, msg, background=False):
+        with self.session(config) as session:
+            self._send_on(session, config, msg, background)
+
+    def send_batch(self, config, messages, background=False):
+        """
+        Push many messages through one login. Returns a list of (ok, error) per message;
+        a refused recipient does not stop the rest of the batch. Once the provider
+        throttles, the remaining messages are not attempted and carry the SMTPThrottled error.
+        """
+        messages = list(messages)
+        results = []
+        with self.session(config) as session:
+            for msg in messages:
+                if session.messages_sent >= self.max_messages_per_session:
+                    self._quit(session.smtp)
+                    fresh = self._connect(config)
+                    session.smtp, session.messages_sent = fresh.smtp, 0
+                try:
+                    self._send_on(session, config, msg, background)
+                    results.append((True, None))
+                except SMTPThrottled as e:
+                    results.extend([(False, e)] * (len(messages) - len(results)))
+                    break
+                except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as e:
+                    results.append((False, e))
+        return results
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for sessions in idle.values():
+            for session in sessions:
+                self._quit(session.smtp)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, idle=sum(len(v) for v in self._idle.values()))
+
+_smtp_pool = None
+_smtp_pool_lock = threading.Lock()
+
+def get_smtp_pool():
+    global _smtp_pool
+    if _smtp_pool is None:
+        with _smtp_pool_lock:
+            if _smtp_pool is None:
+                _smtp_pool = SMTPSessionPool(
+                    max_idle_per_key=int(os.getenv('WORKFLOW_SMTP_POOL_SIZE', 4)),
+                    idle_timeout=float(os.getenv('WORKFLOW_SMTP_IDLE_TIMEOUT', 240)),
+                    max_messages_per_session=int(os.getenv('WORKFLOW_SMTP_MAX_MESSAGES', 100)),
+                )
+    return _smtp_pool
+
+def close_smtp_pool():
+    global _smtp_pool
+    with _smtp_pool_lock:
+        pool, _smtp_pool = _smtp_pool, None
+    if pool is not None:
+        pool.close()
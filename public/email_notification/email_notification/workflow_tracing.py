@@ -0,0 +1,378 @@
+"""
+Span tracing and slow-path profiling for the approval workflow.
+"""
+
+import os
+import sys
+import logging
+import json
+import itertools
+import functools
+import threading
+import time
+import contextvars
+from collections import deque
+from contextlib import nullcontext
+from datetime import datetime, timezone
+
+from workflow_core import _LazyModule, _log_event
+
+__all__ = [
+    "Span",
+    "TRACE_TAGS",
+    "WorkflowTracer",
+    "configure_tracing",
+    "configure_tracing_from_env",
+    "export_traces_jsonl",
+    "get_recent_traces",
+    "get_tracer",
+    "tag_trace",
+    "trace_span",
+    "traced",
+]
+
+# 🔥 NEW: Tracing. With WORKFLOW_TRACE=1 each public entry point (start_approval_workflow,
+# send_approval_email, ...) opens a root span and every pipeline stage, SQL statement and
+# SMTP phase underneath it records a child span; spans carry invoice_number/audit_id and
+# finished traces are written as JSON lines. WORKFLOW_PROFILE adds a sampling profiler
+# that only keeps data for root calls slower than WORKFLOW_PROFILE_THRESHOLD_MS.
+# Outside a trace the hooks cost one context-variable lookup.
+
+# Profiling dependencies load only when a profile mode is switched on
+_random = _LazyModule("random")
+_cProfile = _LazyModule("cProfile")
+_pstats = _LazyModule("pstats")
+
+_current_span = contextvars.ContextVar("workflow_span", default=None)
+_NO_SPAN = nullcontext()
+TRACE_TAGS = ("invoice_number", "audit_id")
+
+class _Trace:
+    __slots__ = ("tracer", "trace_id", "tags", "spans", "span_ids", "samples", "profiler")
+
+    def __init__(self, tracer, tags):
+        self.tracer = tracer
+        self.trace_id = os.urandom(8).hex()
+        self.tags = dict(tags)
+        self.spans = []
+        self.span_ids = itertools.count(1)
+        self.samples = None
+        self.profiler = None
+
+class Span:
+    __slots__ = ("trace", "name", "span_id", "parent_id", "started_at", "_started", "duration", "tags", "error")
+
+    def __init__(self, trace, name, parent_id, tags):
+        self.trace = trace
+        self.name = name
+        self.span_id = next(trace.span_ids)
+        self.parent_id = parent_id
+        self.tags = tags
+        self.error = None
+        self.duration = None
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+
+    def set_tag(self, key, value):
+        self.tags[key] = value
+
+    def to_dict(self):
+        record = {
+            "trace_id": self.trace.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": datetime.fromtimestamp(self.started_at, timezone.utc).isoformat(),
+            "duration_ms": round(self.duration * 1000, 3),
+        }
+        for key in TRACE_TAGS:
+            value = self.tags.get(key, self.trace.tags.get(key))
+            if value is not None:
+                record[key] = value
+        extra = {key: value for key, value in self.tags.items() if key not in TRACE_TAGS}
+        if extra:
+            record["tags"] = extra
+        if self.error:
+            record["error"] = self.error
+        return record
+
+class _SpanContext:
+    __slots__ = ("name", "tags", "span", "token")
+
+    def __init__(self, name, tags):
+        self.name = name
+        self.tags = tags
+        self.span = None
+        self.token = None
+
+    def __enter__(self):
+        parent = _current_span.get()
+        if parent is None:
+            trace = _Trace(_tracer, {key: value for key, value in self.tags.items() if key in TRACE_TAGS})
+            self.span = Span(trace, self.name, None, self.tags)
+            trace.tracer.begin(trace)
+        else:
+            self.span = Span(parent.trace, self.name, parent.span_id, self.tags)
+        self.token = _current_span.set(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        span = self.span
+        span.duration = time.perf_counter() - span._started
+        if exc is not None:
+            span.error = f"{exc_type.__name__}: {exc}"
+        _current_span.reset(self.token)
+        span.trace.spans.append(span)
+        if span.parent_id is None:
+            span.trace.tracer.finish(span)
+        return False
+
+def trace_span(name, root=False, **tags):
+    """
+    Child span of the current trace; a no-op context outside a trace unless `root`
+    asks for a new trace while tracing is on
+    """
+    if _current_span.get() is None and (not root or _tracer is None):
+        return _NO_SPAN
+    return _SpanContext(name, tags)
+
+def tag_trace(**tags):
+    """
+    Attach tags (e.g. the audit_id once it is known) to every span of the current trace
+    """
+    span = _current_span.get()
+    if span is not None:
+        span.trace.tags.update((key, value) for key, value in tags.items() if value is not None)
+
+def traced(name=None, tags=TRACE_TAGS):
+    """
+    Decorator: run the function as a root span when tracing is on (or as a child span
+    inside an active trace), tagged from the arguments named in `tags`
+    """
+    def decorate(func):
+        span_name = name or func.__name__
+        code = func.__code__
+        arg_names = code.co_varnames[:code.co_argcount]
+        positions = tuple((arg_names.index(tag), tag) for tag in tags if tag in arg_names)
+        
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return func(*args, **kwargs)
+            span_tags = {}
+            for index, tag in positions:
+                value = args[index] if index < len(args) else kwargs.get(tag)
+                if value is not None:
+                    span_tags[tag] = value
+            with _SpanContext(span_name, span_tags):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def _collapsed_stack(frame, limit=64):
+    names = []
+    while frame is not None and len(names) < limit:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+class _StackSampler:
+    """
+    One daemon thread that samples the stacks of root calls once they have run
+    longer than the threshold; fast calls are never sampled
+    """
+
+    def __init__(self, threshold, interval):
+        self.threshold = threshold
+        self.interval = interval
+        self._active = {}  # thread id -> (trace, started)
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def begin(self, trace):
+        with self._cond:
+            self._active[threading.get_ident()] = (trace, time.perf_counter())
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="workflow-stack-sampler", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def end(self, trace):
+        with self._cond:
+            self._active.pop(threading.get_ident(), None)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._active:
+                    self._cond.wait()
+                now = time.perf_counter()
+                slow = [(thread_id, trace) for thread_id, (trace, started) in self._active.items()
+                        if now - started >= self.threshold]
+                if not slow:
+                    first = min(started for _, started in self._active.values())
+                    self._cond.wait(max(first + self.threshold - now, self.interval))
+                    continue
+                frames = sys._current_frames()
+                for thread_id, trace in slow:
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        if trace.samples is None:
+                            trace.samples = {}
+                        stack = _collapsed_stack(frame)
+                        trace.samples[stack] = trace.samples.get(stack, 0) + 1
+                del frames
+            time.sleep(self.interval)
+
+class WorkflowTracer:
+    """
+    Collects finished traces: writes them as JSON lines to `path` (one object per span,
+    plus one "profile" object for slow profiled roots) and keeps the last `buffer` in memory.
+    `profile` is None, "stack" (sampled stacks of slow roots) or "cprofile" (cProfile on a
+    `sample_rate` share of roots, kept only when the root was slow).
+    """
+
+    def __init__(self, path=None, min_ms=0.0, buffer=200, profile=None, profile_threshold_ms=1000.0,
+                 profile_interval_ms=5.0, sample_rate=0.1):
+        if profile not in (None, "stack", "cprofile"):
+            raise ValueError(f"Unknown profile mode: {profile}")
+        self.path = path
+        self.min_ms = min_ms
+        self.profile = profile
+        self.profile_threshold = profile_threshold_ms / 1000.0
+        self.sample_rate = sample_rate
+        self._recent = deque(maxlen=buffer)
+        self._lock = threading.Lock()
+        self._file = open(path, "a", encoding="utf-8") if path else None
+        self._sampler = _StackSampler(self.profile_threshold, profile_interval_ms / 1000.0) if profile == "stack" else None
+        self._stats = {"traces": 0, "exported": 0, "profiled": 0}
+
+    def begin(self, trace):
+        if self._sampler is not None:
+            self._sampler.begin(trace)
+        elif self.profile == "cprofile" and _random.random() < self.sample_rate:
+            profiler = _cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                return  # another profiler is active on this thread
+            trace.profiler = profiler
+
+    def _profile_record(self, trace, root):
+        if trace.profiler is not None:
+            trace.profiler.disable()
+        if root.duration < self.profile_threshold:
+            return None
+        record = {"trace_id": trace.trace_id, "type": "profile", "mode": self.profile, "name": root.name,
+                  "duration_ms": round(root.duration * 1000, 3)}
+        record.update((key, value) for key, value in trace.tags.items() if key in TRACE_TAGS)
+        if trace.samples:
+            record["samples"] = [
+                {"stack": stack, "count": count}
+                for stack, count in sorted(trace.samples.items(), key=lambda item: -item[1])
+            ]
+        elif trace.profiler is not None:
+            stats = _pstats.Stats(trace.profiler)
+            top = sorted(stats.stats.items(), key=lambda item: -item[1][3])[:40]
+            record["functions"] = [
+                {"function": f"{os.path.basename(filename)}:{line}({function})", "calls": calls,
+                 "tottime_ms": round(tottime * 1000, 3), "cumtime_ms": round(cumtime * 1000, 3)}
+                for (filename, line, function), (_, calls, tottime, cumtime, _) in top
+            ]
+        else:
+            return None
+        return record
+
+    def finish(self, root):
+        trace = root.trace
+        if self._sampler is not None:
+            self._sampler.end(trace)
+        profile = self._profile_record(trace, root) if self.profile else None
+        with self._lock:
+            self._stats["traces"] += 1
+        if root.duration * 1000 < self.min_ms and profile is None:
+            return
+        records = [span.to_dict() for span in sorted(trace.spans, key=lambda span: span.span_id)]
+        if profile is not None:
+            records.append(profile)
+        with self._lock:
+            self._stats["exported"] += 1
+            self._stats["profiled"] += profile is not None
+            self._recent.append(records)
+            if self._file is not None:
+                self._file.write("".join(json.dumps(record, default=str) + "\n" for record in records))
+                self._file.flush()
+        if profile is not None:
+            _log_event(logging.WARNING, "🐌 Slow workflow call profiled", trace_id=trace.trace_id,
+                       name=root.name, duration_ms=round(root.duration * 1000), **{
+                           key: value for key, value in trace.tags.items() if key in TRACE_TAGS})
+
+    def recent(self):
+        with self._lock:
+            return list(self._recent)
+
+    def export(self, path):
+        """
+        Write the buffered traces to `path` as JSON lines; returns the number of records
+        """
+        traces = self.recent()
+        with open(path, "w", encoding="utf-8") as f:
+            count = 0
+            for records in traces:
+                for record in records:
+                    f.write(json.dumps(record, default=str) + "\n")
+                    count += 1
+        return count
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, buffered=len(self._recent))
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+_tracer = None
+
+def configure_tracing(enabled=True, **settings):
+    """
+    Turn tracing on (settings as for WorkflowTracer) or off; returns the tracer or None
+    """
+    global _tracer
+    previous, _tracer = _tracer, None
+    if previous is not None:
+        previous.close()
+    if not enabled:
+        return None
+    _tracer = WorkflowTracer(**settings)
+    return _tracer
+
+def get_tracer():
+    return _tracer
+
+def get_recent_traces():
+    return _tracer.recent() if _tracer is not None else []
+
+def export_traces_jsonl(path):
+    return _tracer.export(path) if _tracer is not None else 0
+
+def configure_tracing_from_env():
+    """
+    Apply WORKFLOW_TRACE / WORKFLOW_PROFILE and their WORKFLOW_TRACE_* / WORKFLOW_PROFILE_*
+    settings; returns the tracer, or None when neither is switched on
+    """
+    profile = os.getenv('WORKFLOW_PROFILE', '').strip().lower() or None
+    if os.getenv('WORKFLOW_TRACE', '0') != '1' and not profile:
+        return None
+    return configure_tracing(
+        path=os.getenv('WORKFLOW_TRACE_FILE') or None,
+        min_ms=float(os.getenv('WORKFLOW_TRACE_MIN_MS', 0)),
+        buffer=int(os.getenv('WORKFLOW_TRACE_BUFFER', 200)),
+        profile=profile,
+        profile_threshold_ms=float(os.getenv('WORKFLOW_PROFILE_THRESHOLD_MS', 1000)),
+        profile_interval_ms=float(os.getenv('WORKFLOW_PROFILE_INTERVAL_MS', 5)),
+        sample_rate=float(os.getenv('WORKFLOW_PROFILE_SAMPLE_RATE', 0.1)),
+    )